@@ -0,0 +1,218 @@
+'''Benchmark cases, each run by run_benchmarks in a fresh process whose
+settings point at the stand-in server and a scratch database. Running one
+case prints its result as a json line.'''
+import sys
+import json
+import time
+import resource
+
+from benchmarks.fixtures import read_fixtures
+
+# Repetitions of the cheap cases, so they run long enough to time
+SCHEDULE_REPEATS = 20
+INSERT_MIN_ROWS = 200000
+# Parse cases repeat over the games until they have run this long
+MIN_CASE_SECONDS = 1.0
+
+
+def _games(n_games):
+    '''Decoded (game_id, game json, shiftchart json) of up to n_games
+    recorded games'''
+    game_bodies = read_fixtures('game')
+    toi_bodies = read_fixtures('toi')
+
+    games = []
+    for path, game_body in sorted(game_bodies.items())[:n_games]:
+        game_json = json.loads(game_body)
+        game_id = game_json['gameData']['game']['pk']
+        toi_body = next(
+            body for toi_path, body in toi_bodies.items()
+            if toi_path.endswith(f'={game_id}'))
+        games.append((game_id, game_json, json.loads(toi_body)))
+    return games
+
+
+def _repeat(parse_games, games):
+    '''Runs parse_games(games), which returns its row count, until
+    MIN_CASE_SECONDS have passed. Returns (seconds, games, rows).'''
+    started = time.perf_counter()
+    total_games = 0
+    rows = 0
+    while True:
+        rows += parse_games(games)
+        total_games += len(games)
+        seconds = time.perf_counter() - started
+        if seconds >= MIN_CASE_SECONDS or not games:
+            return seconds, total_games, rows
+
+
+def _clear_http_cache():
+    from misc_functions import response_cache
+
+    with response_cache.lock:
+        conn = response_cache._connect()
+        with conn:
+            conn.execute('DELETE FROM responses')
+        response_cache.total_bytes = 0
+
+
+def bench_get_schedule(n_games):
+    from nhl_api.get_game_schedules import get_schedule
+
+    season = next(iter(read_fixtures('schedule'))).rsplit('=', 1)[1]
+
+    seconds = 0
+    rows = 0
+    for _ in range(SCHEDULE_REPEATS):
+        # Time the request and parse, not the response cache
+        _clear_http_cache()
+        started = time.perf_counter()
+        rows += len(get_schedule(season))
+        seconds += time.perf_counter() - started
+    # The schedule lists one row per game
+    return seconds, rows, rows
+
+
+def bench_get_player_stats_by_team(n_games):
+    from nhl_api.get_game_data import get_player_stats_by_team
+
+    def parse_games(games):
+        rows = 0
+        for game_id, game_json, _ in games:
+            for HoA, is_home in [('away', 0), ('home', 1)]:
+                team_id = game_json['gameData']['teams'][HoA]['id']
+                game_dict = game_json['liveData']['boxscore']['teams'][HoA]
+                rows += sum(map(len, get_player_stats_by_team(
+                    game_dict, is_home, team_id, game_id)))
+        return rows
+
+    return _repeat(parse_games, _games(n_games))
+
+
+def bench_get_game_plays(n_games):
+    from nhl_api.get_game_data import get_game_plays
+
+    def parse_games(games):
+        return sum(
+            len(get_game_plays(
+                game_id, game_json['liveData'], game_json['gameData'], as_frame=False))
+            for game_id, game_json, _ in games)
+
+    return _repeat(parse_games, _games(n_games))
+
+
+def bench_get_game_plays_players(n_games):
+    from nhl_api.get_game_data import get_game_plays_players
+
+    def parse_games(games):
+        return sum(
+            len(get_game_plays_players(
+                game_id, game_json['liveData'], game_json['gameData'], as_frame=False))
+            for game_id, game_json, _ in games)
+
+    return _repeat(parse_games, _games(n_games))
+
+
+def bench_get_shift_data(n_games):
+    from nhl_api.get_game_data import get_shift_data
+
+    def parse_games(games):
+        return sum(
+            len(get_shift_data(toi_json, as_frame=False))
+            for _, _, toi_json in games)
+
+    return _repeat(parse_games, _games(n_games))
+
+
+def bench_insert_into_db(n_games):
+    import pandas as pd
+    from misc_functions import insert_into_db
+    from nhl_api.get_game_data import get_player_stats
+
+    games = _games(n_games)
+    frames = [
+        get_player_stats(game_json['liveData'], game_json['gameData'], game_id)[0]
+        for game_id, game_json, _ in games]
+    skater_stats = pd.concat(frames, ignore_index=True)
+    copies = -(-INSERT_MIN_ROWS // max(len(skater_stats), 1))
+    skater_stats = pd.concat([skater_stats] * copies, ignore_index=True)
+
+    started = time.perf_counter()
+    insert_into_db(skater_stats, 'bench_skater_game_stats')
+    return time.perf_counter() - started, len(games) * copies, len(skater_stats)
+
+
+def bench_get_shot_data(n_games):
+    from misc_functions import import_data_from_query
+    from moneypuck.get_moneypuck_data import get_shot_data
+
+    started = time.perf_counter()
+    get_shot_data()
+    seconds = time.perf_counter() - started
+    rows = import_data_from_query(
+        'SELECT COUNT(*) AS n FROM shot_data_advanced')['n'][0]
+    return seconds, None, int(rows)
+
+
+def bench_ingest(n_games):
+    '''End to end: fetch, parse and write n_games through get_game_info'''
+    import pandas as pd
+    from misc_functions import import_data_from_query
+    from nhl_api.get_game_data import get_game_info
+
+    game_ids = sorted(
+        int(path.split('/')[4]) for path in read_fixtures('game'))[:n_games]
+    games_df = pd.DataFrame({
+        'game_id': game_ids,
+        'link': [f'/api/v1/game/{game_id}/feed/live' for game_id in game_ids]})
+
+    started = time.perf_counter()
+    get_game_info(games_df)
+    seconds = time.perf_counter() - started
+
+    rows = sum(
+        int(import_data_from_query(f'SELECT COUNT(*) AS n FROM {table}')['n'][0])
+        for table in ['games', 'team_game_info', 'game_players', 'skater_game_stats',
+                      'goalie_game_stats', 'game_plays_info', 'game_play_players',
+                      'game_shift_info', 'game_play_on_ice'])
+    return seconds, len(game_ids), rows
+
+
+BENCHMARKS = {
+    'get_schedule': bench_get_schedule,
+    'get_player_stats_by_team': bench_get_player_stats_by_team,
+    'get_game_plays': bench_get_game_plays,
+    'get_game_plays_players': bench_get_game_plays_players,
+    'get_shift_data': bench_get_shift_data,
+    'insert_into_db': bench_insert_into_db,
+    'get_shot_data': bench_get_shot_data,
+    'ingest': bench_ingest,
+}
+
+# Fixture kind a case cannot run without, other than game feeds
+required_fixtures = {
+    'get_schedule': 'schedule',
+    'get_shift_data': 'toi',
+    'get_shot_data': 'shots',
+}
+
+
+def run_case(name, n_games):
+    seconds, games, rows = BENCHMARKS[name](n_games)
+    # Peak resident memory of this process and of its parse workers, in MB
+    # (ru_maxrss is KB on Linux)
+    peak_mb = max(
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss) / 1024
+    return {
+        'seconds': round(seconds, 4),
+        'games': games,
+        'rows': rows,
+        'games_per_s': round(games / seconds, 2) if games and seconds else None,
+        'rows_per_s': round(rows / seconds, 1) if rows and seconds else None,
+        'peak_mb': round(peak_mb, 1),
+    }
+
+
+if __name__ == '__main__':
+    print(json.dumps(run_case(sys.argv[1], int(sys.argv[2]))))
@@ -0,0 +1,215 @@
+import io
+import os
+import json
+import zlib
+import logging
+import zipfile
+import tempfile
+
+from urllib.parse import urlsplit
+
+import requests
+
+from settings import (
+    ARCHIVE_DATABASE_NAME,
+    NHL_STATS_API_URL,
+    NHL_SHIFTS_API_URL,
+    MONEYPUCK_HOST_URL,
+    MONEYPUCK_SHOTS_HOST_URL)
+import http_client
+
+logger = logging.getLogger()
+
+FIXTURE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+MANIFEST_NAME = 'manifest.json'
+
+# Paths as the fetchers request them, relative to their API host
+game_feed_path = '/api/v1/game/{game_id}/feed/live'
+shiftchart_path = '/stats/rest/en/shiftcharts?cayenneExp=gameId={game_id}'
+schedule_path = '/api/v1/schedule?season={season}'
+season_summary_path = '/moneypuck/playerData/seasonSummary/{year}/regular/skaters.csv'
+shots_path = '/moneypuck/downloads/shots_{year}.zip'
+
+
+def path_of(link):
+    '''The part of a url the stand-in server is asked for'''
+    parts = urlsplit(link)
+    return parts.path + ('?' + parts.query if parts.query else '')
+
+
+class FixtureRecorder:
+    '''Writes response bodies to fixture_path, indexed by request path in
+    the manifest'''
+
+    def __init__(self, fixture_path=FIXTURE_PATH):
+        self.fixture_path = fixture_path
+        self.manifest = {}
+        os.makedirs(fixture_path, exist_ok=True)
+
+    def add(self, path, body, kind):
+        file_name = f'{len(self.manifest):05d}_{kind}'
+        with open(os.path.join(self.fixture_path, file_name), 'wb') as f:
+            f.write(body)
+        self.manifest[path] = {'file': file_name, 'kind': kind}
+
+    def save(self):
+        with open(os.path.join(self.fixture_path, MANIFEST_NAME), 'w') as f:
+            json.dump(self.manifest, f, indent=1)
+        logger.info(f'Recorded {len(self.manifest)} fixtures in {self.fixture_path}')
+
+
+def load_manifest(fixture_path=FIXTURE_PATH):
+    manifest_file = os.path.join(fixture_path, MANIFEST_NAME)
+    if not os.path.exists(manifest_file):
+        raise FileNotFoundError(
+            f'No fixtures in {fixture_path}, record them with '
+            'python -m benchmarks.fixtures')
+    with open(manifest_file) as f:
+        return json.load(f)
+
+
+def read_fixtures(kind, fixture_path=FIXTURE_PATH):
+    '''Returns {path: body} of every recorded fixture of a kind'''
+    return {
+        path: open(os.path.join(fixture_path, entry['file']), 'rb').read()
+        for path, entry in load_manifest(fixture_path).items()
+        if entry['kind'] == kind}
+
+
+def _archived_games(season, n_games):
+    '''Up to n_games (game_id, game body, shiftchart body) of a season from
+    the raw feed archive'''
+    from nhl_api.game_archive import (
+        connect_archive, get_archived_game_ids, get_archived_payloads)
+
+    if not os.path.exists(ARCHIVE_DATABASE_NAME):
+        return []
+    conn = connect_archive()
+    try:
+        games = []
+        for game_id in get_archived_game_ids(conn, [season])[:n_games]:
+            payloads = get_archived_payloads(conn, game_id)
+            if set(payloads) == {'game', 'toi'}:
+                games.append((
+                    game_id, zlib.decompress(payloads['game']),
+                    zlib.decompress(payloads['toi'])))
+        return games
+    finally:
+        conn.close()
+
+
+def _live_games(season, n_games):
+    '''Up to n_games (game_id, game body, shiftchart body) of a season,
+    fetched from the live API'''
+    from misc_functions import get_json_data_from_link, get_raw_data_from_link
+
+    schedule = get_json_data_from_link(
+        NHL_STATS_API_URL + schedule_path.format(season=season))
+    game_ids = [
+        game['gamePk'] for date in schedule.get('dates', [])
+        for game in date.get('games', []) if game.get('gameType') == 'R']
+
+    games = []
+    for game_id in game_ids[:n_games]:
+        game_body = get_raw_data_from_link(
+            NHL_STATS_API_URL + game_feed_path.format(game_id=game_id))
+        toi_body = get_raw_data_from_link(
+            NHL_SHIFTS_API_URL + shiftchart_path.format(game_id=game_id))
+        if game_body is not None and toi_body is not None:
+            games.append((game_id, game_body, toi_body))
+    return games
+
+
+def _schedule_from_games(season, games):
+    '''A schedule payload listing the recorded games, used when the real
+    schedule cannot be fetched'''
+    dates = {}
+    for game_id, game_body, _ in games:
+        game_data = json.loads(game_body)['gameData']
+        date = game_data['datetime']['dateTime'][:10]
+        dates.setdefault(date, []).append({
+            'gamePk': game_id,
+            'link': game_feed_path.format(game_id=game_id),
+            'gameType': game_data['game']['type'],
+            'season': season,
+            'gameDate': game_data['datetime']['dateTime'],
+        })
+    return json.dumps({'dates': [
+        {'date': date, 'games': dates[date]} for date in sorted(dates)]}).encode()
+
+
+def _truncated_shots(year, shot_rows):
+    '''The season's MoneyPuck shot archive cut down to its first shot_rows
+    rows, re-zipped'''
+    link = MONEYPUCK_SHOTS_HOST_URL + shots_path.format(year=year)
+    with tempfile.TemporaryFile() as f:
+        with http_client.get(link, stream=True) as r:
+            r.raise_for_status()
+            for chunk in r.iter_content(1024 ** 2):
+                f.write(chunk)
+        f.seek(0)
+        with zipfile.ZipFile(f) as source:
+            member = next(name for name in source.namelist() if name.endswith('.csv'))
+            with source.open(member) as csv_file:
+                lines = [csv_file.readline() for _ in range(shot_rows + 1)]
+
+    out = io.BytesIO()
+    with zipfile.ZipFile(out, 'w', zipfile.ZIP_DEFLATED) as target:
+        target.writestr(f'shots_{year}.csv', b''.join(lines))
+    return out.getvalue()
+
+
+def record_fixtures(season='20192020', n_games=200, shot_rows=100000,
+                    source='archive', fixture_path=FIXTURE_PATH):
+    '''Records the payloads the benchmarks replay: n_games game feeds and
+    shiftcharts of a season (from the raw feed archive, falling back to the
+    live API), the season's schedule and MoneyPuck skater summary, and the
+    first shot_rows rows of its MoneyPuck shots.'''
+
+    games = _archived_games(season, n_games) if source == 'archive' else []
+    if len(games) < n_games:
+        logger.info(f'{len(games)} games archived, fetching the rest live')
+        archived = {game_id for game_id, _, _ in games}
+        games += [
+            game for game in _live_games(season, n_games)
+            if game[0] not in archived][:n_games - len(games)]
+    if not games:
+        raise RuntimeError(f'No games of {season} could be recorded')
+
+    recorder = FixtureRecorder(fixture_path)
+    for game_id, game_body, toi_body in games:
+        recorder.add(game_feed_path.format(game_id=game_id), game_body, 'game')
+        recorder.add(shiftchart_path.format(game_id=game_id), toi_body, 'toi')
+
+    # The schedule only lists the recorded games, so replaying it never
+    # asks the stand-in server for a game it does not have
+    recorder.add(
+        schedule_path.format(season=season),
+        _schedule_from_games(season, games), 'schedule')
+
+    year = int(season[:4])
+    try:
+        summary = http_client.get(
+            MONEYPUCK_HOST_URL + season_summary_path.format(year=year))
+        summary.raise_for_status()
+        recorder.add(season_summary_path.format(year=year), summary.content, 'summary')
+        recorder.add(shots_path.format(year=year), _truncated_shots(year, shot_rows), 'shots')
+    except requests.RequestException as e:
+        logger.warning(f'Could not record MoneyPuck data for {year}: {e}')
+
+    recorder.save()
+    return len(games)
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Record benchmark fixtures')
+    parser.add_argument('--season', default='20192020')
+    parser.add_argument('--games', type=int, default=200)
+    parser.add_argument('--shot-rows', type=int, default=100000)
+    parser.add_argument('--source', choices=['archive', 'live'], default='archive')
+    args = parser.parse_args()
+
+    logging.basicConfig(level='INFO')
+    record_fixtures(args.season, args.games, args.shot_rows, args.source)
@@ -0,0 +1,163 @@
+'''Runs the benchmark cases against the stand-in server and appends the
+results to benchmarks/results.jsonl, comparing them with the last run of
+the same configuration. Run from src/:
+
+    python -m benchmarks.fixtures --games 200      # once, records fixtures
+    python -m benchmarks.run_benchmarks --games 200 --latency 0.05
+'''
+import os
+import sys
+import json
+import time
+import logging
+import platform
+import argparse
+import tempfile
+import subprocess
+
+from benchmarks.server import StandInServer
+from benchmarks.fixtures import load_manifest
+from benchmarks.bench_cases import BENCHMARKS, required_fixtures
+
+logger = logging.getLogger()
+
+SRC_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+RESULTS_FILE = os.path.join(SRC_PATH, 'benchmarks', 'results.jsonl')
+# A case is a regression when its throughput drops by more than this
+REGRESSION_THRESHOLD = 0.2
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=SRC_PATH,
+            capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_case(name, n_games, server_url, work_path):
+    '''Runs one case in a fresh process, so settings read the stand-in
+    urls and scratch paths and peak memory is the case's own'''
+
+    env = dict(
+        os.environ,
+        PYTHONPATH=SRC_PATH,
+        NHL_DATABASE=os.path.join(work_path, f'{name}.db'),
+        NHL_ARCHIVE_DATABASE=os.path.join(work_path, f'{name}_archive.db'),
+        NHL_HTTP_CACHE=os.path.join(work_path, f'{name}_http_cache.db'),
+        NHL_REQUESTS_PER_SECOND='0',
+        NHL_STATS_API_URL=server_url,
+        NHL_SHIFTS_API_URL=server_url,
+        MONEYPUCK_HOST_URL=server_url,
+        MONEYPUCK_SHOTS_HOST_URL=server_url)
+    result = subprocess.run(
+        [sys.executable, '-m', 'benchmarks.bench_cases', name, str(n_games)],
+        cwd=work_path, env=env, capture_output=True, text=True)
+    if result.returncode != 0:
+        logger.error(f'{name} failed:\n{result.stderr[-2000:]}')
+        return None
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def load_previous(config):
+    '''The last stored run with the same configuration'''
+    if not os.path.exists(RESULTS_FILE):
+        return None
+    previous = None
+    with open(RESULTS_FILE) as f:
+        for line in f:
+            run = json.loads(line)
+            if run['config'] == config:
+                previous = run
+    return previous
+
+
+def throughput(result):
+    if result is None:
+        return None
+    return result['rows_per_s'] or result['games_per_s']
+
+
+def compare(results, previous):
+    '''Returns the names of cases slower than in the previous run'''
+
+    regressions = []
+    print(f"\n{'case':<26}{'seconds':>10}{'games/s':>10}{'rows/s':>12}"
+          f"{'peak MB':>9}{'change':>9}")
+    for name, result in results.items():
+        if result is None:
+            print(f'{name:<26}{"failed":>10}')
+            continue
+
+        change = ''
+        before = throughput((previous or {}).get('results', {}).get(name))
+        after = throughput(result)
+        if before and after:
+            ratio = after / before - 1
+            change = f'{ratio:+.0%}'
+            if ratio < -REGRESSION_THRESHOLD:
+                regressions.append(name)
+                change += ' !'
+
+        print(f"{name:<26}{result['seconds']:>10.3f}"
+              f"{result['games_per_s'] or '':>10}{result['rows_per_s'] or '':>12}"
+              f"{result['peak_mb']:>9}{change:>9}")
+    return regressions
+
+
+def run_benchmarks(n_games=200, latency=0.05, jitter=0.0, cases=None, save=True):
+    cases = list(cases or BENCHMARKS)
+    config = {'games': n_games, 'latency': latency, 'jitter': jitter}
+
+    recorded = {entry['kind'] for entry in load_manifest().values()}
+    for name in list(cases):
+        if required_fixtures.get(name, 'game') not in recorded:
+            logger.warning(f'Skipping {name}, its fixtures were not recorded')
+            cases.remove(name)
+
+    results = {}
+    with StandInServer(latency=latency, jitter=jitter) as server, \
+            tempfile.TemporaryDirectory() as work_path:
+        for name in cases:
+            logger.info(f'Running {name}')
+            results[name] = run_case(name, n_games, server.url, work_path)
+
+    previous = load_previous(config)
+    regressions = compare(results, previous)
+    if previous is not None:
+        print(f"\nCompared with {previous['commit']} "
+              f"({time.strftime('%Y-%m-%d', time.localtime(previous['timestamp']))})")
+    if regressions:
+        print(f"Regressions (over {REGRESSION_THRESHOLD:.0%} slower): {', '.join(regressions)}")
+
+    if save:
+        with open(RESULTS_FILE, 'a') as f:
+            f.write(json.dumps({
+                'timestamp': time.time(),
+                'commit': git_commit(),
+                'python': platform.python_version(),
+                'machine': platform.machine(),
+                'cpus': os.cpu_count(),
+                'config': config,
+                'results': results,
+            }) + '\n')
+    return results, regressions
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level='INFO')
+    parser = argparse.ArgumentParser(description='Run the ingest benchmarks')
+    parser.add_argument('--games', type=int, default=200)
+    parser.add_argument('--latency', type=float, default=0.05,
+                        help='seconds the stand-in server waits per request')
+    parser.add_argument('--jitter', type=float, default=0.0)
+    parser.add_argument('--cases', nargs='*', choices=list(BENCHMARKS))
+    parser.add_argument('--no-save', action='store_true')
+    parser.add_argument('--fail-on-regression', action='store_true')
+    args = parser.parse_args()
+
+    _, regressions = run_benchmarks(
+        args.games, args.latency, args.jitter, args.cases, not args.no_save)
+    if regressions and args.fail_on_regression:
+        sys.exit(1)
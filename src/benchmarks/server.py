@@ -0,0 +1,145 @@
+import os
+import gzip
+import time
+import random
+import hashlib
+import logging
+import threading
+
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+from benchmarks.fixtures import FIXTURE_PATH, load_manifest
+
+logger = logging.getLogger()
+
+content_types = {
+    'game': 'application/json',
+    'toi': 'application/json',
+    'schedule': 'application/json',
+    'summary': 'text/csv',
+    'shots': 'application/zip',
+}
+
+
+class StandInServer:
+    '''Serves recorded fixtures over HTTP on localhost, standing in for the
+    NHL and MoneyPuck APIs. Every response is delayed by latency seconds,
+    plus up to jitter seconds at random, to mimic the real round trip.
+    Supports HEAD, ETag conditional GETs and gzip content encoding of
+    text responses like the real hosts.
+
+    Use as a context manager; url is the base url to point the
+    *_URL settings at.'''
+
+    def __init__(self, fixture_path=FIXTURE_PATH, latency=0.0, jitter=0.0):
+        self.latency = latency
+        self.jitter = jitter
+        self.responses = {}
+        for path, entry in load_manifest(fixture_path).items():
+            with open(os.path.join(fixture_path, entry['file']), 'rb') as f:
+                body = f.read()
+            etag = '"' + hashlib.md5(body).hexdigest() + '"'
+            content_type = content_types[entry['kind']]
+            gzipped = None
+            if content_type != 'application/zip':
+                gzipped = gzip.compress(body, compresslevel=6)
+            self.responses[path] = (body, gzipped, etag, content_type)
+        self.requests_served = 0
+        self.bytes_served = 0
+        self.httpd = None
+        self.thread = None
+
+    @property
+    def url(self):
+        host, port = self.httpd.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def _handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def _respond(self, send_body):
+                delay = server.latency + random.uniform(0, server.jitter)
+                if delay:
+                    time.sleep(delay)
+
+                response = server.responses.get(self.path)
+                if response is None:
+                    self.send_response(404)
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+
+                body, gzipped, etag, content_type = response
+                if self.headers.get('If-None-Match') == etag:
+                    self.send_response(304)
+                    self.send_header('ETag', etag)
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+
+                self.send_response(200)
+                if gzipped is not None and 'gzip' in self.headers.get(
+                        'Accept-Encoding', ''):
+                    body = gzipped
+                    self.send_header('Content-Encoding', 'gzip')
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.send_header('ETag', etag)
+                self.end_headers()
+                if send_body:
+                    self.wfile.write(body)
+                    server.requests_served += 1
+                    server.bytes_served += len(body)
+
+            def do_GET(self):
+                self._respond(send_body=True)
+
+            def do_HEAD(self):
+                self._respond(send_body=False)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+    def start(self):
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), self._handler())
+        self.httpd.daemon_threads = True
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+        logger.info(f'Stand-in API serving {len(self.responses)} fixtures at {self.url}')
+        return self
+
+    def stop(self):
+        if self.httpd is not None:
+            self.httpd.shutdown()
+            self.httpd.server_close()
+            self.httpd = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+        return False
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Serve recorded fixtures')
+    parser.add_argument('--latency', type=float, default=0.05)
+    parser.add_argument('--jitter', type=float, default=0.0)
+    args = parser.parse_args()
+
+    logging.basicConfig(level='INFO')
+    with StandInServer(latency=args.latency, jitter=args.jitter) as server:
+        print(f'Point NHL_STATS_API_URL, NHL_SHIFTS_API_URL, MONEYPUCK_HOST_URL '
+              f'and MONEYPUCK_SHOTS_HOST_URL at {server.url}, Ctrl-C to stop')
+        try:
+            server.thread.join()
+        except KeyboardInterrupt:
+            pass
@@ -0,0 +1,272 @@
+'''Command line entry point for the data pipeline. Run from src/:
+
+    python cli.py schedules        # seasons and game schedules
+    python cli.py games            # games not ingested yet
+    python cli.py players
+    python cli.py teams
+    python cli.py moneypuck
+    python cli.py features         # player-season features
+    python cli.py reprocess --seasons 20192020
+    python cli.py on-ice --seasons 20192020   # backfill players on ice
+    python cli.py dead-letters [--retry]
+    python cli.py export           # season-partitioned Parquet copies
+    python cli.py update           # what a scheduled run does
+    python cli.py status
+
+Each command imports only the modules it needs, so short commands such as
+status start without loading pandas or opening the database through
+SQLAlchemy. --database and --offline are applied before settings are
+first imported.
+'''
+import os
+import sys
+import time
+import logging
+import argparse
+
+logger = logging.getLogger()
+
+
+def run_schedules(args):
+    from nhl_api.get_seasons import get_seasons
+    from nhl_api.get_game_schedules import get_game_schedules
+
+    get_seasons()
+    get_game_schedules()
+
+
+def run_games(args):
+    from nhl_api.get_game_data import get_game_data
+
+    get_game_data(args.workers, args.parse_workers)
+
+
+def run_players(args):
+    from nhl_api.get_player_info import get_player_data
+
+    get_player_data()
+
+
+def run_teams(args):
+    from nhl_api.get_team_info import get_team_data
+
+    get_team_data()
+
+
+def run_moneypuck(args):
+    from moneypuck.get_moneypuck_data import (
+        get_season_summary_data, get_shot_data)
+
+    if args.only in (None, 'summaries'):
+        get_season_summary_data()
+    if args.only in (None, 'shots'):
+        get_shot_data()
+
+
+def run_features(args):
+    from features.player_season_features import refresh_player_season_features
+
+    refresh_player_season_features()
+
+
+def run_reprocess(args):
+    from nhl_api.reprocess_games import reprocess
+
+    reprocess(args.tables, args.seasons, args.parse_workers)
+
+
+def run_on_ice(args):
+    from nhl_api.get_on_ice import build_on_ice_table
+
+    build_on_ice_table(args.seasons or None)
+
+
+def run_dead_letters(args):
+    from nhl_api.ingest_jobs import get_dead_letter_games, retry_dead_letter_games
+
+    if args.retry:
+        retry_dead_letter_games(args.game_ids or None)
+        return
+
+    dead = get_dead_letter_games()
+    if args.game_ids:
+        dead = dead[dead['game_id'].isin(args.game_ids)]
+    if dead.empty:
+        print('No dead-lettered games')
+        return
+    for game in dead.itertuples():
+        print(f'{game.game_id}  {game.attempts} attempts  {game.last_error}')
+
+
+def run_export(args):
+    from parquet_export import export_parquet
+
+    export_parquet(args.tables, args.seasons, args.force)
+
+
+def run_update(args):
+    '''MoneyPuck data, new games, their players, then the features built
+    from them'''
+    from moneypuck.get_moneypuck_data import get_moneypuck_data
+    from nhl_api.get_game_data import get_game_data
+    from nhl_api.get_player_info import get_player_data
+    from features.player_season_features import refresh_player_season_features
+
+    get_moneypuck_data()
+    get_game_data(args.workers, args.parse_workers)
+    get_player_data()
+    refresh_player_season_features()
+
+
+status_queries = [
+    ('scheduled games played',
+     "SELECT COUNT(*) FROM game_schedules WHERE gameDate < date('now')"),
+    ('games ingested', 'SELECT COUNT(*) FROM games'),
+    ('players', 'SELECT COUNT(*) FROM player_info'),
+    ('teams', 'SELECT COUNT(*) FROM team_info'),
+    ('player-seasons', 'SELECT COUNT(*) FROM player_season_features'),
+]
+
+
+def run_status(args):
+    '''Reads the database with sqlite3 only, it never changes it'''
+    import sqlite3
+
+    from settings import DATABASE_NAME
+    from schema import MIGRATIONS, get_schema_version
+
+    if not os.path.exists(DATABASE_NAME):
+        print(f'{DATABASE_NAME} does not exist, run create_database.py')
+        return
+
+    conn = sqlite3.connect(f'file:{DATABASE_NAME}?mode=ro', uri=True)
+    try:
+        version = get_schema_version(conn)
+        latest = MIGRATIONS[-1][0]
+        print(f'database        {DATABASE_NAME}')
+        print(f'schema version  {version}'
+              + ('' if version == latest else f' (latest {latest}, run any command to migrate)'))
+
+        for name, query in status_queries:
+            try:
+                value = conn.execute(query).fetchone()[0]
+            except sqlite3.OperationalError:
+                value = '-'
+            print(f'{name:<24}{value:>10}')
+
+        try:
+            jobs = conn.execute(
+                'SELECT status, COUNT(*) FROM ingest_jobs GROUP BY status ORDER BY status'
+            ).fetchall()
+        except sqlite3.OperationalError:
+            jobs = []
+        for status, count in jobs:
+            print(f'{"jobs " + status:<24}{count:>10}')
+
+        try:
+            runs = conn.execute(
+                '''SELECT run_id, MAX(recorded_at) FROM ingest_metrics
+                   GROUP BY run_id ORDER BY MAX(recorded_at) DESC LIMIT 3'''
+            ).fetchall()
+        except sqlite3.OperationalError:
+            runs = []
+        for run_id, recorded_at in runs:
+            finished = time.strftime('%Y-%m-%d %H:%M', time.localtime(recorded_at))
+            print(f'last run        {run_id} ({finished})')
+    finally:
+        conn.close()
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(
+        prog='cli.py', description='NHL data pipeline')
+    parser.add_argument('--database', help='sqlite database file (NHL_DATABASE)')
+    parser.add_argument('--offline', action='store_true',
+                        help='serve requests from the response cache only')
+    parser.add_argument('--log-level', default='INFO')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    def add_workers(command):
+        # Defaults are read from settings when the command runs
+        command.add_argument('--workers', type=int, help='concurrent downloads')
+        command.add_argument('--parse-workers', type=int,
+                             help='parse processes, 0 parses in this process')
+
+    commands.add_parser(
+        'schedules', help='seasons and game schedules').set_defaults(func=run_schedules)
+
+    games = commands.add_parser('games', help='games not ingested yet')
+    add_workers(games)
+    games.set_defaults(func=run_games)
+
+    commands.add_parser(
+        'players', help='info of players without it').set_defaults(func=run_players)
+    commands.add_parser(
+        'teams', help='info of teams without it').set_defaults(func=run_teams)
+
+    moneypuck = commands.add_parser('moneypuck', help='MoneyPuck summaries and shots')
+    moneypuck.add_argument('--only', choices=['summaries', 'shots'])
+    moneypuck.set_defaults(func=run_moneypuck)
+
+    commands.add_parser(
+        'features', help='refresh player-season features').set_defaults(func=run_features)
+
+    reprocess = commands.add_parser(
+        'reprocess', help='rebuild game tables from the raw feed archive')
+    reprocess.add_argument('--tables', nargs='*')
+    reprocess.add_argument('--seasons', nargs='*')
+    reprocess.add_argument('--parse-workers', type=int)
+    reprocess.set_defaults(func=run_reprocess)
+
+    on_ice = commands.add_parser(
+        'on-ice', help='players on ice of stored games that lack them')
+    on_ice.add_argument('--seasons', nargs='*')
+    on_ice.set_defaults(func=run_on_ice)
+
+    dead_letters = commands.add_parser(
+        'dead-letters', help='list, or retry, games that kept failing')
+    dead_letters.add_argument('game_ids', nargs='*', type=int)
+    dead_letters.add_argument('--retry', action='store_true')
+    dead_letters.set_defaults(func=run_dead_letters)
+
+    export = commands.add_parser(
+        'export', help='Parquet copies of the large tables, by season')
+    export.add_argument('--tables', nargs='*')
+    export.add_argument('--seasons', nargs='*')
+    export.add_argument('--force', action='store_true',
+                        help='rewrite seasons that did not change')
+    export.set_defaults(func=run_export)
+
+    update = commands.add_parser(
+        'update', help='moneypuck, games, players and features')
+    add_workers(update)
+    update.set_defaults(func=run_update)
+
+    commands.add_parser(
+        'status', help='what the database holds').set_defaults(func=run_status)
+
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+
+    logging.basicConfig(level=args.log_level.upper())
+    if args.database:
+        os.environ['NHL_DATABASE'] = args.database
+    if args.offline:
+        os.environ['NHL_OFFLINE'] = '1'
+
+    # Settings are imported only now, so the options above apply to them
+    from settings import FETCH_WORKERS, PARSE_WORKERS
+
+    for name, default in [('workers', FETCH_WORKERS),
+                          ('parse_workers', PARSE_WORKERS)]:
+        if getattr(args, name, default) is None:
+            setattr(args, name, default)
+
+    args.func(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,128 @@
+import zlib
+import datetime
+
+from settings import COMPRESS_PLAY_DESCRIPTIONS
+from schema import COMPACT_PLAY_TABLES, PLAY_CODED_COLUMNS
+
+# Readable columns the views rebuild from other columns, never stored
+DERIVED_PLAY_COLUMNS = {'play_id', 'periodTime', 'periodTimeRemaining'}
+
+# Preset dictionary for compressing play descriptions, which are too short
+# to compress on their own. Stored descriptions depend on it: never edit
+# it. Most common fragments last, they cost the fewest bits.
+DESCRIPTION_ZDICT = (
+    b'Period Official Game Scheduled Game End Shootout Complete Early Intermission '
+    b'Fighting (5 min) Misconduct (10 min) Major Unsportsmanlike conduct '
+    b'Too many men on the ice - bench Delay of Game - Puck over glass '
+    b'Interference Roughing Cross checking High-sticking Holding Hooking Slashing Tripping '
+    b'Penalty Shot Empty Net Hit Crossbar Goalpost Over Net Tip-In Deflected Wrap-around '
+    b'Challenge Chlg Video Review Puck in Crowd Puck in Benches Puck in Netting '
+    b'Hand Pass High Stick Net Off Offside Icing TV timeout Player Injury Puck Frozen '
+    b'Goalie Stopped (after SOG) Goalie Stopped Period Ready Period Start Period End Stoppage '
+    b' against  drawn by  served by  Minor (2 min) '
+    b'Takeaway by Giveaway by  hit  blocked shot from  - Wide of Net '
+    b'Backhand Tip-In Slap Shot Snap Shot, assists: , assists: none '
+    b' Wrist Shot saved by  faceoff won against ')
+
+
+def compress_description(description):
+    compressor = zlib.compressobj(
+        9, zlib.DEFLATED, -zlib.MAX_WBITS, zdict=DESCRIPTION_ZDICT)
+    return compressor.compress(description.encode()) + compressor.flush()
+
+
+def play_description(value):
+    '''Decodes a game_plays_info description: compressed ones are stored as
+    blobs, plain ones as text. Registered as a SQL function, so
+    SELECT play_description(description) works on connect_db connections.'''
+    if not isinstance(value, bytes):
+        return value
+    decompressor = zlib.decompressobj(-zlib.MAX_WBITS, zdict=DESCRIPTION_ZDICT)
+    return (decompressor.decompress(value) + decompressor.flush()).decode()
+
+
+def register_play_functions(conn):
+    '''SQL functions for reading compressed play descriptions'''
+    conn.create_function('play_description', 1, play_description, deterministic=True)
+
+
+def iso_to_epoch(value):
+    '''"2019-10-02T23:07:13Z" to unix seconds'''
+    if not value:
+        return None
+    try:
+        return int(datetime.datetime.fromisoformat(
+            value.replace('Z', '+00:00')).timestamp())
+    except ValueError:
+        return None
+
+
+class PlayEncoder:
+    '''Turns game_plays_info and game_play_players rows, as the extractors
+    build them, into rows of the compact tables behind those views (see
+    schema.compact_plays). Text values of the coded columns are replaced
+    by their play_codes code, adding codes for values not seen yet.
+
+    Codes are cached, so call reset() when the transaction they were added
+    in rolls back.'''
+
+    def __init__(self, compress_descriptions=COMPRESS_PLAY_DESCRIPTIONS):
+        self.compress_descriptions = compress_descriptions
+        self.codes = None
+
+    def reset(self):
+        self.codes = None
+
+    def code(self, conn, column, value):
+        if value is None:
+            return None
+        if self.codes is None:
+            self.codes = {
+                (column_name, code_value): code
+                for code, column_name, code_value in conn.execute(
+                    'SELECT code, column_name, value FROM play_codes')}
+
+        key = (column, str(value))
+        code = self.codes.get(key)
+        if code is None:
+            conn.execute(
+                'INSERT OR IGNORE INTO play_codes (column_name, value) VALUES (?, ?)',
+                key)
+            code = conn.execute(
+                'SELECT code FROM play_codes WHERE column_name = ? AND value = ?',
+                key).fetchone()[0]
+            self.codes[key] = code
+        return code
+
+    def encode(self, conn, table_name, records):
+        '''Returns {table_name: records} to write in place of records'''
+
+        if table_name not in COMPACT_PLAY_TABLES:
+            return {table_name: records}
+
+        coded = PLAY_CODED_COLUMNS[table_name]
+        compact = []
+        descriptions = []
+        for record in records:
+            row = {}
+            for column, value in record.items():
+                if column in coded:
+                    row[coded[column]] = self.code(conn, column, value)
+                elif column == 'dateTime':
+                    row[column] = iso_to_epoch(value)
+                elif column == 'description':
+                    if value is not None:
+                        if self.compress_descriptions:
+                            value = compress_description(value)
+                        descriptions.append({
+                            'game_id': record['game_id'],
+                            'event_id': record['event_id'],
+                            'description': value})
+                elif column not in DERIVED_PLAY_COLUMNS:
+                    row[column] = value
+            compact.append(row)
+
+        tables = {COMPACT_PLAY_TABLES[table_name]: compact}
+        if table_name == 'game_plays_info':
+            tables['game_play_descriptions'] = descriptions
+        return tables
@@ -4,20 +4,24 @@ from sqlite3 import Error
 import logging
 
 from settings import DATABASE_NAME
+from schema import migrate_database, get_schema_version
 
 from nhl_api.get_seasons import get_seasons
 from nhl_api.get_game_schedules import get_game_schedules
 
-logging.basicConfig(level='INFO')
 logger = logging.getLogger()
 
 
 def create_database(db_file):
-    """ create a database connection to a SQLite database """
+    """ create a SQLite database, or migrate an existing one, to the current
+    schema version """
     conn = None
     try:
         conn = sqlite3.connect(db_file)
-        logger.info(f'Database creation complete. Successfully created {db_file}')
+        migrate_database(conn)
+        logger.info(
+            f'Database creation complete. Successfully created {db_file} '
+            f'(schema version {get_schema_version(conn)})')
     except Error as e:
         logger.error('Error: Database not created.')
         logger.error(e)
@@ -27,6 +31,7 @@ def create_database(db_file):
 
 
 if __name__ == '__main__':
+    logging.basicConfig(level='INFO')
     create_database(DATABASE_NAME)
     get_seasons()
     get_game_schedules()
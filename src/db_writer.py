@@ -0,0 +1,264 @@
+import json
+import time
+import atexit
+import logging
+
+from settings import DATABASE_NAME, GAMES_PER_FLUSH
+from misc_functions import connect_db
+from schema import migrate_database
+from metrics import estimate_bytes
+from compact_plays import PlayEncoder
+
+logger = logging.getLogger()
+
+# Tables describing players/teams rather than games, keyed by these columns.
+# Their rows are upserted, and only rewritten when a value changed and the
+# rows come from a game no older than the one stored (source_game_id).
+ENTITY_KEYS = {
+    'player_info': 'player_id',
+    'team_info': 'team_id',
+}
+
+
+def _sql_value(value):
+    '''Converts pandas/numpy values into types sqlite3 can bind'''
+    if value is None or isinstance(value, (str, int, float, bytes)):
+        return value
+    if hasattr(value, 'item'):
+        return value.item()
+    if isinstance(value, (dict, list)):
+        return json.dumps(value)
+    return str(value)
+
+
+def _to_records(rows):
+    '''Accepts a DataFrame or a list of dicts, returns a list of dicts'''
+    if rows is None:
+        return []
+    if hasattr(rows, 'to_dict'):
+        if rows.empty:
+            return []
+        return rows.astype(object).where(rows.notna(), None).to_dict('records')
+    return rows
+
+
+class BufferedWriter:
+    '''Collects the rows of every game table for several games and writes
+    them in a single transaction with executemany. Rows already stored for a
+    buffered game are replaced, so re-ingesting a game never duplicates it.
+
+    Use as a context manager; pending games are flushed on exit, including
+    when an exception is raised, and at interpreter exit. If only_tables is
+    given, rows for any other table are ignored and those tables are left
+    as they are. If metrics (an IngestMetrics) is given, every flush
+    records its duration and the rows and bytes written per table.
+
+    If a flush fails and on_game_failed is given, its games are written
+    again one at a time and on_game_failed(game_id, error) is called for
+    each that still fails; without it the error is raised. Either way the
+    failed games leave the buffer, so closing never retries them.
+
+    Rows of the play views (game_plays_info, game_play_players) are
+    encoded and written to the compact tables behind them.'''
+
+    def __init__(self, db_file=DATABASE_NAME, games_per_flush=GAMES_PER_FLUSH,
+                 only_tables=None, metrics=None, on_game_failed=None):
+        self.db_file = db_file
+        self.games_per_flush = games_per_flush
+        self.only_tables = only_tables
+        self.metrics = metrics
+        self.on_game_failed = on_game_failed
+        self.conn = None
+        # (game_id, {table_name: records}) of the buffered games
+        self.games = []
+        self.table_columns = {}
+        self.play_encoder = PlayEncoder()
+        atexit.register(self.close)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
+    def _connect(self):
+        if self.conn is None:
+            self.conn = connect_db(self.db_file)
+            migrate_database(self.conn)
+        return self.conn
+
+    def add_game(self, game_id, game_tables):
+        '''game_tables is {table_name: DataFrame or list of dicts}'''
+
+        if any(buffered_id == game_id for buffered_id, _ in self.games):
+            self.flush()
+
+        tables = {}
+        for table_name, rows in game_tables.items():
+            if self.only_tables is not None and table_name not in self.only_tables:
+                continue
+            tables[table_name] = _to_records(rows)
+        self.games.append((game_id, tables))
+
+        if len(self.games) >= self.games_per_flush:
+            self.flush()
+
+    def _existing_columns(self, conn, table_name):
+        if table_name not in self.table_columns:
+            columns = [row[1] for row in conn.execute(
+                f'PRAGMA table_info("{table_name}")')]
+            self.table_columns[table_name] = columns
+        return self.table_columns[table_name]
+
+    def _prepare_table(self, conn, table_name, columns):
+        '''Creates the table, or adds columns it does not have yet'''
+
+        existing = self._existing_columns(conn, table_name)
+        if not existing:
+            column_sql = ', '.join(f'"{column}"' for column in columns)
+            conn.execute(f'CREATE TABLE "{table_name}" ({column_sql})')
+            existing.extend(columns)
+            return
+
+        for column in columns:
+            if column not in existing:
+                conn.execute(f'ALTER TABLE "{table_name}" ADD COLUMN "{column}"')
+                existing.append(column)
+
+    def _upsert_entities(self, conn, table_name, records):
+        key = ENTITY_KEYS[table_name]
+        # Keep the row of the newest game per key
+        latest = {}
+        for record in records:
+            kept = latest.get(record[key])
+            if kept is None or (record.get('source_game_id') or 0) >= (
+                    kept.get('source_game_id') or 0):
+                latest[record[key]] = record
+        records = list(latest.values())
+
+        columns = list(dict.fromkeys(
+            column for record in records for column in record))
+        self._prepare_table(conn, table_name, columns)
+
+        column_sql = ', '.join(f'"{column}"' for column in columns)
+        placeholders = ', '.join('?' for _ in columns)
+        rows = [tuple(_sql_value(record.get(column)) for column in columns)
+                for record in records]
+        values = [column for column in columns if column != key]
+        # Missing (null) values never overwrite known ones
+        update_sql = ', '.join(
+            f'"{column}" = COALESCE(excluded."{column}", "{column}")'
+            for column in values)
+        changed_sql = ' OR '.join(
+            f'(excluded."{column}" IS NOT NULL AND excluded."{column}" IS NOT "{column}")'
+            for column in values)
+        if 'source_game_id' in columns:
+            # Rows from an older game than the stored one are ignored
+            changed_sql = (
+                f'excluded.source_game_id >= COALESCE(source_game_id, 0) '
+                f'AND ({changed_sql})')
+        conn.executemany(
+            f'INSERT INTO "{table_name}" ({column_sql}) VALUES ({placeholders}) '
+            f'ON CONFLICT ("{key}") DO UPDATE SET {update_sql} WHERE {changed_sql}',
+            rows)
+        return rows
+
+    def _write_table(self, conn, table_name, records, game_ids):
+        '''Returns the rows written, as tuples'''
+
+        if table_name in ENTITY_KEYS:
+            if records:
+                return self._upsert_entities(conn, table_name, records)
+            return []
+
+        if self._existing_columns(conn, table_name):
+            conn.executemany(
+                f'DELETE FROM "{table_name}" WHERE game_id = ?',
+                [(game_id,) for game_id in game_ids])
+
+        if not records:
+            return []
+
+        columns = list(dict.fromkeys(
+            column for record in records for column in record))
+        self._prepare_table(conn, table_name, columns)
+
+        column_sql = ', '.join(f'"{column}"' for column in columns)
+        placeholders = ', '.join('?' for _ in columns)
+        rows = [tuple(_sql_value(record.get(column)) for column in columns)
+                for record in records]
+        conn.executemany(
+            f'INSERT OR REPLACE INTO "{table_name}" ({column_sql}) VALUES ({placeholders})',
+            rows)
+        return rows
+
+    def _write_games(self, games):
+        '''Writes games in one transaction. Returns the rows written per
+        table.'''
+
+        game_ids = [game_id for game_id, _ in games]
+        tables = {}
+        for _, game_tables in games:
+            for table_name, records in game_tables.items():
+                tables.setdefault(table_name, []).extend(records)
+
+        conn = self._connect()
+        written = {}
+        try:
+            with conn:
+                for table_name, records in tables.items():
+                    encoded = self.play_encoder.encode(conn, table_name, records)
+                    for encoded_name, encoded_records in encoded.items():
+                        written[encoded_name] = self._write_table(
+                            conn, encoded_name, encoded_records, game_ids)
+        except Exception:
+            # Created tables/columns and new play codes were rolled back
+            # with the transaction
+            self.table_columns = {}
+            self.play_encoder.reset()
+            raise
+        return written
+
+    def flush(self):
+        if not self.games:
+            return
+
+        games, self.games = self.games, []
+        started = time.perf_counter()
+        try:
+            written = self._write_games(games)
+        except Exception as e:
+            if self.on_game_failed is None:
+                raise
+            logger.warning(
+                f'Could not write {len(games)} games together ({e}), '
+                f'writing them one at a time')
+            written = {}
+            for game_id, game_tables in games:
+                try:
+                    game_written = self._write_games([(game_id, game_tables)])
+                except Exception as game_error:
+                    self.on_game_failed(game_id, game_error)
+                    continue
+                for table_name, rows in game_written.items():
+                    written.setdefault(table_name, []).extend(rows)
+
+        if self.metrics is not None:
+            self.metrics.record(
+                'flush', seconds=time.perf_counter() - started,
+                rows=len(games))
+            for table_name, rows in written.items():
+                self.metrics.record(
+                    'write', table_name, rows=len(rows),
+                    bytes=sum(map(estimate_bytes, rows)))
+
+        logger.debug(f'Flushed {len(games)} games')
+
+    def close(self):
+        try:
+            self.flush()
+        finally:
+            if self.conn is not None:
+                self.conn.close()
+                self.conn = None
@@ -0,0 +1,257 @@
+import json
+import time
+import logging
+
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from settings import (
+    DATABASE_NAME,
+    SIMILARITY_MIN_GAMES,
+    CLUSTER_COUNT,
+    CLUSTER_BATCH_SIZE,
+    CLUSTER_MAX_ITERATIONS,
+    CLUSTER_WORKERS)
+from misc_functions import connect_db, ensure_schema
+from features.similarity import (
+    similarity_features,
+    load_player_season_features,
+    feature_scaling,
+    standardize)
+
+logger = logging.getLogger()
+
+# Rows per distance computation, each handled by one thread
+ASSIGN_CHUNK_SIZE = 8192
+# Rows k-means++ seeding looks at
+SEEDING_SAMPLE_SIZE = 20000
+# Fitting stops once no centroid moves more than this in a batch
+CONVERGENCE_TOLERANCE = 1e-4
+
+unassigned_query = '''
+    SELECT f.player_id, f.season, f.game_type
+    FROM player_season_features f
+    LEFT JOIN player_season_clusters c
+      ON c.model_id = ? AND c.player_id = f.player_id
+     AND c.season = f.season AND c.game_type = f.game_type
+    WHERE f.is_goalie = 0 AND f.games_played >= ? AND f.toi_seconds > 0
+      AND (c.player_id IS NULL OR f.updated_at > c.assigned_at)'''
+
+
+def assign_clusters(vectors, centroids, workers=CLUSTER_WORKERS):
+    '''Nearest centroid of every row and the squared distance to it. Rows
+    are split into chunks scored on a thread pool; numpy releases the GIL
+    in the matrix products so chunks run on separate cores.'''
+
+    centroid_sq_norms = (centroids ** 2).sum(axis=1)
+
+    def assign_chunk(start):
+        chunk = vectors[start:start + ASSIGN_CHUNK_SIZE]
+        distances = chunk @ centroids.T
+        distances *= -2
+        distances += centroid_sq_norms
+        distances += (chunk ** 2).sum(axis=1)[:, None]
+        labels = distances.argmin(axis=1)
+        return labels, np.maximum(
+            distances[np.arange(len(chunk)), labels], 0)
+
+    starts = range(0, len(vectors), ASSIGN_CHUNK_SIZE)
+    if workers > 1 and len(starts) > 1:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(assign_chunk, starts))
+    else:
+        results = [assign_chunk(start) for start in starts]
+
+    if not results:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=vectors.dtype)
+    labels, distances = zip(*results)
+    return np.concatenate(labels), np.concatenate(distances)
+
+
+def seed_centroids(vectors, k, rng, seeding='k-means++'):
+    '''Initial centroids, either k random rows or k-means++ over a sample:
+    each next centroid is drawn with probability proportional to the
+    squared distance to the closest centroid chosen so far.'''
+
+    if seeding == 'random':
+        return vectors[rng.choice(len(vectors), k, replace=False)].copy()
+    if seeding != 'k-means++':
+        raise ValueError(f'Unknown seeding {seeding}')
+
+    if len(vectors) > SEEDING_SAMPLE_SIZE:
+        vectors = vectors[rng.choice(len(vectors), SEEDING_SAMPLE_SIZE, replace=False)]
+
+    centroids = np.empty((k, vectors.shape[1]), dtype=vectors.dtype)
+    centroids[0] = vectors[rng.integers(len(vectors))]
+    closest = ((vectors - centroids[0]) ** 2).sum(axis=1)
+    for i in range(1, k):
+        total = closest.sum()
+        if total > 0:
+            choice = rng.choice(len(vectors), p=closest / total)
+        else:
+            choice = rng.integers(len(vectors))
+        centroids[i] = vectors[choice]
+        np.minimum(closest, ((vectors - centroids[i]) ** 2).sum(axis=1), out=closest)
+    return centroids
+
+
+def mini_batch_kmeans(vectors, k, batch_size=CLUSTER_BATCH_SIZE,
+                      max_iterations=CLUSTER_MAX_ITERATIONS, seed=0,
+                      seeding='k-means++', workers=CLUSTER_WORKERS):
+    '''Fits k centroids with mini-batch k-means: every iteration assigns a
+    random batch and moves each centroid towards the mean of its batch rows
+    with a learning rate of 1 / rows seen so far by that centroid.
+    Returns the centroids.'''
+
+    rng = np.random.default_rng(seed)
+    centroids = seed_centroids(vectors, k, rng, seeding)
+    counts = np.zeros(k)
+    batch_size = min(batch_size, len(vectors))
+
+    for iteration in range(max_iterations):
+        batch = vectors[rng.choice(len(vectors), batch_size, replace=False)]
+        labels, _ = assign_clusters(batch, centroids, workers)
+
+        batch_counts = np.bincount(labels, minlength=k)
+        sums = np.zeros_like(centroids, dtype=np.float64)
+        np.add.at(sums, labels, batch)
+        counts += batch_counts
+
+        seen = batch_counts > 0
+        step = (sums[seen] - batch_counts[seen, None] * centroids[seen]) / counts[seen, None]
+        centroids[seen] += step.astype(centroids.dtype)
+
+        if np.abs(step).max(initial=0) < CONVERGENCE_TOLERANCE:
+            logger.debug(f'k-means converged after {iteration + 1} batches')
+            break
+
+    return centroids
+
+
+def _weights_vector(weights):
+    '''weights is {feature: weight}, features not given weigh 1'''
+    weights = weights or {}
+    unknown = set(weights) - set(similarity_features)
+    if unknown:
+        raise ValueError(f'Unknown features {sorted(unknown)}')
+    return np.array(
+        [weights.get(col, 1.0) for col in similarity_features], dtype=np.float32)
+
+
+def _save_assignments(conn, model_id, keys, labels, distances, assigned_at):
+    conn.executemany(
+        '''INSERT OR REPLACE INTO player_season_clusters
+           (model_id, player_id, season, game_type, cluster, distance, assigned_at)
+           VALUES (?, ?, ?, ?, ?, ?, ?)''',
+        [(model_id, player_id, str(season), game_type, int(label),
+          float(np.sqrt(distance)), assigned_at)
+         for (player_id, season, game_type), label, distance
+         in zip(keys, labels, distances)])
+
+
+def fit_player_clusters(k=CLUSTER_COUNT, weights=None, seed=0,
+                        seeding='k-means++', name='default',
+                        min_games=SIMILARITY_MIN_GAMES, db_file=DATABASE_NAME):
+    '''Clusters every skater player-season and stores the model, its
+    centroids and all assignments. Features are z-scored, then scaled by
+    the square root of their weight so squared distances weigh each
+    feature by weight. Returns the new model_id.'''
+
+    ensure_schema(db_file)
+    conn = connect_db(db_file)
+    try:
+        keys, features = load_player_season_features(conn, min_games)
+        if len(keys) < k:
+            raise ValueError(f'Cannot fit {k} clusters to {len(keys)} player-seasons')
+
+        weight_vector = _weights_vector(weights)
+        mean, std = feature_scaling(features)
+        vectors = standardize(features, mean, std) * np.sqrt(weight_vector)
+
+        started = time.time()
+        centroids = mini_batch_kmeans(vectors, k, seed=seed, seeding=seeding)
+        labels, distances = assign_clusters(vectors, centroids)
+        inertia = float(distances.sum())
+        logger.info(
+            f'Fitted {k} clusters to {len(keys)} player-seasons '
+            f'in {time.time() - started:.1f}s, inertia {inertia:.0f}')
+
+        now = time.time()
+        sizes = np.bincount(labels, minlength=k)
+        with conn:
+            model_id = conn.execute(
+                '''INSERT INTO cluster_models
+                   (name, k, features, weights, mean, std, min_games, seed,
+                    inertia, created_at)
+                   VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''',
+                (name, k, json.dumps(list(similarity_features)),
+                 json.dumps(weight_vector.tolist()), json.dumps(mean.tolist()),
+                 json.dumps(std.tolist()), min_games, seed, inertia, now)
+            ).lastrowid
+            conn.executemany(
+                '''INSERT INTO cluster_centroids (model_id, cluster, size, centroid)
+                   VALUES (?, ?, ?, ?)''',
+                [(model_id, cluster, int(sizes[cluster]),
+                  json.dumps(centroids[cluster].tolist()))
+                 for cluster in range(k)])
+            _save_assignments(conn, model_id, keys, labels, distances, now)
+    finally:
+        conn.close()
+
+    return model_id
+
+
+def get_latest_model_id(conn, name='default'):
+    row = conn.execute(
+        'SELECT MAX(model_id) FROM cluster_models WHERE name = ?', (name,)).fetchone()
+    return row[0]
+
+
+def assign_new_player_seasons(model_id=None, name='default', db_file=DATABASE_NAME):
+    '''Assigns player-seasons added or updated since model_id (by default
+    the latest model called name) was fitted or last assigned to its
+    existing centroids, without refitting. Returns the number assigned.'''
+
+    ensure_schema(db_file)
+    conn = connect_db(db_file)
+    try:
+        if model_id is None:
+            model_id = get_latest_model_id(conn, name)
+            if model_id is None:
+                raise ValueError(f'No cluster model called {name}')
+
+        features_json, weights, mean, std, min_games = conn.execute(
+            '''SELECT features, weights, mean, std, min_games
+               FROM cluster_models WHERE model_id = ?''', (model_id,)).fetchone()
+        if json.loads(features_json) != list(similarity_features):
+            raise ValueError(f'Cluster model {model_id} used other features, refit it')
+
+        pending = {
+            (player_id, int(season), game_type)
+            for player_id, season, game_type in conn.execute(
+                unassigned_query, (model_id, min_games))}
+        if not pending:
+            return 0
+
+        keys, features = load_player_season_features(conn, min_games)
+        rows = [row for row, key in enumerate(keys) if tuple(key) in pending]
+        keys = [keys[row] for row in rows]
+        vectors = standardize(
+            features[rows], np.array(json.loads(mean)), np.array(json.loads(std))
+        ) * np.sqrt(np.array(json.loads(weights), dtype=np.float32))
+
+        centroid_rows = conn.execute(
+            '''SELECT centroid FROM cluster_centroids
+               WHERE model_id = ? ORDER BY cluster''', (model_id,)).fetchall()
+        centroids = np.array(
+            [json.loads(centroid) for centroid, in centroid_rows], dtype=np.float32)
+
+        labels, distances = assign_clusters(vectors, centroids)
+        with conn:
+            _save_assignments(conn, model_id, keys, labels, distances, time.time())
+    finally:
+        conn.close()
+
+    logger.info(f'Assigned {len(keys)} player-seasons to cluster model {model_id}')
+    return len(keys)
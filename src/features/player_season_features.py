@@ -0,0 +1,180 @@
+import time
+import logging
+
+from settings import DATABASE_NAME
+from misc_functions import connect_db, ensure_schema
+
+logger = logging.getLogger()
+
+# MoneyPuck keys its season summaries by start year and 'regular'/'playoffs'
+MONEYPUCK_GAME_TYPES = {'R': 'regular', 'P': 'playoffs'}
+
+# Player-seasons to recompute: players of dirty games, plus every player of
+# a season whose MoneyPuck summaries changed
+dirty_player_seasons_query = '''
+    CREATE TEMP TABLE dirty_player_seasons AS
+    SELECT d.player_id, g.season, g.type AS game_type
+    FROM player_season_dirty d
+    JOIN games g ON g.game_id = d.game_id
+    UNION
+    SELECT s.player_id, g.season, g.type
+    FROM player_season_dirty_seasons ds
+    JOIN games g ON g.season = ds.season AND g.type = ds.game_type
+    JOIN skater_game_stats s ON s.game_id = g.game_id
+    UNION
+    SELECT s.player_id, g.season, g.type
+    FROM player_season_dirty_seasons ds
+    JOIN games g ON g.season = ds.season AND g.type = ds.game_type
+    JOIN goalie_game_stats s ON s.game_id = g.game_id'''
+
+# Boxscore aggregates per player-season, column -> expression over s
+shared_aggregates = {
+    'games_played': 'COUNT(*)',
+    'toi_seconds': 'SUM(s.timeOnIceSeconds)',
+    'goals': 'SUM(s.goals)',
+    'assists': 'SUM(s.assists)',
+    'points': 'SUM(s.goals) + SUM(s.assists)',
+}
+skater_aggregates = {
+    **shared_aggregates,
+    'even_toi_seconds': 'SUM(s.evenTimeOnIceSeconds)',
+    'pp_toi_seconds': 'SUM(s.powerPlayTimeOnIceSeconds)',
+    'sh_toi_seconds': 'SUM(s.shortHandedTimeOnIceSeconds)',
+    'shots': 'SUM(s.shots)',
+    'hits': 'SUM(s.hits)',
+    'blocked': 'SUM(s.blocked)',
+    'takeaways': 'SUM(s.takeaways)',
+    'giveaways': 'SUM(s.giveaways)',
+    'penalty_minutes': 'SUM(s.penaltyMinutes)',
+    'plus_minus': 'SUM(s.plusMinus)',
+    'pp_goals': 'SUM(s.powerPlayGoals)',
+    'pp_assists': 'SUM(s.powerPlayAssists)',
+    'sh_goals': 'SUM(s.shortHandedGoals)',
+    'sh_assists': 'SUM(s.shortHandedAssists)',
+    'faceoff_wins': 'SUM(s.faceOffWins)',
+    'faceoffs_taken': 'SUM(s.faceoffTaken)',
+}
+goalie_aggregates = {
+    **shared_aggregates,
+    'penalty_minutes': 'SUM(s.pim)',
+    'saves': 'SUM(s.saves)',
+    'shots_against': 'SUM(s.shots)',
+    'goals_against': 'SUM(s.shots) - SUM(s.saves)',
+    'wins': "SUM(s.decision = 'W')",
+    'save_pct': 'CAST(SUM(s.saves) AS REAL) / NULLIF(SUM(s.shots), 0)',
+}
+
+# MoneyPuck columns joined onto each kind of row as mp, if the table is loaded
+skater_advanced_cols = {
+    'xgoals': 'mp.I_F_xGoals',
+    'game_score': 'mp.gameScore',
+    'high_danger_shots': 'mp.I_F_highDangerShots',
+    'on_ice_xgoals_pct': 'mp.onIce_xGoalsPercentage',
+    'on_ice_corsi_pct': 'mp.onIce_corsiPercentage',
+    'on_ice_fenwick_pct': 'mp.onIce_fenwickPercentage',
+}
+goalie_advanced_cols = {
+    'xgoals': 'mp.xGoals',
+    'high_danger_shots': 'mp.highDangerShots',
+    'goals_saved_above_expected': 'mp.xGoals - mp.goals',
+}
+
+
+def _advanced_join(conn, table_name, advanced_cols):
+    '''Returns the select list and join clause adding MoneyPuck columns, or
+    nulls when table_name has not been loaded'''
+
+    exists = conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?",
+        (table_name,)).fetchone()
+    if not exists:
+        return ', '.join(f'NULL AS {col}' for col in advanced_cols), ''
+
+    conn.execute(
+        f'CREATE INDEX IF NOT EXISTS idx_{table_name}_player '
+        f'ON {table_name} (playerId, year, game_type, situation)')
+    select_sql = ', '.join(
+        f'{expression} AS {col}' for col, expression in advanced_cols.items())
+    game_type_sql = ' '.join(
+        f"WHEN '{nhl_type}' THEN '{mp_type}'"
+        for nhl_type, mp_type in MONEYPUCK_GAME_TYPES.items())
+    join_sql = f'''
+        LEFT JOIN {table_name} mp
+          ON mp.playerId = a.player_id
+         AND mp.year = CAST(substr(a.season, 1, 4) AS INTEGER)
+         AND mp.game_type = CASE a.game_type {game_type_sql} END
+         AND mp.situation = 'all' '''
+    return select_sql, join_sql
+
+
+def _insert_features(conn, stats_table, is_goalie, aggregates,
+                     advanced_table, advanced_cols, updated_at):
+    '''Inserts the rows of the dirty player-seasons found in stats_table'''
+
+    aggregate_sql = ', '.join(
+        f'{expression} AS {col}' for col, expression in aggregates.items())
+    advanced_sql, join_sql = _advanced_join(conn, advanced_table, advanced_cols)
+    columns = ['player_id', 'season', 'game_type', 'is_goalie'] + \
+        list(aggregates) + list(advanced_cols) + ['updated_at']
+    select_sql = ', '.join(f'a.{col}' for col in ['player_id', 'season', 'game_type'])
+    select_sql += f', {is_goalie}, ' + ', '.join(f'a.{col}' for col in aggregates)
+
+    conn.execute(
+        f'''INSERT INTO player_season_features ({', '.join(columns)})
+            SELECT {select_sql}, {advanced_sql}, ?
+            FROM (
+                SELECT s.player_id, g.season, g.type AS game_type, {aggregate_sql}
+                FROM dirty_player_seasons d
+                JOIN {stats_table} s ON s.player_id = d.player_id
+                JOIN games g ON g.game_id = s.game_id
+                 AND g.season = d.season AND g.type = d.game_type
+                GROUP BY s.player_id, g.season, g.type) a
+            {join_sql}''',
+        (updated_at,))
+
+
+def refresh_player_season_features(db_file=DATABASE_NAME):
+    '''Recomputes the player_season_features rows of every player-season
+    marked dirty since the last refresh, in one transaction. Boxscore writes
+    mark games dirty through triggers; changed MoneyPuck slices mark whole
+    seasons. Returns the number of player-seasons refreshed.'''
+
+    ensure_schema(db_file)
+
+    conn = connect_db(db_file)
+    try:
+        with conn:
+            conn.execute('DROP TABLE IF EXISTS temp.dirty_player_seasons')
+            conn.execute(dirty_player_seasons_query)
+            refreshed = conn.execute(
+                'SELECT COUNT(*) FROM dirty_player_seasons').fetchone()[0]
+
+            conn.execute('''
+                DELETE FROM player_season_features
+                WHERE (player_id, season, game_type) IN (
+                    SELECT player_id, season, game_type FROM dirty_player_seasons)''')
+
+            updated_at = time.time()
+            _insert_features(
+                conn, 'skater_game_stats', 0, skater_aggregates,
+                'skaters_advanced', skater_advanced_cols, updated_at)
+            # A player dressing as both only ever keeps their goalie row
+            conn.execute('''
+                DELETE FROM player_season_features
+                WHERE is_goalie = 0 AND (player_id, season, game_type) IN (
+                    SELECT s.player_id, g.season, g.type
+                    FROM dirty_player_seasons d
+                    JOIN goalie_game_stats s ON s.player_id = d.player_id
+                    JOIN games g ON g.game_id = s.game_id)''')
+            _insert_features(
+                conn, 'goalie_game_stats', 1, goalie_aggregates,
+                'goalies_advanced', goalie_advanced_cols, updated_at)
+
+            conn.execute('DELETE FROM player_season_dirty')
+            conn.execute('DELETE FROM player_season_dirty_seasons')
+            conn.execute('DROP TABLE temp.dirty_player_seasons')
+    finally:
+        conn.close()
+
+    logger.info(f'Refreshed features for {refreshed} player-seasons')
+    return refreshed
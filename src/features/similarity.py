@@ -0,0 +1,305 @@
+import os
+import json
+import logging
+import warnings
+
+import numpy as np
+
+from settings import DATABASE_NAME, SIMILARITY_INDEX_PATH, SIMILARITY_MIN_GAMES
+from misc_functions import connect_db, ensure_schema
+
+logger = logging.getLogger()
+
+# Skater features compared, column -> expression over player_season_features.
+# Counting stats are rates so players with different ice time compare.
+similarity_features = {
+    'toi_per_game': 'toi_seconds * 1.0 / games_played',
+    'pp_toi_share': 'pp_toi_seconds * 1.0 / toi_seconds',
+    'sh_toi_share': 'sh_toi_seconds * 1.0 / toi_seconds',
+    'goals_per_60': 'goals * 3600.0 / toi_seconds',
+    'assists_per_60': 'assists * 3600.0 / toi_seconds',
+    'shots_per_60': 'shots * 3600.0 / toi_seconds',
+    'hits_per_60': 'hits * 3600.0 / toi_seconds',
+    'blocked_per_60': 'blocked * 3600.0 / toi_seconds',
+    'takeaways_per_60': 'takeaways * 3600.0 / toi_seconds',
+    'giveaways_per_60': 'giveaways * 3600.0 / toi_seconds',
+    'penalty_minutes_per_60': 'penalty_minutes * 3600.0 / toi_seconds',
+    'faceoffs_per_60': 'faceoffs_taken * 3600.0 / toi_seconds',
+    'faceoff_win_pct': 'faceoff_wins * 1.0 / NULLIF(faceoffs_taken, 0)',
+    'xgoals_per_60': 'xgoals * 3600.0 / toi_seconds',
+    'high_danger_shots_per_60': 'high_danger_shots * 3600.0 / toi_seconds',
+    'game_score_per_game': 'game_score / games_played',
+    'on_ice_xgoals_pct': 'on_ice_xgoals_pct',
+    'on_ice_corsi_pct': 'on_ice_corsi_pct',
+}
+
+feature_query = f'''
+    SELECT player_id, CAST(season AS INTEGER), game_type,
+        {', '.join(similarity_features.values())}
+    FROM player_season_features
+    WHERE is_goalie = 0 AND games_played >= ? AND toi_seconds > 0
+    ORDER BY season, player_id, game_type'''
+fingerprint_query = '''
+    SELECT COUNT(*), MAX(updated_at)
+    FROM player_season_features
+    WHERE is_goalie = 0 AND games_played >= ? AND toi_seconds > 0'''
+
+ARRAY_NAMES = ['vectors', 'units', 'sq_norms', 'projected', 'player_ids', 'seasons', 'game_types']
+# Bumped when the saved arrays change, so older indexes are rebuilt. 2:
+# game types no longer truncated to one character ('PR' read as 'P').
+INDEX_VERSION = 2
+# Dimensions of the random projection scanned in approximate mode, and how
+# many candidates per requested neighbour it keeps for exact re-ranking
+PROJECTED_DIMS = 8
+CANDIDATES_PER_RESULT = 10
+# Query rows scored per matrix product, bounds the score matrix in memory
+QUERY_CHUNK_SIZE = 256
+
+
+def get_features_fingerprint(conn, min_games=SIMILARITY_MIN_GAMES):
+    '''Changes whenever the indexed player-season features change'''
+    count, updated_at = conn.execute(fingerprint_query, (min_games,)).fetchone()
+    return [count, updated_at]
+
+
+def load_player_season_features(conn, min_games=SIMILARITY_MIN_GAMES):
+    '''Returns the (player_id, season, game_type) rows of every skater
+    player-season with at least min_games, and their similarity_features
+    as a float matrix with NaN for missing values'''
+
+    rows = conn.execute(feature_query, (min_games,)).fetchall()
+    features = np.array(
+        [row[3:] for row in rows], dtype=np.float64
+    ).reshape(len(rows), len(similarity_features))
+    return [row[:3] for row in rows], features
+
+
+def feature_scaling(features):
+    '''Column means and standard deviations, ignoring missing values'''
+
+    n_cols = features.shape[1]
+    with warnings.catch_warnings():
+        # Columns with no values at all, e.g. no MoneyPuck data loaded
+        warnings.simplefilter('ignore', RuntimeWarning)
+        mean = np.nanmean(features, axis=0) if len(features) else np.zeros(n_cols)
+        std = np.nanstd(features, axis=0) if len(features) else np.ones(n_cols)
+    mean = np.nan_to_num(mean)
+    std = np.where(np.isfinite(std) & (std > 0), std, 1.0)
+    return mean, std
+
+
+def standardize(features, mean, std):
+    '''z-scores features, missing values become 0 (the mean)'''
+    return np.nan_to_num((features - mean) / std).astype(np.float32)
+
+
+def build_similarity_index(db_file=DATABASE_NAME, path=SIMILARITY_INDEX_PATH,
+                           min_games=SIMILARITY_MIN_GAMES):
+    '''Builds the index from player_season_features and saves it in path.
+
+    Features are z-scored over all indexed player-seasons; missing values
+    (e.g. seasons without MoneyPuck data) become the mean. The metadata
+    file is written last, so an interrupted build is never loaded.'''
+
+    ensure_schema(db_file)
+    conn = connect_db(db_file)
+    try:
+        fingerprint = get_features_fingerprint(conn, min_games)
+        rows, features = load_player_season_features(conn, min_games)
+    finally:
+        conn.close()
+
+    mean, std = feature_scaling(features)
+    vectors = standardize(features, mean, std)
+    n_cols = len(similarity_features)
+    norms = np.linalg.norm(vectors, axis=1)
+    projection = np.random.default_rng(0).standard_normal(
+        (n_cols, PROJECTED_DIMS)).astype(np.float32)
+    arrays = {
+        'vectors': vectors,
+        'units': vectors / np.maximum(norms, 1e-6)[:, None],
+        'sq_norms': norms ** 2,
+        'projected': vectors @ projection,
+        'player_ids': np.array([row[0] for row in rows], dtype=np.int64),
+        'seasons': np.array([row[1] for row in rows], dtype=np.int64),
+        'game_types': np.array([row[2] for row in rows], dtype=str),
+    }
+
+    os.makedirs(path, exist_ok=True)
+    meta_file = os.path.join(path, 'meta.json')
+    if os.path.exists(meta_file):
+        os.remove(meta_file)
+    for name, array in arrays.items():
+        np.save(os.path.join(path, f'{name}.npy'), array)
+    with open(meta_file, 'w') as f:
+        json.dump({
+            'version': INDEX_VERSION,
+            'fingerprint': fingerprint,
+            'min_games': min_games,
+            'columns': list(similarity_features),
+            'mean': mean.tolist(),
+            'std': std.tolist(),
+            'projection': projection.tolist(),
+        }, f)
+
+    logger.info(f'Built similarity index of {len(rows)} player-seasons')
+    return SimilarityIndex(path)
+
+
+def get_similarity_index(db_file=DATABASE_NAME, path=SIMILARITY_INDEX_PATH,
+                         min_games=SIMILARITY_MIN_GAMES):
+    '''Loads the index from path, rebuilding it first if player features
+    changed since it was built'''
+
+    meta_file = os.path.join(path, 'meta.json')
+    if os.path.exists(meta_file):
+        with open(meta_file) as f:
+            meta = json.load(f)
+
+        ensure_schema(db_file)
+        conn = connect_db(db_file)
+        try:
+            fingerprint = get_features_fingerprint(conn, min_games)
+        finally:
+            conn.close()
+
+        if (meta.get('version') == INDEX_VERSION
+                and meta['fingerprint'] == fingerprint and meta['min_games'] == min_games
+                and meta['columns'] == list(similarity_features)):
+            return SimilarityIndex(path)
+
+    return build_similarity_index(db_file, path, min_games)
+
+
+def _top_k(scores, k, largest):
+    '''Columns of the k largest (or smallest) scores of every row, best
+    first, and those scores'''
+
+    if largest:
+        top = np.argpartition(scores, scores.shape[1] - k, axis=1)[:, -k:]
+    else:
+        top = np.argpartition(scores, k - 1, axis=1)[:, :k]
+    top_scores = np.take_along_axis(scores, top, axis=1)
+    order = np.argsort(top_scores, axis=1)
+    if largest:
+        order = order[:, ::-1]
+    return (np.take_along_axis(top, order, axis=1),
+            np.take_along_axis(top_scores, order, axis=1))
+
+
+class SimilarityIndex:
+    '''Nearest neighbour queries over the player-season vectors saved by
+    build_similarity_index. The arrays are memory-mapped, so loading is
+    instant and the pages are shared between processes.
+
+    metric is 'cosine' (score is the cosine similarity, higher is more
+    similar) or 'euclidean' (score is the distance, lower is more similar).'''
+
+    def __init__(self, path=SIMILARITY_INDEX_PATH):
+        with open(os.path.join(path, 'meta.json')) as f:
+            self.meta = json.load(f)
+        for name in ARRAY_NAMES:
+            # Plain ndarray views of the maps, numpy ops on memmap are slower
+            setattr(self, name, np.asarray(np.load(
+                os.path.join(path, f'{name}.npy'), mmap_mode='r')))
+        self.columns = self.meta['columns']
+        self.row_ids = None
+
+    def __len__(self):
+        return len(self.player_ids)
+
+    def find(self, player_id, season, game_type='R'):
+        '''Returns the row of a player-season, or None if it is not indexed'''
+
+        if self.row_ids is None:
+            self.row_ids = {
+                key: row for row, key in enumerate(zip(
+                    self.player_ids.tolist(), self.seasons.tolist(),
+                    self.game_types.tolist()))}
+        return self.row_ids.get((player_id, int(season), game_type))
+
+    def _scores(self, query_rows, candidates, metric):
+        '''Scores query rows against candidate rows (None for all) as a
+        (queries x candidates) matrix, computed in place to avoid
+        allocating temporaries the size of the matrix. Euclidean scores are
+        squared distances.'''
+
+        if metric == 'cosine':
+            units = self.units if candidates is None else self.units[candidates]
+            return self.units[query_rows] @ units.T
+        if metric == 'euclidean':
+            vectors = self.vectors if candidates is None else self.vectors[candidates]
+            sq_norms = self.sq_norms if candidates is None else self.sq_norms[candidates]
+            scores = self.vectors[query_rows] @ vectors.T
+            scores *= -2
+            scores += sq_norms
+            scores += self.sq_norms[query_rows][:, None]
+            return scores
+        raise ValueError(f'Unknown metric {metric}')
+
+    def _candidates(self, query_row, k):
+        '''Rows closest to query_row in the projected space, or None when
+        that would be every row'''
+
+        n_candidates = k * CANDIDATES_PER_RESULT + 1
+        if n_candidates >= len(self):
+            return None
+        distances = self.projected - self.projected[query_row]
+        distances = np.einsum('ij,ij->i', distances, distances)
+        return np.argpartition(distances, n_candidates - 1)[:n_candidates]
+
+    def query_rows(self, rows, k=10, metric='cosine', approximate=False):
+        '''Top k neighbours of every row in rows, excluding the row itself.
+        Returns (neighbour rows, scores), each of shape (len(rows), k).
+
+        Exact queries are scored in chunks with one matrix product each.
+        Approximate queries only re-rank the rows nearest in a random
+        projection, which is much cheaper for large indexes.'''
+
+        rows = np.asarray(rows, dtype=np.int64)
+        k = max(0, min(k, len(self) - 1))
+        largest = metric == 'cosine'
+        excluded = -np.inf if largest else np.inf
+        neighbours = np.empty((len(rows), k), dtype=np.int64)
+        scores = np.empty((len(rows), k), dtype=np.float32)
+        if k == 0:
+            return neighbours, scores
+
+        if approximate:
+            for i, row in enumerate(rows):
+                candidates = self._candidates(row, k)
+                if candidates is None:
+                    candidates = np.arange(len(self))
+                row_scores = self._scores([row], candidates, metric)
+                row_scores[0, candidates == row] = excluded
+                top, top_scores = _top_k(row_scores, k, largest)
+                neighbours[i] = candidates[top[0]]
+                scores[i] = top_scores[0]
+        else:
+            for start in range(0, len(rows), QUERY_CHUNK_SIZE):
+                chunk = rows[start:start + QUERY_CHUNK_SIZE]
+                chunk_scores = self._scores(chunk, None, metric)
+                chunk_scores[np.arange(len(chunk)), chunk] = excluded
+                top, top_scores = _top_k(chunk_scores, k, largest)
+                neighbours[start:start + len(chunk)] = top
+                scores[start:start + len(chunk)] = top_scores
+
+        if metric == 'euclidean':
+            scores = np.sqrt(np.maximum(scores, 0))
+        return neighbours, scores
+
+    def most_similar(self, player_id, season, game_type='R', k=10,
+                     metric='cosine', approximate=False):
+        '''Top k player-seasons most similar to one player-season, as a list
+        of (player_id, season, game_type, score), most similar first'''
+
+        row = self.find(player_id, season, game_type)
+        if row is None:
+            raise KeyError(f'{player_id} {season} {game_type} is not indexed')
+
+        neighbours, scores = self.query_rows(
+            [row], k=k, metric=metric, approximate=approximate)
+        return [
+            (int(self.player_ids[n]), str(self.seasons[n]),
+             str(self.game_types[n]), float(score))
+            for n, score in zip(neighbours[0], scores[0])]
@@ -1,8 +1,5 @@
-from moneypuck.get_moneypuck_data import get_moneypuck_data
-from nhl_api.get_game_data import get_game_data
-from nhl_api.get_player_info import get_player_data
+from cli import main
 
 
-get_moneypuck_data()
-get_game_data()
-get_player_data()
+if __name__ == '__main__':
+    main(['update'])
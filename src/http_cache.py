@@ -0,0 +1,136 @@
+import re
+import time
+import zlib
+import sqlite3
+import logging
+import threading
+
+logger = logging.getLogger()
+
+# Seconds a response stays fresh, first matching pattern wins.
+# None means the response never expires.
+HOUR = 60 * 60
+DAY = 24 * HOUR
+TTL_RULES = [
+    (re.compile(r'/feed/live'), 5 * 60),  # unfinished games, see ttl_for
+    (re.compile(r'shiftcharts'), HOUR),  # empty charts, see ttl_for
+    (re.compile(r'/schedule'), 6 * HOUR),
+    (re.compile(r'/people/'), 7 * DAY),
+    (re.compile(r'/teams/'), 7 * DAY),
+    (re.compile(r'/seasons'), DAY),
+]
+DEFAULT_TTL = DAY
+
+# Checked on the raw body so caching never needs to decode the json
+FINAL_GAME = re.compile(rb'"abstractGameState"\s*:\s*"Final"')
+EMPTY_SHIFTCHART = re.compile(rb'"data"\s*:\s*\[\s*\]')
+
+
+def ttl_for(link, body):
+    '''Returns how long (seconds) a response body may be served from the
+    cache. Finished games never change so they never expire.'''
+
+    if '/feed/live' in link:
+        if FINAL_GAME.search(body):
+            return None
+    elif 'shiftcharts' in link:
+        if not EMPTY_SHIFTCHART.search(body):
+            return None
+
+    for pattern, ttl in TTL_RULES:
+        if pattern.search(link):
+            return ttl
+    return DEFAULT_TTL
+
+
+class ResponseCache:
+    '''Compressed on-disk cache of url -> response body, with LRU eviction
+    once the stored payloads exceed max_bytes'''
+
+    def __init__(self, path, max_bytes):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.conn = None
+        self.total_bytes = 0
+        self.lock = threading.Lock()
+
+    def _connect(self):
+        if self.conn is None:
+            self.conn = sqlite3.connect(self.path, check_same_thread=False)
+            self.conn.execute('PRAGMA journal_mode=WAL')
+            self.conn.execute('PRAGMA synchronous=NORMAL')
+            self.conn.execute(
+                '''CREATE TABLE IF NOT EXISTS responses (
+                    url TEXT PRIMARY KEY,
+                    payload BLOB NOT NULL,
+                    size INTEGER NOT NULL,
+                    fetched_at REAL NOT NULL,
+                    expires_at REAL,
+                    last_accessed REAL NOT NULL)''')
+            self.conn.execute(
+                '''CREATE INDEX IF NOT EXISTS idx_responses_last_accessed
+                   ON responses (last_accessed)''')
+            self.total_bytes = self.conn.execute(
+                'SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()[0]
+        return self.conn
+
+    def get(self, link, allow_stale=False):
+        '''Returns the cached body for link, or None if missing or expired'''
+
+        with self.lock:
+            conn = self._connect()
+            row = conn.execute(
+                'SELECT payload, expires_at FROM responses WHERE url = ?',
+                (link,)).fetchone()
+            if row is None:
+                return None
+
+            payload, expires_at = row
+            now = time.time()
+            if not allow_stale and expires_at is not None and expires_at < now:
+                return None
+
+            with conn:
+                conn.execute(
+                    'UPDATE responses SET last_accessed = ? WHERE url = ?',
+                    (now, link))
+
+        return zlib.decompress(payload)
+
+    def put(self, link, body, ttl):
+        payload = zlib.compress(body)
+        now = time.time()
+        expires_at = None if ttl is None else now + ttl
+
+        with self.lock:
+            conn = self._connect()
+            with conn:
+                old = conn.execute(
+                    'SELECT size FROM responses WHERE url = ?', (link,)).fetchone()
+                conn.execute(
+                    '''INSERT OR REPLACE INTO responses
+                       (url, payload, size, fetched_at, expires_at, last_accessed)
+                       VALUES (?, ?, ?, ?, ?, ?)''',
+                    (link, payload, len(payload), now, expires_at, now))
+            self.total_bytes += len(payload) - (old[0] if old else 0)
+
+            if self.total_bytes > self.max_bytes:
+                self._evict(conn)
+
+    def _evict(self, conn):
+        '''Drops least recently used responses until 90% of the size cap'''
+
+        target = self.max_bytes * 0.9
+        freed = 0
+        evicted = []
+        for url, size in conn.execute(
+                'SELECT url, size FROM responses ORDER BY last_accessed'):
+            if self.total_bytes - freed <= target:
+                break
+            evicted.append((url,))
+            freed += size
+
+        with conn:
+            conn.executemany('DELETE FROM responses WHERE url = ?', evicted)
+        self.total_bytes -= freed
+        logger.info(f'Evicted {len(evicted)} responses ({freed} bytes) from cache')
@@ -0,0 +1,107 @@
+import os
+import time
+import logging
+import threading
+
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from settings import (
+    REQUESTS_PER_SECOND_PER_HOST,
+    HTTP_USER_AGENT,
+    HTTP_CONNECT_TIMEOUT,
+    HTTP_TIMEOUT,
+    HTTP_POOL_HOSTS,
+    HTTP_POOL_SIZE)
+
+logger = logging.getLogger()
+
+# urllib3 only decodes brotli when a brotli package is installed, so only
+# ask for it then
+try:
+    import brotli  # noqa: F401
+    ACCEPT_ENCODING = 'gzip, deflate, br'
+except ImportError:
+    try:
+        import brotlicffi  # noqa: F401
+        ACCEPT_ENCODING = 'gzip, deflate, br'
+    except ImportError:
+        ACCEPT_ENCODING = 'gzip, deflate'
+
+# Sent with every request. The shiftcharts api turns away the default
+# python user agent.
+DEFAULT_HEADERS = {
+    'User-Agent': HTTP_USER_AGENT,
+    'Accept-Encoding': ACCEPT_ENCODING,
+    'Connection': 'keep-alive',
+}
+
+
+class HostRateLimiter:
+    '''Thread-safe limiter spacing out requests made to the same host'''
+
+    def __init__(self, requests_per_second):
+        self.min_interval = 1.0 / requests_per_second if requests_per_second else 0
+        self.next_slot = {}
+        self.lock = threading.Lock()
+
+    def wait(self, link):
+        if not self.min_interval:
+            return
+        host = urlsplit(link).netloc
+        with self.lock:
+            now = time.monotonic()
+            slot = max(now, self.next_slot.get(host, now))
+            self.next_slot[host] = slot + self.min_interval
+        if slot > now:
+            time.sleep(slot - now)
+
+
+rate_limiter = HostRateLimiter(REQUESTS_PER_SECOND_PER_HOST)
+
+_session = None
+_session_pid = None
+_session_lock = threading.Lock()
+
+
+def new_session():
+    '''A session keeping up to HTTP_POOL_SIZE connections alive to each of
+    HTTP_POOL_HOSTS hosts. Retries are left to retry_with_backoff.'''
+    session = requests.Session()
+    session.headers.update(DEFAULT_HEADERS)
+    adapter = HTTPAdapter(
+        pool_connections=HTTP_POOL_HOSTS, pool_maxsize=HTTP_POOL_SIZE,
+        max_retries=0)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+def get_session():
+    '''The process wide session. A forked process (the parse workers) gets
+    its own rather than sharing the parent's sockets.'''
+    global _session, _session_pid
+    with _session_lock:
+        if _session is None or _session_pid != os.getpid():
+            _session = new_session()
+            _session_pid = os.getpid()
+        return _session
+
+
+def request(method, link, headers=None, **kwargs):
+    '''Sends a request through the shared session, rate limited per host,
+    with the default timeouts unless given'''
+    kwargs.setdefault('timeout', (HTTP_CONNECT_TIMEOUT, HTTP_TIMEOUT))
+    rate_limiter.wait(link)
+    return get_session().request(method, link, headers=headers, **kwargs)
+
+
+def get(link, headers=None, **kwargs):
+    return request('GET', link, headers=headers, **kwargs)
+
+
+def head(link, headers=None, **kwargs):
+    return request('HEAD', link, headers=headers, **kwargs)
+
@@ -0,0 +1,244 @@
+import os
+import io
+import json
+import time
+import pstats
+import logging
+import cProfile
+import threading
+import tracemalloc
+
+from contextlib import contextmanager
+
+from settings import DATABASE_NAME, METRICS_PATH, METRICS_PROFILE
+from misc_functions import connect_db
+from schema import migrate_database
+
+logger = logging.getLogger()
+
+# Stages a sample can belong to, label narrows it down
+# fetch: label is the endpoint, bytes the response size
+# parse: label is json_decode or an extractor name
+# write: label is the table, rows/bytes what was written to it
+# flush: one database transaction, rows is the number of games in it
+PROMETHEUS_PREFIX = 'nhl_ingest'
+PROFILE_TOP_N = 25
+
+
+@contextmanager
+def stage_timer(timings, name):
+    '''Adds the seconds spent in the block to timings[name]. Used inside
+    the parse workers, whose timings travel back with the parsed rows.'''
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings[name] = timings.get(name, 0.0) + time.perf_counter() - started
+
+
+def estimate_bytes(values):
+    '''Approximate storage size of a row's values'''
+    size = 0
+    for value in values:
+        if value is None:
+            continue
+        if isinstance(value, (str, bytes)):
+            size += len(value)
+        else:
+            size += 8
+    return size
+
+
+class IngestMetrics:
+    '''Collects per game, per stage samples of one ingest run.
+
+    On finish the samples are stored in the ingest_metrics table, appended
+    to METRICS_PATH/ingest_metrics.jsonl with a run summary, and
+    aggregated into METRICS_PATH/<run_name>.prom for the node_exporter
+    textfile collector. With profile='cprofile' or 'tracemalloc' the run
+    is profiled too; only this process is, not the parse workers.
+
+    Use as a context manager around the run.'''
+
+    def __init__(self, run_name, db_file=DATABASE_NAME, path=METRICS_PATH,
+                 profile=METRICS_PROFILE):
+        self.run_name = run_name
+        self.run_id = f"{run_name}-{time.strftime('%Y%m%dT%H%M%S')}"
+        self.db_file = db_file
+        self.path = path
+        self.profile = profile
+        self.samples = []
+        self.games = 0
+        self.lock = threading.Lock()
+        self.profiler = None
+        self.started = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.finish(failed=exc_type is not None)
+        return False
+
+    def record(self, stage, label=None, seconds=None, rows=None, bytes=None,
+               game_id=None):
+        with self.lock:
+            self.samples.append(
+                (self.run_id, game_id, stage, label, seconds, rows, bytes, time.time()))
+
+    @contextmanager
+    def timer(self, stage, label=None, game_id=None, rows=None, bytes=None):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(stage, label, time.perf_counter() - started,
+                        rows, bytes, game_id)
+
+    def record_timings(self, game_id, stage, timings):
+        '''Records a {label: seconds} dict built with stage_timer'''
+        for label, seconds in timings.items():
+            self.record(stage, label, seconds, game_id=game_id)
+
+    def game_done(self):
+        self.games += 1
+
+    def start(self):
+        self.started = time.time()
+        if self.profile == 'cprofile':
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+        elif self.profile == 'tracemalloc':
+            tracemalloc.start()
+        elif self.profile:
+            logger.warning(f'Unknown profile {self.profile}, not profiling')
+
+    def _stop_profile(self):
+        if self.profile == 'cprofile' and self.profiler is not None:
+            self.profiler.disable()
+            prof_file = os.path.join(self.path, f'{self.run_id}.prof')
+            self.profiler.dump_stats(prof_file)
+            summary = io.StringIO()
+            pstats.Stats(self.profiler, stream=summary).sort_stats(
+                'cumulative').print_stats(PROFILE_TOP_N)
+            logger.info(f'Profile saved to {prof_file}\n{summary.getvalue()}')
+            self.profiler = None
+
+        elif self.profile == 'tracemalloc' and tracemalloc.is_tracing():
+            snapshot = tracemalloc.take_snapshot()
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            self.record('memory', 'tracemalloc_peak', bytes=peak)
+
+            top_file = os.path.join(self.path, f'{self.run_id}.tracemalloc.txt')
+            with open(top_file, 'w') as f:
+                for stat in snapshot.statistics('lineno')[:PROFILE_TOP_N]:
+                    f.write(f'{stat}\n')
+            logger.info(
+                f'Peak traced memory {peak / 1024 ** 2:.1f}MB, '
+                f'top allocations in {top_file}')
+
+    def summary(self):
+        '''Totals per (stage, label): [calls, seconds, rows, bytes]'''
+        totals = {}
+        for _, _, stage, label, seconds, rows, size, _ in self.samples:
+            total = totals.setdefault((stage, label), [0, 0.0, 0, 0])
+            total[0] += 1
+            total[1] += seconds or 0.0
+            total[2] += rows or 0
+            total[3] += size or 0
+        return totals
+
+    def _write_table(self):
+        conn = connect_db(self.db_file)
+        try:
+            migrate_database(conn)
+            with conn:
+                conn.executemany(
+                    '''INSERT INTO ingest_metrics
+                       (run_id, game_id, stage, label, seconds, rows, bytes, recorded_at)
+                       VALUES (?, ?, ?, ?, ?, ?, ?, ?)''',
+                    self.samples)
+        finally:
+            conn.close()
+
+    def _write_json_log(self, run_record):
+        keys = ['run_id', 'game_id', 'stage', 'label', 'seconds', 'rows',
+                'bytes', 'recorded_at']
+        with open(os.path.join(self.path, 'ingest_metrics.jsonl'), 'a') as f:
+            for sample in self.samples:
+                f.write(json.dumps(
+                    {key: value for key, value in zip(keys, sample)
+                     if value is not None}) + '\n')
+            f.write(json.dumps(run_record) + '\n')
+
+    def _write_prometheus(self, totals, run_record):
+        '''Writes the textfile atomically so a scrape never sees half of it'''
+
+        run = f'run="{self.run_name}"'
+        lines = []
+        for metric, index, help_text in [
+                ('stage_seconds', 1, 'Seconds spent per stage in the last run'),
+                ('stage_calls', 0, 'Samples recorded per stage in the last run'),
+                ('stage_rows', 2, 'Rows handled per stage in the last run'),
+                ('stage_bytes', 3, 'Bytes handled per stage in the last run')]:
+            name = f'{PROMETHEUS_PREFIX}_{metric}'
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} gauge')
+            for (stage, label), total in sorted(
+                    totals.items(), key=lambda item: (item[0][0], item[0][1] or '')):
+                if index >= 1 and not total[index]:
+                    continue
+                lines.append(
+                    f'{name}{{{run},stage="{stage}",label="{label or ""}"}} {total[index]}')
+
+        for metric, value, help_text in [
+                ('run_seconds', run_record['seconds'], 'Duration of the last run'),
+                ('run_games', run_record['games'], 'Games handled by the last run'),
+                ('run_failed', int(run_record['failed']), 'Whether the last run raised'),
+                ('run_timestamp_seconds', run_record['finished_at'],
+                 'When the last run finished')]:
+            name = f'{PROMETHEUS_PREFIX}_{metric}'
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} gauge')
+            lines.append(f'{name}{{{run}}} {value}')
+
+        prom_file = os.path.join(self.path, f'{self.run_name}.prom')
+        with open(prom_file + '.tmp', 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        os.replace(prom_file + '.tmp', prom_file)
+
+    def finish(self, failed=False):
+        os.makedirs(self.path, exist_ok=True)
+        self._stop_profile()
+
+        finished_at = time.time()
+        totals = self.summary()
+        run_record = {
+            'run_id': self.run_id,
+            'run': self.run_name,
+            'games': self.games,
+            'seconds': round(finished_at - self.started, 3),
+            'failed': failed,
+            'finished_at': finished_at,
+            'stages': {
+                f'{stage}:{label}' if label else stage: {
+                    'calls': calls, 'seconds': round(seconds, 4),
+                    'rows': rows, 'bytes': size}
+                for (stage, label), (calls, seconds, rows, size) in totals.items()},
+        }
+
+        try:
+            self._write_table()
+        except Exception as e:
+            logger.error(f'Could not store ingest metrics: {e}')
+        self._write_json_log(run_record)
+        self._write_prometheus(totals, run_record)
+
+        slowest = sorted(totals.items(), key=lambda item: -item[1][1])[:5]
+        logger.info(
+            f'{self.run_id}: {self.games} games in {run_record["seconds"]:.1f}s; '
+            + ', '.join(
+                f'{stage}:{label} {total[1]:.1f}s' if label else f'{stage} {total[1]:.1f}s'
+                for (stage, label), total in slowest))
@@ -2,22 +2,122 @@ import pandas as pd
 import sqlalchemy as sa
 
 import requests
-import zipfile
 
-import urllib
+import io
+import os
+
+import random
 import json
+import sqlite3
 import logging
+import threading
+import time
 
-from settings import DATABASE_NAME
-
-engine = sa.create_engine(f'sqlite:///{DATABASE_NAME}')
+from settings import (
+    DATABASE_NAME,
+    SQLITE_PRAGMAS,
+    HTTP_CACHE_PATH,
+    HTTP_CACHE_MAX_BYTES,
+    HTTP_CACHE_OFFLINE,
+    DOWNLOAD_CHUNK_SIZE,
+    FETCH_RETRIES,
+    FETCH_BACKOFF_SECONDS,
+    FETCH_BACKOFF_MAX_SECONDS)
+import http_client
+from http_cache import ResponseCache, ttl_for
+from compact_plays import register_play_functions
+from schema import migrate_database
 
-logging.basicConfig(level='INFO')
 logger = logging.getLogger()
 
 
+def set_sqlite_pragmas(conn, *args):
+    for pragma in SQLITE_PRAGMAS:
+        conn.execute(pragma)
+
+
+def prepare_connection(conn, *args):
+    '''Applies the tuned pragmas and registers the SQL functions the play
+    views use'''
+    set_sqlite_pragmas(conn)
+    register_play_functions(conn)
+
+
+def connect_db(db_file=DATABASE_NAME):
+    '''Opens a sqlite3 connection ready for every table and view'''
+    conn = sqlite3.connect(db_file)
+    prepare_connection(conn)
+    return conn
+
+
+_engine = None
+_engine_lock = threading.Lock()
+
+
+def get_engine():
+    '''The process wide SQLAlchemy engine and its connection pool, created
+    on first use so importing a module never touches the database'''
+    global _engine
+    with _engine_lock:
+        if _engine is None:
+            _engine = sa.create_engine(f'sqlite:///{DATABASE_NAME}')
+            sa.event.listen(_engine, 'connect', prepare_connection)
+        return _engine
+
+
+response_cache = ResponseCache(HTTP_CACHE_PATH, HTTP_CACHE_MAX_BYTES)
+
+
+def is_transient_error(error):
+    '''Whether a failed request is worth retrying: timeouts, dropped
+    connections, 429 and 5xx responses'''
+    if isinstance(error, requests.HTTPError):
+        status = error.response.status_code if error.response is not None else 0
+        return status == 429 or status >= 500
+    return isinstance(error, (
+        TimeoutError, ConnectionError, requests.ConnectionError,
+        requests.Timeout, requests.exceptions.ChunkedEncodingError))
+
+
+def backoff_delay(attempt, base, cap):
+    '''Exponential backoff with full jitter: a uniform delay of up to
+    base * 2 ** attempt seconds, at most cap'''
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+def retry_with_backoff(func, *args, retries=FETCH_RETRIES,
+                       base=FETCH_BACKOFF_SECONDS, cap=FETCH_BACKOFF_MAX_SECONDS,
+                       **kwargs):
+    '''Calls func, retrying transient errors up to retries times'''
+    for attempt in range(retries + 1):
+        try:
+            return func(*args, **kwargs)
+        except Exception as e:
+            if attempt == retries or not is_transient_error(e):
+                raise
+            delay = backoff_delay(attempt, base, cap)
+            logger.warning(f'{e}, retry {attempt + 1} of {retries} in {delay:.1f}s')
+            time.sleep(delay)
+
+
+def time_to_seconds(time_str):
+    '''Converts a "MM:SS" string to integer seconds, None if missing'''
+    if not time_str:
+        return None
+    minutes, seconds = time_str.split(':')
+    return int(minutes) * 60 + int(seconds)
+
+
+def game_seconds(period, period_seconds):
+    '''Seconds since the start of the game. Every period, overtime included,
+    starts a multiple of 20 minutes in.'''
+    if period is None or period_seconds is None:
+        return None
+    return (period - 1) * 1200 + period_seconds
+
 
 def import_data_from_sql(table_name):
+    engine = get_engine()
     insp = sa.inspect(engine)
 
     if insp.dialect.has_table(engine.connect(), table_name):
@@ -28,43 +128,238 @@ def import_data_from_sql(table_name):
     return table_data
 
 
-def get_json_data_from_link(link, headers={}):
+def import_data_from_query(query, **params):
+    '''Runs a SQL query with named (:name) parameters, returns a dataframe'''
+    return pd.read_sql_query(sa.text(query), get_engine(), params=params)
+
+
+def ensure_schema(db_file=DATABASE_NAME):
+    '''Creates/migrates the database schema so queries can rely on it'''
+    conn = connect_db(db_file)
+    try:
+        migrate_database(conn)
+    finally:
+        conn.close()
+
+
+def get_raw_data_from_link(link, headers={}, use_cache=True):
+    '''Takes a url and headers (optional), returns the response body as
+    bytes. Responses are served from the on-disk cache while fresh (or
+    always, when offline); returns None when offline and not cached.'''
+
+    if use_cache:
+        cached = response_cache.get(link, allow_stale=HTTP_CACHE_OFFLINE)
+        if cached is not None:
+            return cached
+    if HTTP_CACHE_OFFLINE:
+        logger.warning(f'Offline and not cached: {link}')
+        return None
+
+    r = http_client.get(link, headers=headers)
+    r.raise_for_status()
+    body = r.content
+
+    if use_cache:
+        response_cache.put(link, body, ttl_for(link, body))
+
+    return body
+
+
+def get_json_data_from_link(link, headers={}, use_cache=True):
     '''Takes a url and headers (optional), returns json'''
 
-    req = urllib.request.Request(link, headers=headers)
-    response = urllib.request.urlopen(req)
-    url_json = json.loads(response.read().decode())
+    body = get_raw_data_from_link(link, headers=headers, use_cache=use_cache)
+    if body is None:
+        return None
 
-    return url_json
+    return json.loads(body)
 
 
 def insert_into_db(df, table_name, if_exists='append'):
     if not df.empty:
         df.to_sql(
-            table_name, engine, if_exists=if_exists, index=False
+            table_name, get_engine(), if_exists=if_exists, index=False
         )
     else:
         logger.warning(f'No data to insert into {table_name}')
 
 
+def upsert_into_db(df, table_name):
+    '''Inserts df, replacing rows that share a primary key with it'''
+
+    def insert_or_replace(table, conn, keys, data_iter):
+        columns = ', '.join(f'"{key}"' for key in keys)
+        placeholders = ', '.join('?' for _ in keys)
+        conn.exec_driver_sql(
+            f'INSERT OR REPLACE INTO "{table.name}" ({columns}) VALUES ({placeholders})',
+            list(data_iter))
+
+    if not df.empty:
+        df.to_sql(
+            table_name, get_engine(), if_exists='append', index=False,
+            method=insert_or_replace)
+    else:
+        logger.warning(f'No data to insert into {table_name}')
+
+
+def table_exists(table_name):
+    return sa.inspect(get_engine()).has_table(table_name)
+
+
+def execute_sql(statement, **params):
+    '''Runs a single statement in its own transaction'''
+    with get_engine().begin() as conn:
+        conn.execute(sa.text(statement), params)
+
+
+def add_missing_columns(conn, df, table_name):
+    '''Adds the columns of df that table_name does not have yet'''
+    existing = [row[1] for row in conn.exec_driver_sql(
+        f'PRAGMA table_info("{table_name}")')]
+    for column in df.columns:
+        if existing and column not in existing:
+            conn.exec_driver_sql(
+                f'ALTER TABLE "{table_name}" ADD COLUMN "{column}"')
+
+
+def replace_partition(conn, df, table_name, **partition):
+    '''Replaces the rows of table_name matching every column=value pair in
+    partition with df, on an open connection/transaction'''
+    if sa.inspect(conn).has_table(table_name):
+        conditions = ' AND '.join(f'"{column}" = :{column}' for column in partition)
+        conn.execute(
+            sa.text(f'DELETE FROM "{table_name}" WHERE {conditions}'), partition)
+        add_missing_columns(conn, df, table_name)
+    df.to_sql(table_name, conn, if_exists='append', index=False)
+
+
+def get_http_validators(url_prefix):
+    '''Returns {url: (etag, last_modified)} stored for urls under url_prefix'''
+    validators = import_data_from_query(
+        'SELECT url, etag, last_modified FROM http_validators '
+        'WHERE url LIKE :prefix', prefix=url_prefix + '%')
+    return {
+        row.url: (row.etag, row.last_modified)
+        for row in validators.itertuples()}
+
+
+def save_http_validators(conn, url, etag, last_modified):
+    conn.execute(
+        sa.text(
+            'INSERT OR REPLACE INTO http_validators (url, etag, last_modified) '
+            'VALUES (:url, :etag, :last_modified)'),
+        {'url': url, 'etag': etag, 'last_modified': last_modified})
+
+
+def get_conditional_data_from_link(link, headers={}, etag=None, last_modified=None):
+    '''Conditional GET of link. Returns (content, etag, last_modified) where
+    content is None if the server reports the resource as not modified.'''
+
+    request_headers = dict(headers)
+    if etag:
+        request_headers['If-None-Match'] = etag
+    if last_modified:
+        request_headers['If-Modified-Since'] = last_modified
+
+    r = http_client.get(link, headers=request_headers)
+    if r.status_code == 304:
+        return None, etag, last_modified
+    r.raise_for_status()
+
+    return (
+        r.content,
+        r.headers.get('ETag'),
+        r.headers.get('Last-Modified'))
+
+
 def get_csv_data_from_link(link, headers={}):
     '''Takes a url and headers(optional), returns pandas dataframe'''
 
-    try: 
-        data = pd.read_csv(link, storage_options=headers)
-    except: 
+    try:
+        r = http_client.get(link, headers=headers)
+        r.raise_for_status()
+        data = pd.read_csv(io.BytesIO(r.content))
+    except (requests.RequestException, ValueError):
         data = pd.DataFrame([])
 
     return data
 
 
-def get_zip_data_from_link(link):
-    '''Given link, returns zip file'''
-    
-    try:
-        r = requests.get(link, stream=True)
-        z = zipfile.ZipFile(io.BytesIO(r.content))
-    except:
-        z = None
+def _read_download_meta(meta_path):
+    if not os.path.exists(meta_path):
+        return {}
+    with open(meta_path) as f:
+        return json.load(f)
+
+
+def _write_download_meta(meta_path, meta):
+    with open(meta_path, 'w') as f:
+        json.dump(meta, f)
+
+
+def download_file(link, path, headers={}):
+    '''Streams link to path in DOWNLOAD_CHUNK_SIZE chunks.
+
+    An interrupted download is kept as path.part and resumed with a Range
+    request as long as the server still has the same version. The result is
+    checked against Content-Length before replacing path; a part that does
+    not match is deleted, so the next run starts over. Returns False without
+    downloading when the local file already matches the server's
+    ETag/Content-Length, True otherwise.'''
+
+    part_path = path + '.part'
+    meta_path = path + '.meta'
+    # Sizes and byte ranges refer to the file itself, not a compressed
+    # transfer of it
+    headers = dict(headers, **{'Accept-Encoding': 'identity'})
+
+    head = http_client.head(link, headers=headers, allow_redirects=True)
+    head.raise_for_status()
+    etag = head.headers.get('ETag')
+    size = int(head.headers.get('Content-Length', 0)) or None
+    version = {'etag': etag, 'size': size}
+
+    meta = _read_download_meta(meta_path)
+    same_version = (etag or size) and all(
+        meta.get(key) == value for key, value in version.items())
+
+    if same_version and meta.get('complete') and os.path.exists(path):
+        return False
+
+    start = 0
+    if same_version and os.path.exists(part_path):
+        start = os.path.getsize(part_path)
+    _write_download_meta(meta_path, dict(version, complete=False))
+
+    # A part already at the full size only needs checking, e.g. when a run
+    # stopped before renaming it
+    if size is None or start < size:
+        request_headers = dict(headers)
+        if start:
+            request_headers['Range'] = f'bytes={start}-'
+            if etag:
+                request_headers['If-Range'] = etag
+
+        with http_client.get(link, headers=request_headers, stream=True) as r:
+            if r.status_code == 416:
+                os.remove(part_path)
+                raise IOError(f'{link}: cannot resume from byte {start}')
+            r.raise_for_status()
+            if r.status_code != 206:
+                start = 0
+            elif start:
+                logger.info(f'Resuming {link} from byte {start}')
+
+            with open(part_path, 'ab' if start else 'wb') as f:
+                for chunk in r.iter_content(DOWNLOAD_CHUNK_SIZE):
+                    f.write(chunk)
+
+    downloaded_size = os.path.getsize(part_path)
+    if size is not None and downloaded_size != size:
+        os.remove(part_path)
+        raise IOError(
+            f'{link}: expected {size} bytes, downloaded {downloaded_size}')
 
-    return z
+    os.replace(part_path, path)
+    _write_download_meta(meta_path, dict(version, complete=True))
+    return True
@@ -3,82 +3,211 @@ import os
 import logging
 import json
 import datetime
+import zipfile
 
 import pandas as pd
-import urllib
-import urllib.request
+import requests
 import sqlite3
 import sqlalchemy as sa
 
 
-from tqdm import tqdm
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
-from settings import DATABASE_NAME
+from settings import (
+    DATABASE_NAME,
+    FETCH_WORKERS,
+    MONEYPUCK_HOST_URL,
+    MONEYPUCK_SHOTS_HOST_URL)
 from misc_functions import (
-    import_data_from_sql, 
-    get_csv_data_from_link, 
-    insert_into_db,
-    get_zip_data_from_link)
-
-SHOT_DATA_URL = 'https://peter-tanner.com/moneypuck/downloads/'
-MONEYPUCK_URL = 'https://moneypuck.com/moneypuck/playerData/seasonSummary/'
+    get_engine,
+    ensure_schema,
+    get_conditional_data_from_link,
+    get_http_validators,
+    save_http_validators,
+    replace_partition,
+    import_data_from_query,
+    download_file,
+    execute_sql,
+    table_exists)
+
+logger = logging.getLogger()
+
+SHOT_DATA_URL = MONEYPUCK_SHOTS_HOST_URL + '/moneypuck/downloads/'
+MONEYPUCK_URL = MONEYPUCK_HOST_URL + '/moneypuck/playerData/seasonSummary/'
 
 game_types = ['regular', 'playoffs']
 data_types = ['lines', 'skaters', 'goalies', 'teams']
+# Summaries joined into player_season_features
+feature_data_types = ['skaters', 'goalies']
 'playerData/playerGameByGame/{year}/{type}/{game}.csv'
 
 
 DATA_PATH = os.path.join('data')
-toi_hdr = {
-    'User-Agent': 'Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.11 (KHTML, like Gecko) Chrome/23.0.1271.64 Safari/537.11',
-}
+SHOT_CHUNK_SIZE = 100000
+shot_category_cols = [
+    'team', 'teamCode', 'homeTeamCode', 'awayTeamCode', 'shotType', 'event',
+    'lastEventCategory', 'playerPositionThatDidEvent', 'shooterLeftRight',
+    'shooterName', 'goalieNameForShot']
 
     
+def mark_season_dirty(conn, year, game_type):
+    '''Queues every player-season of year/game_type for the next
+    player_season_features refresh'''
+    season = f'{year}{year + 1}'
+    nhl_game_type = 'R' if game_type == 'regular' else 'P'
+    conn.execute(
+        sa.text('''INSERT OR IGNORE INTO player_season_dirty_seasons
+                   (season, game_type) VALUES (:season, :game_type)'''),
+        {'season': season, 'game_type': nhl_game_type})
+
+
+def get_season_summary(data_url, validators):
+    headers = {'User-Agent': 'Mozilla/5.0'}
+    etag, last_modified = validators.get(data_url, (None, None))
+    return get_conditional_data_from_link(
+        data_url, headers, etag=etag, last_modified=last_modified)
+
+
 def get_season_summary_data():
+    '''Refreshes the *_advanced tables. Every season summary is requested
+    concurrently with a conditional GET; only the year/game_type slices the
+    server reports as changed are replaced, each in one transaction together
+    with its new ETag/Last-Modified.'''
+
+    ensure_schema()
 
     today = datetime.datetime.today().year
     years = range(2007, today+1)
+    validators = get_http_validators(MONEYPUCK_URL)
+
+    summaries = {}
     for data_type in data_types:
-        data_type_df = pd.DataFrame([])
         for year in years:
             for game_type in game_types:
                 data_url = MONEYPUCK_URL + \
                     f'{year}/{game_type}/{data_type}.csv'
-                headers = {'User-Agent': 'Mozilla/5.0'}
-                data = get_csv_data_from_link(data_url, headers)
-                if not data.empty:
-                    data['game_type'] = game_type
-                    data['year'] = year
-                    
-                    data_type_df = data_type_df.append(data)
-                
-        insert_into_db(
-            data_type_df, f'{data_type}_advanced', if_exists='replace')
+                summaries[data_url] = (data_type, year, game_type)
+
+    changed = 0
+    with ThreadPoolExecutor(max_workers=FETCH_WORKERS) as executor:
+        futures = {
+            executor.submit(get_season_summary, data_url, validators): data_url
+            for data_url in summaries}
+
+        for future in as_completed(futures):
+            data_url = futures[future]
+            data_type, year, game_type = summaries[data_url]
+            try:
+                content, etag, last_modified = future.result()
+            except requests.RequestException as e:
+                logger.debug(f'No season summary at {data_url}: {e}')
+                continue
+            if content is None:
+                continue
+
+            try:
+                data = pd.read_csv(io.BytesIO(content))
+                # Every summary has a season column, an html error page
+                # served with a 200 does not
+                if 'season' not in data.columns:
+                    raise ValueError('not a season summary csv')
+            except ValueError as e:
+                logger.warning(f'Could not parse season summary at {data_url}: {e}')
+                continue
+            data['game_type'] = game_type
+            data['year'] = year
+
+            with get_engine().begin() as conn:
+                replace_partition(
+                    conn, data, f'{data_type}_advanced',
+                    year=year, game_type=game_type)
+                save_http_validators(conn, data_url, etag, last_modified)
+                if data_type in feature_data_types:
+                    mark_season_dirty(conn, year, game_type)
+            changed += 1
+
+    logger.info(
+        f'Season summaries: {changed} of {len(summaries)} slices changed')
+
+
+def compact_shot_dtypes(shot_data):
+    '''Downcasts a chunk of shot data: categoricals for the repeated strings,
+    float32 for coordinates/probabilities and the smallest int type that
+    fits. Id columns keep full precision.'''
+
+    for col in shot_data.columns:
+        dtype = shot_data[col].dtype
+        if col in shot_category_cols:
+            shot_data[col] = shot_data[col].astype('category')
+        elif col.lower().endswith('id'):
+            continue
+        elif pd.api.types.is_float_dtype(dtype):
+            shot_data[col] = pd.to_numeric(shot_data[col], downcast='float')
+        elif pd.api.types.is_integer_dtype(dtype):
+            shot_data[col] = pd.to_numeric(shot_data[col], downcast='integer')
+
+    return shot_data
+
+
+def shot_season_loaded(year):
+    if not table_exists('shot_data_advanced'):
+        return False
+    return not import_data_from_query(
+        'SELECT 1 FROM shot_data_advanced WHERE season = :season LIMIT 1',
+        season=year).empty
 
 
 def get_shot_data():
+    '''Streams each season's shot csv straight out of its zip archive in
+    SHOT_CHUNK_SIZE row chunks, replacing that season in shot_data_advanced.
+    Memory is bounded by the chunk size rather than the shot history.
+
+    Archives are kept in data/moneypuck and only downloaded again when the
+    server's copy changed, so re-runs only transfer and reload the seasons
+    that did.'''
     today = datetime.datetime.today().year
     years = range(2007, today + 1)
     MONEYPUCK_PATH = os.path.join(DATA_PATH, 'moneypuck')
     os.makedirs(MONEYPUCK_PATH, exist_ok=True)
 
-    # Extract Data
     for year in years:
         shot_year_url = SHOT_DATA_URL + f'shots_{year}.zip'
-
-        zips = get_zip_data_from_link(shot_year_url)
-        if zips is not None:
-            zips.extractall(MONEYPUCK_PATH)
-
-    # Load Data
-    yearly_shot_data = pd.DataFrame([])
-    for file in os.listdir(MONEYPUCK_PATH):
-        shot_path = os.path.join(MONEYPUCK_PATH, file)
-        shot_data = pd.read_csv(shot_path)
-        yearly_shot_data = yearly_shot_data.append(shot_data)
-
-    insert_into_db(
-        yearly_shot_data, f'shot_data_advanced', if_exists='replace')
+        shot_year_path = os.path.join(MONEYPUCK_PATH, f'shots_{year}.zip')
+
+        try:
+            changed = download_file(shot_year_url, shot_year_path)
+        except (requests.RequestException, IOError) as e:
+            logger.warning(f'Could not download shots for {year}: {e}')
+            continue
+        if not changed and shot_season_loaded(year):
+            continue
+
+        zips = zipfile.ZipFile(shot_year_path)
+
+        # One transaction per season: a run stopped part way through leaves
+        # the season as it was, rather than half loaded and looking done
+        row_count = 0
+        with get_engine().begin() as conn:
+            for member in zips.namelist():
+                if not member.endswith('.csv'):
+                    continue
+                with zips.open(member) as shot_file:
+                    for shot_data in pd.read_csv(shot_file, chunksize=SHOT_CHUNK_SIZE):
+                        shot_data = compact_shot_dtypes(shot_data)
+                        if row_count == 0:
+                            replace_partition(
+                                conn, shot_data, 'shot_data_advanced', season=year)
+                        else:
+                            shot_data.to_sql(
+                                'shot_data_advanced', conn, if_exists='append',
+                                index=False)
+                        row_count += shot_data.shape[0]
+        logger.info(f'Loaded {row_count} shots for {year}')
+
+    if table_exists('shot_data_advanced'):
+        execute_sql(
+            'CREATE INDEX IF NOT EXISTS idx_shot_data_advanced_season '
+            'ON shot_data_advanced (season)')
 
 
 def get_moneypuck_data():
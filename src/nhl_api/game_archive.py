@@ -0,0 +1,162 @@
+import time
+import zlib
+import queue
+import atexit
+import sqlite3
+import logging
+import threading
+
+from settings import ARCHIVE_DATABASE_NAME, GAMES_PER_FLUSH
+
+logger = logging.getLogger()
+
+feed_types = ['game', 'toi']
+
+
+def connect_archive(db_file=ARCHIVE_DATABASE_NAME):
+    conn = sqlite3.connect(db_file)
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=NORMAL')
+    conn.execute(
+        '''CREATE TABLE IF NOT EXISTS raw_game_feeds (
+            game_id INTEGER NOT NULL,
+            feed_type TEXT NOT NULL,
+            fetched_at REAL NOT NULL,
+            payload BLOB NOT NULL,
+            PRIMARY KEY (game_id, feed_type))''')
+    return conn
+
+
+def season_game_id_range(season):
+    '''Game ids start with the first year of their season, e.g. 2019020001
+    is in 20192020. Accepts 2019, '2019' or '20192020'.'''
+    start_year = int(str(season)[:4])
+    return start_year * 1000000, (start_year + 1) * 1000000
+
+
+def get_archived_game_ids(conn, seasons=None):
+    if seasons is None:
+        return [row[0] for row in conn.execute(
+            "SELECT game_id FROM raw_game_feeds WHERE feed_type = 'game' "
+            "ORDER BY game_id")]
+
+    game_ids = []
+    for season in seasons:
+        low, high = season_game_id_range(season)
+        game_ids.extend(row[0] for row in conn.execute(
+            "SELECT game_id FROM raw_game_feeds WHERE feed_type = 'game' "
+            "AND game_id >= ? AND game_id < ? ORDER BY game_id", (low, high)))
+    return game_ids
+
+
+def get_archived_payloads(conn, game_id):
+    '''Returns the compressed {feed_type: payload} stored for game_id'''
+    return dict(conn.execute(
+        'SELECT feed_type, payload FROM raw_game_feeds WHERE game_id = ?',
+        (game_id,)))
+
+
+# Queue items asking the archive thread to flush, and to flush and stop
+_FLUSH = 'flush'
+_CLOSE = 'close'
+
+
+class GameArchive:
+    '''Stores raw game feed and shiftchart bodies zlib-compressed in
+    raw_game_feeds, GAMES_PER_FLUSH games at a time.
+
+    Compression and writes run on a thread of the archive's own (zlib
+    releases the GIL), so add_game returns at once and the ingest
+    coordinator never waits on them. At most 2 * games_per_flush games
+    wait to be compressed. An error on the archive thread is raised by the
+    next call.'''
+
+    def __init__(self, db_file=ARCHIVE_DATABASE_NAME, games_per_flush=GAMES_PER_FLUSH):
+        self.db_file = db_file
+        self.games_per_flush = games_per_flush
+        self.conn = None
+        self.rows = []
+        self.queue = queue.Queue(maxsize=2 * games_per_flush)
+        self.thread = None
+        self.error = None
+        atexit.register(self.close)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
+    def _raise_error(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def add_game(self, game_id, game_body, toi_body):
+        self._raise_error()
+        if self.thread is None:
+            # A daemon, so it is still running for the atexit close
+            self.thread = threading.Thread(
+                target=self._run, name='game-archive', daemon=True)
+            self.thread.start()
+        self.queue.put((game_id, game_body, toi_body, time.time()))
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            try:
+                if item == _CLOSE:
+                    self._close()
+                    return
+                if item == _FLUSH:
+                    self._flush()
+                else:
+                    self._store(*item)
+            except Exception as e:
+                self.rows = []
+                self.error = e
+            finally:
+                self.queue.task_done()
+
+    def _store(self, game_id, game_body, toi_body, fetched_at):
+        for feed_type, body in zip(feed_types, [game_body, toi_body]):
+            self.rows.append((game_id, feed_type, fetched_at, zlib.compress(body)))
+
+        if len(self.rows) >= 2 * self.games_per_flush:
+            self._flush()
+
+    def _flush(self):
+        if not self.rows:
+            return
+        if self.conn is None:
+            self.conn = connect_archive(self.db_file)
+
+        with self.conn:
+            self.conn.executemany(
+                'INSERT OR REPLACE INTO raw_game_feeds '
+                '(game_id, feed_type, fetched_at, payload) VALUES (?, ?, ?, ?)',
+                self.rows)
+        self.rows = []
+
+    def _close(self):
+        try:
+            self._flush()
+        finally:
+            if self.conn is not None:
+                self.conn.close()
+                self.conn = None
+
+    def flush(self):
+        '''Waits until every game added so far is stored'''
+        if self.thread is not None:
+            self.queue.put(_FLUSH)
+            self.queue.join()
+        self._raise_error()
+
+    def close(self):
+        if self.thread is not None:
+            self.queue.put(_CLOSE)
+            self.thread.join()
+            self.thread = None
+        self._raise_error()
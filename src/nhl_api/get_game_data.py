@@ -2,20 +2,43 @@ import logging
 import json
 
 import pandas as pd
-import urllib
-import urllib.request
-import sqlite3
-import sqlalchemy as sa
-from timeit import default_timer as timer
+import time
+from concurrent.futures import (
+    ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED)
 
 from tqdm import tqdm
 
-from settings import DATABASE_NAME
-from misc_functions import import_data_from_sql, get_json_data_from_link, insert_into_db
+from settings import (
+    FETCH_WORKERS,
+    PARSE_WORKERS,
+    PIPELINE_DEPTH,
+    NHL_STATS_API_URL,
+    NHL_SHIFTS_API_URL)
+from misc_functions import (
+    import_data_from_query,
+    ensure_schema,
+    get_raw_data_from_link,
+    retry_with_backoff,
+    connect_db,
+    time_to_seconds,
+    game_seconds)
+from db_writer import BufferedWriter
+from nhl_api.ingest_jobs import (
+    IN_FLIGHT,
+    PENDING,
+    done_job_row,
+    mark_job_failed,
+    reset_in_flight_jobs,
+    set_job_status)
+from metrics import IngestMetrics, stage_timer
+from schema import migrate_database
+from nhl_api.game_archive import GameArchive
+from nhl_api.get_on_ice import get_plays_on_ice
+from nhl_api.get_player_info import get_player_info_row
+from nhl_api.get_team_info import get_team_info_row
 
 pd.set_option('display.max_columns', None)
 
-logging.basicConfig(level='INFO')
 logger = logging.getLogger()
 
 # Settings
@@ -24,24 +47,36 @@ skater_stats_cols = ["player_id","timeOnIce", "assists", "goals", "shots", "hits
                      "takeaways",  "giveaways", "shortHandedGoals", "shortHandedAssists",
                      "blocked",
                      "plusMinus", "evenTimeOnIce", "shortHandedTimeOnIce",
-                     "powerPlayTimeOnIce", 'test_col'] # REMOVE TEST COL
+                     "powerPlayTimeOnIce"]
 goalie_stats_cols = ["player_id", "timeOnIce", "assists", "goals", "shots",
                      "saves", "pim", "powerPlaySaves", "shortHandedSaves",
                      "evenSaves", "shortHandedShotsAgainst",
                      "evenShotsAgainst", "powerPlayShotsAgainst", "decision",
                      "savePercentage",  "powerPlaySavePercentage",
                      "evenStrengthSavePercentage"]
+# "MM:SS" stats also stored as integer seconds, in <col>Seconds
+time_on_ice_cols = ["timeOnIce", "evenTimeOnIce", "shortHandedTimeOnIce",
+                    "powerPlayTimeOnIce"]
 
+url_prefix = NHL_STATS_API_URL
+url_toiData_prefix = NHL_SHIFTS_API_URL + '/stats/rest/en/shiftcharts?cayenneExp=gameId='
 
+# Games not written yet, skipping dead-lettered ones and failed ones
+# still backing off
+missing_games_query = '''
+    SELECT s.game_id, s.link, s.gameDate
+    FROM game_schedules s
+    WHERE s.gameDate < :today
+      AND NOT EXISTS (SELECT 1 FROM games g WHERE g.game_id = s.game_id)
+      AND NOT EXISTS (
+        SELECT 1 FROM ingest_jobs j
+        WHERE j.game_id = s.game_id
+          AND (j.status = 'dead' OR j.next_attempt_at > :now))
+    ORDER BY s.game_id'''
 
-engine = sa.create_engine(f'sqlite:///{DATABASE_NAME}')
 
-url_prefix = 'https://statsapi.web.nhl.com'
-url_toiData_prefix = "https://api.nhle.com/stats/rest/en/shiftcharts?cayenneExp=gameId="
-
-toi_hdr = {
-    'User-Agent': 'Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.11 (KHTML, like Gecko) Chrome/23.0.1271.64 Safari/537.11',
-}
+def seconds_cols(cols):
+    return [col + 'Seconds' for col in time_on_ice_cols if col in cols]
 
 
 def get_game_winner(live_data):
@@ -85,7 +120,7 @@ def determine_outcome(live_data):
     return winner + ' win ' + period + str(last_period)
 
 
-def get_game_overview(game_id, game_data, live_data, venue_data):
+def get_game_overview(game_id, game_data, live_data, venue_data, as_frame=True):
     game_properties = {}
     # Get Game Properties
     game_properties['game_id'] = game_id
@@ -107,89 +142,87 @@ def get_game_overview(game_id, game_data, live_data, venue_data):
         'Unknown' if venue_data == None else venue_data.get('name'))
     game_properties['outcome'] = determine_outcome(live_data)
 
+    if not as_frame:
+        return [game_properties]
+
     game_properties_df = pd.DataFrame().from_dict(game_properties, orient='index').T
     return game_properties_df
 
 
-def get_player_stats_by_team(game_dict, is_home):
-    skater_stats_all_df = pd.DataFrame([], columns=skater_stats_cols)
-    goalie_stats_all_df = pd.DataFrame([], columns=goalie_stats_cols)
-    _scratches_stats_df = pd.DataFrame([], columns=['player_id'])
+def get_player_stats_by_team(game_dict, is_home, team_id, game_id):
+    '''Returns lists of skater, goalie and scratch rows (dicts) for a team'''
+    skater_rows = []
+    goalie_rows = []
 
     # Get Skater and Goalie Properties
-    player_dict = game_dict.get('players')
-    for index, player in player_dict.items():
+    for player in game_dict.get('players').values():
         player_id = player.get('person').get('id')
 
         # Check if player played in game
-        if (player.get('stats') is not None) & (player.get('stats') != {}):
-            player_stats = player.get('stats')
-            skater_stats = player_stats.get('skaterStats')
-            goalie_stats = player_stats.get('goalieStats')
-            # Check whether goalie or skater (or other?)
-            if skater_stats is not None:
-                skater_stats_all_df = skater_stats_all_df.append(
-                    skater_stats, ignore_index=True)
-                skater_stats_all_df['player_id'] = player_id
-            elif goalie_stats is not None:
-                goalie_stats_all_df = goalie_stats_all_df.append(
-                    goalie_stats, ignore_index=True)
-                goalie_stats_all_df['player_id'] = player_id
-            else:
-                other_player = 'test'
-                print('--------Not goalie or skater -------')
-    _skater_stats_df = skater_stats_all_df[skater_stats_cols]
-    _skater_stats_df['is_home'] = is_home
-
-    _goalie_stats_df = goalie_stats_all_df[goalie_stats_cols]
-    _goalie_stats_df['is_home'] = is_home
+        player_stats = player.get('stats')
+        if not player_stats:
+            continue
+
+        skater_stats = player_stats.get('skaterStats')
+        goalie_stats = player_stats.get('goalieStats')
+        # Check whether goalie or skater (or other?)
+        if skater_stats is not None:
+            stats, rows, cols = skater_stats, skater_rows, skater_stats_cols
+        elif goalie_stats is not None:
+            stats, rows, cols = goalie_stats, goalie_rows, goalie_stats_cols
+        else:
+            logger.warning(f'Player {player_id} is not a goalie or skater')
+            continue
+
+        row = {col: stats.get(col) for col in cols}
+        for col in time_on_ice_cols:
+            if col in row:
+                row[col + 'Seconds'] = time_to_seconds(row[col])
+        row['player_id'] = player_id
+        row['is_home'] = is_home
+        row['team_id'] = team_id
+        row['game_id'] = game_id
+        rows.append(row)
 
     # Get Scratches Properties
-    scratches_dict = game_dict.get('scratches')
-    if len(scratches_dict)>0:
-        _scratches_stats_df = pd.DataFrame(scratches_dict, columns=['player_id'])
-
-    return _skater_stats_df, _goalie_stats_df, _scratches_stats_df
-
-
-def get_player_stats(live_data, game_data, game_id):
-
-    # Home Stats
-    home_team_id = game_data.get('teams').get('home').get('id')
-    home_game_dict = live_data.get('boxscore').get('teams').get('home')
-
-    home_skater_stats_df, home_goalie_stats_df, home_scratches_stats_df = get_player_stats_by_team(
-        home_game_dict, is_home=1)
-    home_goalie_stats_df['team_id'] = home_team_id
-    home_goalie_stats_df['game_id'] = game_id
-    
-    home_skater_stats_df['team_id'] = home_team_id
-    home_skater_stats_df['game_id'] = game_id
-
-    home_scratches_stats_df['team_id'] = home_team_id
-    home_scratches_stats_df['game_id'] = game_id
-
-    # Away Stats
-    away_team_id = game_data.get('teams').get('away').get('id')
-    away_game_dict = live_data.get('boxscore').get('teams').get('away')
-
-    away_skater_stats_df, away_goalie_stats_df, away_scratches_stats_df = get_player_stats_by_team(
-        away_game_dict, is_home=0)
-
-    away_goalie_stats_df['team_id'] = away_team_id
-    away_goalie_stats_df['game_id'] = game_id
-    
-    away_skater_stats_df['team_id'] = away_team_id
-    away_skater_stats_df['game_id'] = game_id
-
-    away_scratches_stats_df['team_id'] = away_team_id
-    away_scratches_stats_df['game_id'] = game_id
-
-    # Combine home and away
-    skater_stats_df = pd.concat([away_skater_stats_df, home_skater_stats_df])
-    goalie_stats_df = pd.concat([away_goalie_stats_df, home_goalie_stats_df])
-    scratches_stats_df = pd.concat(
-        [away_scratches_stats_df, home_scratches_stats_df])
+    scratch_rows = [
+        {'player_id': player_id, 'team_id': team_id, 'game_id': game_id}
+        for player_id in game_dict.get('scratches')]
+
+    return skater_rows, goalie_rows, scratch_rows
+
+
+def get_player_stats(live_data, game_data, game_id, as_frame=True):
+    '''Returns skater, goalie and scratch stats for both teams. With
+    as_frame=False the rows are returned as lists of dicts, skipping pandas
+    for callers that hand them straight to the db writer.'''
+    skater_rows = []
+    goalie_rows = []
+    scratch_rows = []
+
+    # Away stats first, then home
+    for HoA, is_home in [('away', 0), ('home', 1)]:
+        team_id = game_data.get('teams').get(HoA).get('id')
+        game_dict = live_data.get('boxscore').get('teams').get(HoA)
+
+        skaters, goalies, scratches = get_player_stats_by_team(
+            game_dict, is_home, team_id, game_id)
+        skater_rows.extend(skaters)
+        goalie_rows.extend(goalies)
+        scratch_rows.extend(scratches)
+
+    if not as_frame:
+        return skater_rows, goalie_rows, scratch_rows
+
+    extra_cols = ['is_home', 'team_id', 'game_id']
+    skater_stats_df = pd.DataFrame(
+        skater_rows,
+        columns=skater_stats_cols + seconds_cols(skater_stats_cols) + extra_cols)
+    goalie_stats_df = pd.DataFrame(
+        goalie_rows,
+        columns=goalie_stats_cols + seconds_cols(goalie_stats_cols) + extra_cols)
+    scratches_stats_df = pd.DataFrame(
+        scratch_rows, columns=['player_id', 'team_id', 'game_id'])
 
     return skater_stats_df, goalie_stats_df, scratches_stats_df
 
@@ -239,19 +272,21 @@ def get_team_info_by_home_away(HoA, game_id, game_data, live_data, venue_data):
     return team_properties
 
 
-def get_team_game_info(game_id, game_data, live_data, venue_data):
+def get_team_game_info(game_id, game_data, live_data, venue_data, as_frame=True):
     home_properties = get_team_info_by_home_away(
         'home', game_id, game_data, live_data, venue_data)
     away_properties = get_team_info_by_home_away(
         'away', game_id, game_data, live_data, venue_data)
 
-    HoA_team_properties = pd.DataFrame().from_dict(home_properties, orient='index').T
-    HoA_team_properties = HoA_team_properties.append(away_properties, ignore_index=True)
-    
+    if not as_frame:
+        return [home_properties, away_properties]
+
+    HoA_team_properties = pd.DataFrame([home_properties, away_properties])
+
     return HoA_team_properties
 
 
-def get_game_plays(game_id, live_data, game_data):
+def get_game_plays(game_id, live_data, game_data, as_frame=True):
     game_plays = []
     
     allplays = live_data.get('plays').get('allPlays')
@@ -274,58 +309,67 @@ def get_game_plays(game_id, live_data, game_data):
         elif team_id == away_team_id:
             team_against_id = home_team_id
 
+        # Play details are nested under result, about and coordinates
+        result = plays.get('result')
+        about = plays.get('about')
+        coordinates = plays.get('coordinates') or {}
+
         strength = None
-        if plays.get('strength') is not None:
-            strength = plays.get('strength')
+        if result.get('strength') is not None:
+            strength = result.get('strength').get('name')
 
-        goals = plays.get('goals')
+        goals = about.get('goals')
         home_goals = None
         away_goals = None
         if  goals is not None:
             home_goals = goals.get('home')
             away_goals = goals.get('away')
 
-        gameWinningGoal = None
-        if plays.get('gameWinningGoal') is not None:
-            gameWinningGoal = plays.get('gameWinningGoal')
-
         _play_data = {}
-        _play_data['play_id'] = str(game_id) + '_' + str(plays.get('about').get('eventId'))
+        _play_data['play_id'] = str(game_id) + '_' + str(about.get('eventId'))
         _play_data['game_id'] = game_id 
-        _play_data['event_id'] = plays.get('about').get('eventId')
+        _play_data['event_id'] = about.get('eventId')
         _play_data['team_id'] = team_id
         _play_data['team_id_against'] = team_against_id 
-        _play_data['event'] = plays.get('result').get('event')
-        _play_data['secondaryType'] = plays.get('result').get('secondaryType')
+        _play_data['event'] = result.get('event')
+        _play_data['secondaryType'] = result.get('secondaryType')
         
         #some vars not in all event types:
         _play_data['strength'] = strength
-        _play_data['gameWinningGoal'] = plays.get('gameWinningGoal')
-        _play_data['emptyNet'] = plays.get('emptyNet')
-        _play_data['penaltySeverity'] = plays.get('penaltySeverity')
-        _play_data['penaltyMinutes'] = plays.get('penaltyMinutes')
-
-        _play_data['x'] = plays.get('x')
-        _play_data['y'] = plays.get('y')
-        _play_data['period'] = plays.get('period')
-        _play_data['periodType'] = plays.get('periodType')
-        _play_data['periodTime'] = plays.get('periodTime')
-        _play_data['periodTimeRemaining'] = plays.get('periodTimeRemaining')
-        _play_data['dateTime'] = plays.get('dateTime')
+        _play_data['gameWinningGoal'] = result.get('gameWinningGoal')
+        _play_data['emptyNet'] = result.get('emptyNet')
+        _play_data['penaltySeverity'] = result.get('penaltySeverity')
+        _play_data['penaltyMinutes'] = result.get('penaltyMinutes')
+
+        _play_data['x'] = coordinates.get('x')
+        _play_data['y'] = coordinates.get('y')
+        _play_data['period'] = about.get('period')
+        _play_data['periodType'] = about.get('periodType')
+        _play_data['periodTime'] = about.get('periodTime')
+        _play_data['periodTimeRemaining'] = about.get('periodTimeRemaining')
+        _play_data['periodTimeSeconds'] = time_to_seconds(about.get('periodTime'))
+        _play_data['periodTimeRemainingSeconds'] = time_to_seconds(
+            about.get('periodTimeRemaining'))
+        _play_data['gameSeconds'] = game_seconds(
+            about.get('period'), _play_data['periodTimeSeconds'])
+        _play_data['dateTime'] = about.get('dateTime')
 
         _play_data['goals_home'] = home_goals
         _play_data['goals_away'] = away_goals
         
-        _play_data['description'] = plays.get('description')
+        _play_data['description'] = result.get('description')
 
         game_plays.append(_play_data)
 
+    if not as_frame:
+        return game_plays
+
     game_plays_df = pd.DataFrame(game_plays)
 
     return game_plays_df
 
 
-def get_game_plays_players(game_id, live_data, game_data):
+def get_game_plays_players(game_id, live_data, game_data, as_frame=True):
     allplays = live_data.get('plays').get('allPlays')
 
     home_team_id = game_data.get(
@@ -344,31 +388,47 @@ def get_game_plays_players(game_id, live_data, game_data):
                 _game_play_player['play_id'] = str(
                     game_id) + '_' + str(plays.get('about').get('eventId'))
                 _game_play_player['game_id'] = game_id
+                _game_play_player['event_id'] = plays.get('about').get('eventId')
                 _game_play_player['player_id'] = player.get('player').get('id')
                 _game_play_player['player_type'] = player.get('playerType')
                 game_play_players.append(_game_play_player)
     
+    if not as_frame:
+        return game_play_players
+
     game_play_players = pd.DataFrame(game_play_players)
     return game_play_players
 
 
-def get_shift_data(toi_json):
+def get_shift_data(toi_json, as_frame=True):
     shift_data = []
     for player in toi_json.get('data'):
         player_shift_data = {}
 
         player_shift_data['game_id'] = player.get('gameId')
         player_shift_data['player_id'] = player.get('playerId')
+        player_shift_data['team_id'] = player.get('teamId')
         player_shift_data['period'] = player.get('period')
         player_shift_data['shift_start'] = player.get('startTime')
         player_shift_data['shift_end'] = player.get('endTime')
+        player_shift_data['shift_start_seconds'] = time_to_seconds(
+            player.get('startTime'))
+        player_shift_data['shift_end_seconds'] = time_to_seconds(
+            player.get('endTime'))
+        player_shift_data['shift_start_game_seconds'] = game_seconds(
+            player.get('period'), player_shift_data['shift_start_seconds'])
+        player_shift_data['shift_end_game_seconds'] = game_seconds(
+            player.get('period'), player_shift_data['shift_end_seconds'])
         shift_data.append(player_shift_data)
 
+    if not as_frame:
+        return shift_data
+
     shift_data_df = pd.DataFrame(shift_data)
     return shift_data_df
 
 
-def get_game_players(game_id, game_data):
+def get_game_players(game_id, game_data, as_frame=True):
     # TODO: Ideally work out a team ID in here too, but this information is probably available in another table
     game_players = game_data.get('players')
 
@@ -381,86 +441,261 @@ def get_game_players(game_id, game_data):
 
         game_players_list.append(_player_dict)
 
+    if not as_frame:
+        return game_players_list
+
     game_players_df = pd.DataFrame(game_players_list)
 
     return game_players_df
 
 
-def get_game_info(games_df):
-    '''Description: For each game in game schedules, obtain all information
-    about the game for each team and player. Also grab all player information. '''
+def timed_fetch(link, headers=None):
+    '''Returns the raw body of link and the seconds the fetch took'''
+    started = time.perf_counter()
+    body = retry_with_backoff(get_raw_data_from_link, link, headers=headers or {})
+    return body, time.perf_counter() - started
 
-    for _, game in tqdm(games_df.iterrows(), total=len(games_df)):
- 
-        # Get data from websites
-        toi_json = get_json_data_from_link(
-            url_toiData_prefix + str(game['game_id']), headers=toi_hdr)
-        game_json = get_json_data_from_link(url_prefix + game['link'])
-
-        # Extract Useful Data Sets
-        game_id = game['game_id']
-        game_data = game_json.get('gameData')
-        live_data = game_json.get('liveData')
-        venue_data = game_data.get('venue')
- 
-        # Get Game Overview
+
+def fetch_game_payloads(executor, game):
+    '''Submits the shiftcharts and game feed requests for a game so that both
+    are fetched at the same time. Returns the (toi, game) futures, which
+    resolve to (raw response body, fetch seconds).'''
+
+    toi_future = executor.submit(
+        timed_fetch, url_toiData_prefix + str(game.game_id))
+    game_future = executor.submit(timed_fetch, url_prefix + game.link)
+
+    return toi_future, game_future
+
+
+def parse_game(game_id, game_json, toi_json, timings=None):
+    '''Extracts every table for a single game, returns {table_name: rows}.
+    If timings is given, the seconds spent in each extractor are added to it.'''
+    timings = {} if timings is None else timings
+
+    # Extract Useful Data Sets
+    game_data = game_json.get('gameData')
+    live_data = game_json.get('liveData')
+    venue_data = game_data.get('venue')
+
+    # Get Game Overview
+    with stage_timer(timings, 'get_game_overview'):
         game_overview = get_game_overview(
-            game_id, game_data, live_data, venue_data)
-        
-        # Get Team Info
-        team_game_info = get_team_game_info(game_id, game_data, live_data, venue_data)
+            game_id, game_data, live_data, venue_data, as_frame=False)
 
-        # Get Game Players
-        game_players = get_game_players(game_id, game_data)
+    # Get Team Info
+    with stage_timer(timings, 'get_team_game_info'):
+        team_game_info = get_team_game_info(
+            game_id, game_data, live_data, venue_data, as_frame=False)
 
-        # Get Player-Game Stats
+    # Get Game Players
+    with stage_timer(timings, 'get_game_players'):
+        game_players = get_game_players(game_id, game_data, as_frame=False)
+
+    # Get Player-Game Stats
+    with stage_timer(timings, 'get_player_stats'):
         skater_stats_df, goalie_stats_df, scratches_stats_df = get_player_stats(
-            live_data, game_data, game_id)
-
-        # Get Play details
-        game_plays_info = get_game_plays(game_id, live_data, game_data)
-
-        # Get Play-Player
-        game_play_players = get_game_plays_players(game_id, live_data, game_data)
-
-        # Get Shift Data
-        game_shift_info = get_shift_data(toi_json)
-
-        ## Insert into DB
-        insert_into_db(game_overview, 'games')
-        insert_into_db(team_game_info, 'team_game_info')
-        insert_into_db(game_players, 'game_players')
-        insert_into_db(skater_stats_df, 'skater_game_stats')
-        insert_into_db(goalie_stats_df, 'goalie_game_stats')
-        insert_into_db(scratches_stats_df, 'scratches_game_stats')
-        insert_into_db(game_plays_info, 'game_plays_info')
-        insert_into_db(game_play_players, 'game_play_players')
-        insert_into_db(game_shift_info, 'game_shift_info')
-   
-            
-def get_game_data():
+            live_data, game_data, game_id, as_frame=False)
+
+    # Get Play details
+    with stage_timer(timings, 'get_game_plays'):
+        game_plays_info = get_game_plays(
+            game_id, live_data, game_data, as_frame=False)
+
+    # Get Play-Player
+    with stage_timer(timings, 'get_game_plays_players'):
+        game_play_players = get_game_plays_players(
+            game_id, live_data, game_data, as_frame=False)
+
+    # Get Shift Data
+    with stage_timer(timings, 'get_shift_data'):
+        game_shift_info = get_shift_data(toi_json, as_frame=False)
+
+    # Get Players On Ice for each play
+    with stage_timer(timings, 'get_plays_on_ice'):
+        goalie_ids = {row['player_id'] for row in goalie_stats_df}
+        game_play_on_ice = get_plays_on_ice(
+            game_plays_info, game_shift_info, goalie_ids)
+
+    # Get Player and Team Info, upserted when changed and the game is the
+    # newest they were seen in
+    with stage_timer(timings, 'get_entity_info'):
+        player_info = [
+            {**get_player_info_row(person), 'source_game_id': game_id}
+            for person in game_data.get('players').values()]
+        team_info = [
+            {**get_team_info_row(game_data.get('teams').get(HoA)),
+             'source_game_id': game_id}
+            for HoA in ['away', 'home']]
+
+    return {
+        'games': game_overview,
+        'team_game_info': team_game_info,
+        'game_players': game_players,
+        'skater_game_stats': skater_stats_df,
+        'goalie_game_stats': goalie_stats_df,
+        'scratches_game_stats': scratches_stats_df,
+        'game_plays_info': game_plays_info,
+        'game_play_players': game_play_players,
+        'game_shift_info': game_shift_info,
+        'game_play_on_ice': game_play_on_ice,
+        'player_info': player_info,
+        'team_info': team_info,
+    }
+
+
+def parse_game_payloads(game_id, game_body, toi_body):
+    '''Decodes the raw game feed and shiftcharts bodies and extracts every
+    table. Runs in the parse worker processes, so it only takes and returns
+    plain picklable data: ({table_name: rows}, {stage: seconds}).'''
+
+    timings = {}
+    with stage_timer(timings, 'json_decode'):
+        game_json = json.loads(game_body)
+        toi_json = json.loads(toi_body)
+
+    return parse_game(game_id, game_json, toi_json, timings), timings
+
+
+def start_parse_pool(parse_workers):
+    '''Starts the parse processes up front, before any fetch threads exist,
+    so forking never copies a lock held by another thread'''
+    if not parse_workers:
+        return None
+
+    parse_pool = ProcessPoolExecutor(max_workers=parse_workers)
+    wait([parse_pool.submit(int) for _ in range(parse_workers)])
+    return parse_pool
+
+
+def get_game_info(games_df, workers=FETCH_WORKERS, parse_workers=PARSE_WORKERS):
+    '''Description: For each game in game schedules, obtain all information
+    about the game for each team and player. Also grab all player information.
+
+    Runs as a three stage pipeline: `workers` games are downloaded at once
+    (both urls of a game in parallel), `parse_workers` processes decode the
+    json and build the rows, and this thread is the single database writer,
+    buffering GAMES_PER_FLUSH games per transaction. Every fetched body is
+    also kept in the raw feed archive, see nhl_api/reprocess_games. At most
+    PIPELINE_DEPTH games are fetched but not yet written, which keeps memory
+    flat. parse_workers=0 parses on this thread instead.
+
+    Fetch, decode, extractor and write timings of every game are recorded
+    with IngestMetrics, see metrics.py.
+
+    Progress is checkpointed in ingest_jobs: games are marked in flight when
+    fetched and done in the transaction that writes their rows, so an
+    interrupted run resumes where it stopped. Transient HTTP errors are
+    retried with backoff; a game that still fails to download, parse or
+    write is marked failed and retried by later runs, until it is
+    dead-lettered.'''
+
+    games = list(games_df[['game_id', 'link']].itertuples(index=False))
+    max_in_flight = max(PIPELINE_DEPTH, workers)
+    fetching = {}
+    parsing = {}
+    next_game = 0
+
+    jobs = connect_db()
+    migrate_database(jobs)
+    reset_in_flight_jobs(jobs)
+
+    def game_failed(game_id, error, stage):
+        logger.error(f'Could not {stage} game {game_id}: {error}')
+        mark_job_failed(jobs, game_id, error)
+        metrics.record('failed', stage, game_id=game_id)
+
+    def game_parsed(game_id, game_tables, timings):
+        metrics.record_timings(game_id, 'parse', timings)
+        game_tables['ingest_jobs'] = done_job_row(game_id)
+        writer.add_game(game_id, game_tables)
+        metrics.game_done()
+
+    parse_pool = start_parse_pool(parse_workers)
+    try:
+        with IngestMetrics('games') as metrics, \
+                ThreadPoolExecutor(max_workers=2 * workers) as fetch_pool, \
+                BufferedWriter(
+                    metrics=metrics,
+                    on_game_failed=lambda game_id, e: game_failed(game_id, e, 'write')
+                ) as writer, \
+                GameArchive() as archive, \
+                tqdm(total=len(games)) as progress:
+            while next_game < len(games) or fetching or parsing:
+
+                # Fetch stage: top up downloads while the pipeline has room
+                started = []
+                while (next_game < len(games) and len(fetching) < workers
+                       and len(fetching) + len(parsing) < max_in_flight):
+                    game = games[next_game]
+                    fetching[game.game_id] = fetch_game_payloads(fetch_pool, game)
+                    started.append(game.game_id)
+                    next_game += 1
+                set_job_status(jobs, started, IN_FLIGHT)
+
+                pending = [f for futures in fetching.values() for f in futures]
+                wait(pending + list(parsing), return_when=FIRST_COMPLETED)
+
+                # Parse stage: hand games with both bodies to the parse pool
+                for game_id, (toi_future, game_future) in list(fetching.items()):
+                    if not (toi_future.done() and game_future.done()):
+                        continue
+                    del fetching[game_id]
+                    try:
+                        toi_body, toi_seconds = toi_future.result()
+                        game_body, feed_seconds = game_future.result()
+                    except Exception as e:
+                        game_failed(game_id, e, 'download')
+                        progress.update(1)
+                        continue
+                    if toi_body is None or game_body is None:
+                        # Offline and not cached, try again next run
+                        set_job_status(jobs, [game_id], PENDING)
+                        progress.update(1)
+                        continue
+                    metrics.record('fetch', 'shiftcharts', toi_seconds,
+                                   bytes=len(toi_body), game_id=game_id)
+                    metrics.record('fetch', 'feed', feed_seconds,
+                                   bytes=len(game_body), game_id=game_id)
+                    archive.add_game(game_id, game_body, toi_body)
+
+                    if parse_pool is None:
+                        try:
+                            game_parsed(game_id, *parse_game_payloads(
+                                game_id, game_body, toi_body))
+                        except Exception as e:
+                            game_failed(game_id, e, 'parse')
+                        progress.update(1)
+                    else:
+                        parse_future = parse_pool.submit(
+                            parse_game_payloads, game_id, game_body, toi_body)
+                        parsing[parse_future] = game_id
+
+                # Write stage
+                for parse_future in [f for f in parsing if f.done()]:
+                    game_id = parsing.pop(parse_future)
+                    try:
+                        game_tables, timings = parse_future.result()
+                    except Exception as e:
+                        game_failed(game_id, e, 'parse')
+                    else:
+                        game_parsed(game_id, game_tables, timings)
+                    progress.update(1)
+    finally:
+        jobs.close()
+        if parse_pool is not None:
+            parse_pool.shutdown(cancel_futures=True)
+
+
+def get_game_data(workers=FETCH_WORKERS, parse_workers=PARSE_WORKERS):
     import datetime
 
     today = datetime.datetime.today()
 
-    game_schedules = import_data_from_sql('game_schedules')    
-    games = import_data_from_sql('games')
-
-    if games.empty :
-        missing_game_data = game_schedules
-    else:
-        missing_game_data = game_schedules[~game_schedules['game_id'].isin(games['game_id'])]    
-
-    games_sample = missing_game_data[
-        missing_game_data['gameDate'].str[:4].astype(int) > 2005]#.head(5000)
-
-    # Remove future games
-    games_rm_future = missing_game_data[
-        missing_game_data['gameDate'].str[:10] < str(today)[
-        0:10]]
-    
-    get_game_info(games_rm_future)
-    # print('---------------------')
- 
+    ensure_schema()
 
+    # Scheduled games, excluding future games, that are not in games yet
+    games_rm_future = import_data_from_query(
+        missing_games_query, today=str(today)[0:10], now=time.time())
 
+    get_game_info(games_rm_future, workers, parse_workers)
@@ -2,68 +2,60 @@ import logging
 import json
 
 import pandas as pd
-import urllib
-import urllib.request
 import sqlite3
-import sqlalchemy as sa
 
-from settings import DATABASE_NAME
+from concurrent.futures import ThreadPoolExecutor
+
+from settings import DATABASE_NAME, FETCH_WORKERS, NHL_STATS_API_URL
+from misc_functions import (
+    get_json_data_from_link, import_data_from_sql, upsert_into_db)
 
 pd.set_option('display.max_columns', None)
 
-logging.basicConfig(level='INFO')
 logger = logging.getLogger()
 
-# Settings
-engine = sa.create_engine(f'sqlite:///{DATABASE_NAME}')
-
-url_schedule_prefix = 'https://statsapi.web.nhl.com/api/v1/schedule?season='
+url_schedule_prefix = NHL_STATS_API_URL + '/api/v1/schedule?season='
+schedule_cols = ['gamePk', 'link', 'gameType', 'season', 'gameDate']
 
 
 def get_schedule(season_id):
+    '''Returns the games of a season as a list of tuples of schedule_cols'''
     schedule_url = (url_schedule_prefix + season_id)
 
-    with urllib.request.urlopen(schedule_url) as url:
-        schedule_json = json.loads(url.read().decode())
+    schedule_json = get_json_data_from_link(schedule_url)
+    if schedule_json is None:
+        logger.warning(f'No schedule for season {season_id}, not cached')
+        return []
 
-    dates = schedule_json.get('dates')
-    games_df = pd.DataFrame([])
-    # NOTE: I'm sure there's a better/faster way to do this. Collapsing the json?
-    for date in dates:
-        games = date.get('games')
-        for game in games:
-            game_df = pd.DataFrame.from_dict(game, orient='index').T
-            games_df = games_df.append(game_df, ignore_index=True)
-    return games_df
+    return [
+        tuple(game.get(col) for col in schedule_cols)
+        for date in schedule_json.get('dates')
+        for game in date.get('games')]
 
 
 def get_games_schedules_from_seasons(df_season):
-    all_schedules = pd.DataFrame([])
-    for _,row in df_season.iterrows():
-        season_id = row['seasonId']
-        logger.info(f'==={season_id}===')
+    season_ids = list(df_season['seasonId'])
+    all_schedules = []
+    with ThreadPoolExecutor(max_workers=FETCH_WORKERS) as executor:
+        for season_id, season_schedule in zip(
+                season_ids, executor.map(get_schedule, season_ids)):
+            logger.info(f'==={season_id}===')
+            logger.info(f'Number of Games:  {len(season_schedule)}')
 
-        season_schedule = get_schedule(season_id)
-        logger.info(f'Number of Games:  {season_schedule.shape[0]}')
-        
-        season_schedule_selected = season_schedule[[
-            'gamePk', 'link', 'gameType', 'season', 'gameDate']]
-        # season_schedule_selected.reset_index(inplace=True)
+            all_schedules.extend(season_schedule)
 
-        all_schedules = all_schedules.append(
-            season_schedule_selected)
-        
-    return all_schedules
+    return pd.DataFrame(all_schedules, columns=schedule_cols)
 
 
 def get_game_schedules():
 
-    seasons = pd.read_sql_table('seasons', engine)
+    seasons = import_data_from_sql('seasons')
+    if seasons.empty:
+        logger.warning('No seasons to get schedules for')
+        return
 
     all_schedules = get_games_schedules_from_seasons(seasons)
     all_schedules.rename(columns={'gamePk': 'game_id'}, inplace=True)
-    
-    print(all_schedules)
-    all_schedules.to_sql(
-            'game_schedules', engine, if_exists='append', index=False)
+    logger.info(f'Writing {all_schedules.shape[0]} scheduled games')
+    upsert_into_db(all_schedules, 'game_schedules')
 
@@ -0,0 +1,146 @@
+import heapq
+import logging
+
+import pandas as pd
+from tqdm import tqdm
+
+from misc_functions import ensure_schema, import_data_from_query
+from db_writer import BufferedWriter
+from nhl_api.game_archive import season_game_id_range
+
+logger = logging.getLogger()
+
+# Settings
+on_ice_cols = ['game_id', 'event_id', 'player_id', 'team_id', 'is_goalie']
+
+# Games with plays and shifts but no players on ice yet. Games lacking
+# either (e.g. seasons without shiftcharts) never get any and are left out,
+# or every backfill would compute them again.
+games_without_on_ice_query = '''
+    SELECT g.game_id
+    FROM games g
+    WHERE g.game_id >= :low AND g.game_id < :high
+      AND NOT EXISTS (
+        SELECT 1 FROM game_play_on_ice o WHERE o.game_id = g.game_id)
+      AND EXISTS (
+        SELECT 1 FROM game_plays_info p WHERE p.game_id = g.game_id)
+      AND EXISTS (
+        SELECT 1 FROM game_shift_info s WHERE s.game_id = g.game_id)'''
+seasons_query = 'SELECT DISTINCT season FROM games WHERE season IS NOT NULL ORDER BY season'
+season_plays_query = '''
+    SELECT game_id, event_id, event, period, periodTimeSeconds
+    FROM game_plays_info
+    WHERE game_id >= :low AND game_id < :high'''
+season_shifts_query = '''
+    SELECT game_id, player_id, team_id, period, shift_start_seconds, shift_end_seconds
+    FROM game_shift_info
+    WHERE game_id >= :low AND game_id < :high'''
+season_goalies_query = '''
+    SELECT game_id, player_id
+    FROM goalie_game_stats
+    WHERE game_id >= :low AND game_id < :high'''
+
+
+def get_plays_on_ice(game_plays, game_shifts, goalie_ids):
+    '''Maps every play to the players on the ice for both teams.
+
+    Works per period with a sweep over plays and shifts sorted by time: shifts
+    that started by the play's time are pushed on a heap ordered by end time
+    and popped once they have ended, so the heap only ever holds the dozen
+    or so shifts around the play. A player is on the ice for a faceoff if
+    their shift starts at or before it and ends after it; for any other
+    event (goals, penalties, stoppages) if it starts before it and ends at
+    or after it.
+
+    game_plays / game_shifts are rows as built by get_game_plays and
+    get_shift_data. Returns rows of on_ice_cols.'''
+
+    plays_by_period = {}
+    for play in game_plays:
+        time = play.get('periodTimeSeconds')
+        if play.get('period') is None or time is None:
+            continue
+        plays_by_period.setdefault(play['period'], []).append(
+            (time, play['event'] == 'Faceoff', play['event_id'], play['game_id']))
+
+    shifts_by_period = {}
+    for shift in game_shifts:
+        start = shift.get('shift_start_seconds')
+        end = shift.get('shift_end_seconds')
+        # Zero length entries are goal markers, not shifts
+        if start is None or end is None or end <= start:
+            continue
+        shifts_by_period.setdefault(shift['period'], []).append(
+            (start, end, shift['player_id'], shift.get('team_id')))
+
+    on_ice = []
+    for period, plays in plays_by_period.items():
+        shifts = sorted(shifts_by_period.get(period, []))
+        plays.sort()
+
+        active = []
+        next_shift = 0
+        for time, is_faceoff, event_id, game_id in plays:
+            while next_shift < len(shifts) and shifts[next_shift][0] <= time:
+                start, end, player_id, team_id = shifts[next_shift]
+                heapq.heappush(active, (end, start, player_id, team_id))
+                next_shift += 1
+            while active and active[0][0] < time:
+                heapq.heappop(active)
+
+            players = {}
+            for end, start, player_id, team_id in active:
+                if is_faceoff and end == time:
+                    continue
+                if not is_faceoff and start == time:
+                    continue
+                players[player_id] = team_id
+
+            on_ice.extend(
+                {'game_id': game_id, 'event_id': event_id,
+                 'player_id': player_id, 'team_id': team_id,
+                 'is_goalie': int(player_id in goalie_ids)}
+                for player_id, team_id in players.items())
+
+    return on_ice
+
+
+def build_on_ice_table(seasons=None):
+    '''Backfills game_play_on_ice for games already in the database that do
+    not have it yet, one season at a time. seasons e.g. ['20192020'],
+    default every season with games.'''
+
+    ensure_schema()
+    if seasons is None:
+        seasons = import_data_from_query(seasons_query)['season'].tolist()
+
+    with BufferedWriter(only_tables=['game_play_on_ice']) as writer:
+        for season in seasons:
+            low, high = season_game_id_range(season)
+            game_ids = import_data_from_query(
+                games_without_on_ice_query, low=low, high=high)['game_id']
+            if game_ids.empty:
+                continue
+
+            plays = import_data_from_query(
+                season_plays_query, low=low, high=high
+            ).dropna(subset=['period', 'periodTimeSeconds'])
+            shifts = import_data_from_query(
+                season_shifts_query, low=low, high=high
+            ).dropna(subset=['period', 'shift_start_seconds', 'shift_end_seconds'])
+            goalies = import_data_from_query(season_goalies_query, low=low, high=high)
+
+            plays_by_game = dict(list(plays.groupby('game_id')))
+            shifts_by_game = dict(list(shifts.groupby('game_id')))
+            goalies_by_game = goalies.groupby('game_id')['player_id'].agg(set)
+            empty = pd.DataFrame([])
+
+            logger.info(f'Building players on ice for {len(game_ids)} games in {season}')
+            for game_id in tqdm(game_ids):
+                game_plays = plays_by_game.get(game_id, empty).to_dict('records')
+                game_shifts = shifts_by_game.get(game_id, empty).to_dict('records')
+                goalie_ids = goalies_by_game.get(game_id, set())
+
+                writer.add_game(game_id, {
+                    'game_play_on_ice': get_plays_on_ice(
+                        game_plays, game_shifts, goalie_ids)})
@@ -1,35 +1,32 @@
 import pandas as pd
-import urllib.request
 import json
 import logging
 
 import sqlite3
-import sqlalchemy as sa
 
-from settings import DATABASE_NAME
+from settings import DATABASE_NAME, NHL_STATS_API_URL
+from misc_functions import get_engine, get_json_data_from_link
 
-logging.basicConfig(level='INFO')
 logger = logging.getLogger()
 
-# Settings
-engine = sa.create_engine(f'sqlite:///{DATABASE_NAME}')
-
-url_seasons = 'https://statsapi.web.nhl.com/api/v1/seasons'
+url_seasons = NHL_STATS_API_URL + '/api/v1/seasons'
 
 
 # Query the season
 
 def get_all_seasons():
-    with urllib.request.urlopen(url_seasons) as url:
-        seasons_json = json.loads(url.read().decode())
-        
+    seasons_json = get_json_data_from_link(url_seasons)
+    if seasons_json is None:
+        logger.warning('No season data, not cached')
+        return pd.DataFrame()
+
     seasons_df = pd.DataFrame(seasons_json.get('seasons'))
     logger.info('Obtained all season data')
     return seasons_df
 
 
 def create_seasons_table(df):
-    df.to_sql('seasons',engine, if_exists='replace', index=False)
+    df.to_sql('seasons', get_engine(), if_exists='replace', index=False)
     logger.info('Injected Seasons table into DB')
 
 
@@ -37,6 +34,8 @@ def create_seasons_table(df):
 def get_seasons():
 
     seasons_df = get_all_seasons()
+    if seasons_df.empty:
+        return
 
     create_seasons_table(seasons_df)
     
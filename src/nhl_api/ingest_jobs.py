@@ -0,0 +1,123 @@
+import time
+import logging
+
+from settings import (
+    JOB_MAX_ATTEMPTS,
+    JOB_RETRY_BACKOFF_SECONDS,
+    JOB_RETRY_BACKOFF_MAX_SECONDS)
+from misc_functions import (
+    backoff_delay,
+    connect_db,
+    ensure_schema,
+    import_data_from_query)
+
+logger = logging.getLogger()
+
+PENDING = 'pending'
+IN_FLIGHT = 'in_flight'
+DONE = 'done'
+FAILED = 'failed'
+DEAD = 'dead'
+
+dead_letter_query = '''
+    SELECT j.game_id, s.link, j.attempts, j.last_error, j.updated_at
+    FROM ingest_jobs j
+    LEFT JOIN game_schedules s ON s.game_id = j.game_id
+    WHERE j.status = 'dead'
+    ORDER BY j.game_id'''
+
+
+def reset_in_flight_jobs(conn):
+    '''Games left in flight by a run that crashed go back to pending'''
+    with conn:
+        reset = conn.execute(
+            'UPDATE ingest_jobs SET status = ?, updated_at = ? WHERE status = ?',
+            (PENDING, time.time(), IN_FLIGHT)).rowcount
+    if reset:
+        logger.info(f'Reset {reset} games left in flight by an earlier run')
+
+
+def set_job_status(conn, game_ids, status):
+    '''Sets the status of game_ids, creating their jobs if needed'''
+    now = time.time()
+    with conn:
+        conn.executemany(
+            '''INSERT INTO ingest_jobs (game_id, status, updated_at) VALUES (?, ?, ?)
+               ON CONFLICT (game_id) DO UPDATE
+               SET status = excluded.status, updated_at = excluded.updated_at''',
+            [(game_id, status, now) for game_id in game_ids])
+
+
+def mark_job_failed(conn, game_id, error):
+    '''Counts a failed attempt. The game is retried by a later run once its
+    backoff has passed, or dead-lettered after JOB_MAX_ATTEMPTS attempts.
+    Returns the new status.'''
+
+    row = conn.execute(
+        'SELECT attempts FROM ingest_jobs WHERE game_id = ?', (game_id,)).fetchone()
+    attempts = (row[0] if row else 0) + 1
+    now = time.time()
+
+    if attempts >= JOB_MAX_ATTEMPTS:
+        status, next_attempt_at = DEAD, None
+        logger.error(f'Game {game_id} failed {attempts} times, dead-lettered: {error}')
+    else:
+        status = FAILED
+        next_attempt_at = now + backoff_delay(
+            attempts, JOB_RETRY_BACKOFF_SECONDS, JOB_RETRY_BACKOFF_MAX_SECONDS)
+
+    with conn:
+        conn.execute(
+            '''INSERT INTO ingest_jobs
+               (game_id, status, attempts, last_error, next_attempt_at, updated_at)
+               VALUES (?, ?, ?, ?, ?, ?)
+               ON CONFLICT (game_id) DO UPDATE
+               SET status = excluded.status, attempts = excluded.attempts,
+                   last_error = excluded.last_error,
+                   next_attempt_at = excluded.next_attempt_at,
+                   updated_at = excluded.updated_at''',
+            (game_id, status, attempts, str(error)[:1000], next_attempt_at, now))
+    return status
+
+
+def done_job_row(game_id):
+    '''The ingest_jobs row of a game written successfully. It goes through
+    the BufferedWriter with the game's other tables, so the game's rows and
+    its done status are committed in the same transaction.'''
+    return [{'game_id': game_id, 'status': DONE, 'attempts': 0,
+             'last_error': None, 'next_attempt_at': None,
+             'updated_at': time.time()}]
+
+
+def get_dead_letter_games():
+    '''Games given up on, with their last error'''
+    ensure_schema()
+    return import_data_from_query(dead_letter_query)
+
+
+def retry_dead_letter_games(game_ids=None):
+    '''Gives dead-lettered games (all, or just game_ids) a fresh set of
+    attempts and ingests them again'''
+    from nhl_api.get_game_data import get_game_info
+
+    dead = get_dead_letter_games()
+    if game_ids is not None:
+        dead = dead[dead['game_id'].isin(game_ids)]
+    dead = dead.dropna(subset=['link'])
+    if dead.empty:
+        logger.info('No dead-lettered games to retry')
+        return
+
+    conn = connect_db()
+    try:
+        with conn:
+            conn.executemany(
+                '''UPDATE ingest_jobs
+                   SET status = ?, attempts = 0, next_attempt_at = NULL
+                   WHERE game_id = ?''',
+                [(PENDING, int(game_id)) for game_id in dead['game_id']])
+    finally:
+        conn.close()
+
+    logger.info(f'Retrying {dead.shape[0]} dead-lettered games')
+    get_game_info(dead)
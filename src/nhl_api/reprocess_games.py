@@ -0,0 +1,95 @@
+import zlib
+import logging
+from concurrent.futures import wait, FIRST_COMPLETED
+
+from tqdm import tqdm
+
+from settings import PARSE_WORKERS, PIPELINE_DEPTH
+from db_writer import BufferedWriter
+from metrics import IngestMetrics
+from nhl_api.game_archive import (
+    connect_archive,
+    get_archived_game_ids,
+    get_archived_payloads)
+from nhl_api.get_game_data import parse_game_payloads, start_parse_pool
+
+logger = logging.getLogger()
+
+
+def parse_archived_game(game_id, payloads):
+    '''Decompresses and parses one archived game, in a parse worker.
+    Returns the tables and the parse timings, as parse_game_payloads.'''
+    return parse_game_payloads(
+        game_id,
+        zlib.decompress(payloads['game']),
+        zlib.decompress(payloads['toi']))
+
+
+def reprocess(tables=None, seasons=None, parse_workers=PARSE_WORKERS):
+    '''Rebuilds derived game tables from the raw feed archive, without any
+    network access. Use after changing the extraction in get_game_data.
+
+    tables: table names to rewrite (default: every table parse_game builds);
+        other tables are left untouched.
+    seasons: e.g. ['20192020'] or [2019] (default: everything archived).'''
+
+    archive = connect_archive()
+    game_ids = get_archived_game_ids(archive, seasons)
+    logger.info(f'Reprocessing {len(game_ids)} archived games')
+
+    parse_pool = start_parse_pool(parse_workers)
+    parsing = {}
+    try:
+        with IngestMetrics('reprocess') as metrics, \
+                BufferedWriter(only_tables=tables, metrics=metrics) as writer, \
+                tqdm(total=len(game_ids)) as progress:
+            for game_id in game_ids:
+                payloads = get_archived_payloads(archive, game_id)
+                if 'toi' not in payloads:
+                    logger.warning(f'No archived shiftchart for game {game_id}')
+                    progress.update(1)
+                    continue
+
+                if parse_pool is None:
+                    write_parsed_game(
+                        game_id, lambda: parse_archived_game(game_id, payloads),
+                        writer, metrics, progress)
+                    continue
+
+                parsing[parse_pool.submit(parse_archived_game, game_id, payloads)] = game_id
+                if len(parsing) >= PIPELINE_DEPTH:
+                    done, _ = wait(parsing, return_when=FIRST_COMPLETED)
+                    write_parsed_games(done, parsing, writer, metrics, progress)
+
+            write_parsed_games(wait(parsing)[0], parsing, writer, metrics, progress)
+    finally:
+        archive.close()
+        if parse_pool is not None:
+            parse_pool.shutdown(cancel_futures=True)
+
+
+def write_parsed_game(game_id, parse, writer, metrics, progress):
+    '''Writes the tables parse() returns for game_id. A game that fails to
+    parse is logged and skipped; write errors are raised, the writer keeps
+    a batch that failed to flush and would only fail on it again.'''
+    try:
+        game_tables, timings = parse()
+    except Exception as e:
+        logger.error(f'Could not reprocess game {game_id}: {e}')
+        metrics.record('failed', 'parse', game_id=game_id)
+    else:
+        metrics.record_timings(game_id, 'parse', timings)
+        writer.add_game(game_id, game_tables)
+        metrics.game_done()
+    progress.update(1)
+
+
+def write_parsed_games(done, parsing, writer, metrics, progress):
+    for parse_future in done:
+        game_id = parsing.pop(parse_future)
+        write_parsed_game(game_id, parse_future.result, writer, metrics, progress)
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level='INFO')
+    reprocess()
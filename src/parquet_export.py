@@ -0,0 +1,272 @@
+'''Season-partitioned Parquet copies of the largest tables, for analysis
+that reads a season or a team at a time without going through SQLite:
+
+    data/parquet/<table>/season=20192020/part-0.parquet
+
+Files are zstd compressed; text columns are dictionary encoded and read
+back as categoricals. Rows are sorted by game type, team and game, so the
+row group statistics let filters on those skip most of a season.
+
+pyarrow is only needed here and is imported on first use.
+'''
+import os
+import json
+import shutil
+import logging
+
+import pandas as pd
+
+from settings import (
+    DATABASE_NAME,
+    PARQUET_PATH,
+    PARQUET_ROW_GROUP_SIZE,
+    PARQUET_COMPRESSION)
+from misc_functions import connect_db, ensure_schema
+
+logger = logging.getLogger()
+
+# Seasons of the game tables: game count and the last time one of their
+# games was ingested. reprocess_games does not touch ingest_jobs, export
+# with force=True after reprocessing.
+game_partitions_query = '''
+    SELECT g.season, COUNT(*), MAX(j.updated_at)
+    FROM games g
+    LEFT JOIN ingest_jobs j ON j.game_id = g.game_id
+    GROUP BY g.season'''
+
+game_rows_query = '''
+    SELECT t.*, g.type AS game_type
+    FROM {table_name} t
+    JOIN games g ON g.game_id = t.game_id
+    WHERE g.season = :season'''
+
+# MoneyPuck seasons are start years, partitions use the 20192020 form.
+# Each season is replaced as a whole when reloaded, so its row count
+# changes with it.
+shot_partitions_query = '''
+    SELECT CAST(season AS TEXT) || CAST(season + 1 AS TEXT), COUNT(*)
+    FROM shot_data_advanced
+    GROUP BY season'''
+
+shot_rows_query = '''
+    SELECT *, CASE WHEN isPlayoffGame = 1 THEN 'P' ELSE 'R' END AS game_type
+    FROM shot_data_advanced
+    WHERE season = CAST(substr(:season, 1, 4) AS INTEGER)'''
+
+# Exported tables: the queries giving each season's fingerprint and rows,
+# and the column read_parquet_table filters teams on. Shot coordinates and
+# probabilities are stored as float32, as compact_shot_dtypes loads them.
+PARQUET_TABLES = {
+    'shot_data_advanced': {
+        'partitions': shot_partitions_query,
+        'rows': shot_rows_query,
+        'team_column': 'teamCode',
+        'float32': True,
+    },
+    'game_plays_info': {
+        'partitions': game_partitions_query,
+        'rows': game_rows_query,
+        'team_column': 'team_id',
+    },
+    'game_shift_info': {
+        'partitions': game_partitions_query,
+        'rows': game_rows_query,
+        'team_column': 'team_id',
+    },
+    'skater_game_stats': {
+        'partitions': game_partitions_query,
+        'rows': game_rows_query,
+        'team_column': 'team_id',
+    },
+}
+
+
+def require_pyarrow():
+    try:
+        import pyarrow as pa
+        import pyarrow.dataset as ds
+        import pyarrow.parquet as pq
+    except ImportError as e:
+        raise ImportError(
+            'The Parquet export needs pyarrow: pip install pyarrow') from e
+    return pa, ds, pq
+
+
+def season_key(season):
+    '''20192020, '20192020' or the MoneyPuck 2019 to '20192020' '''
+    season = str(season)
+    if len(season) == 4:
+        season = f'{season}{int(season) + 1}'
+    return season
+
+
+def _read_meta(table_path):
+    meta_file = os.path.join(table_path, '_meta.json')
+    if not os.path.exists(meta_file):
+        return {}
+    with open(meta_file) as f:
+        return json.load(f)
+
+
+def _write_meta(table_path, meta):
+    meta_file = os.path.join(table_path, '_meta.json')
+    with open(meta_file + '.tmp', 'w') as f:
+        json.dump(meta, f)
+    os.replace(meta_file + '.tmp', meta_file)
+
+
+def to_arrow_table(df, spec):
+    '''The partition's rows as the Arrow table written: season dropped (the
+    partition holds it), sorted, text dictionary encoded'''
+    pa, ds, pq = require_pyarrow()
+
+    table = pa.Table.from_pandas(
+        df.drop(columns=['season'], errors='ignore'), preserve_index=False)
+    table = table.sort_by([
+        ('game_type', 'ascending'),
+        (spec['team_column'], 'ascending'),
+        ('game_id', 'ascending')])
+
+    fields = []
+    for field in table.schema:
+        if pa.types.is_string(field.type) or pa.types.is_large_string(field.type):
+            field = field.with_type(pa.dictionary(pa.int32(), pa.string()))
+        elif spec.get('float32') and pa.types.is_float64(field.type):
+            field = field.with_type(pa.float32())
+        fields.append(field)
+    # Without the pandas metadata columns are read back by their Arrow
+    # types, dictionaries as categoricals
+    return table.cast(pa.schema(fields)).replace_schema_metadata(None)
+
+
+def write_partition(conn, table_name, season, table_path):
+    '''Writes one season of table_name next to its partition, then swaps it
+    in, so readers never see a partly written season. Returns the row
+    count.'''
+    pa, ds, pq = require_pyarrow()
+    spec = PARQUET_TABLES[table_name]
+
+    # Read with Arrow dtypes so integer columns stay integers in seasons
+    # where they have nulls
+    df = pd.read_sql_query(
+        spec['rows'].format(table_name=table_name), conn,
+        params={'season': season}, dtype_backend='pyarrow')
+    table = to_arrow_table(df, spec)
+    del df
+
+    partition_path = os.path.join(table_path, f'season={season}')
+    tmp_path = os.path.join(table_path, f'.season={season}.tmp')
+    old_path = os.path.join(table_path, f'.season={season}.old')
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    os.makedirs(tmp_path)
+    pq.write_table(
+        table, os.path.join(tmp_path, 'part-0.parquet'),
+        row_group_size=PARQUET_ROW_GROUP_SIZE, compression=PARQUET_COMPRESSION)
+
+    if os.path.isdir(partition_path):
+        os.replace(partition_path, old_path)
+    os.replace(tmp_path, partition_path)
+    shutil.rmtree(old_path, ignore_errors=True)
+    return table.num_rows
+
+
+def export_parquet(tables=None, seasons=None, force=False,
+                   db_file=DATABASE_NAME, path=PARQUET_PATH):
+    '''Exports tables (default all of PARQUET_TABLES) to path, one Parquet
+    partition per season.
+
+    Only seasons whose fingerprint changed since they were last exported
+    are written again, unless force. seasons limits the export to those.
+    Returns the number of partitions written.'''
+
+    require_pyarrow()
+    ensure_schema(db_file)
+    wanted = None if seasons is None else {season_key(s) for s in seasons}
+
+    written = 0
+    conn = connect_db(db_file)
+    try:
+        for table_name in tables or PARQUET_TABLES:
+            spec = PARQUET_TABLES[table_name]
+            exists = conn.execute(
+                "SELECT 1 FROM sqlite_master WHERE name = ? AND type IN ('table', 'view')",
+                (table_name,)).fetchone()
+            if not exists:
+                logger.warning(f'No {table_name} to export')
+                continue
+
+            table_path = os.path.join(path, table_name)
+            os.makedirs(table_path, exist_ok=True)
+            meta = _read_meta(table_path)
+
+            for season, *fingerprint in conn.execute(spec['partitions']).fetchall():
+                if season is None or (wanted is not None and season not in wanted):
+                    continue
+                exported = meta.get(season)
+                if (not force and exported and exported['fingerprint'] == fingerprint
+                        and os.path.isdir(os.path.join(table_path, f'season={season}'))):
+                    continue
+
+                rows = write_partition(conn, table_name, season, table_path)
+                # Saved after every partition, so an interrupted export
+                # keeps the seasons it finished
+                meta[season] = {'fingerprint': fingerprint, 'rows': rows}
+                _write_meta(table_path, meta)
+                written += 1
+                logger.info(f'Exported {rows} rows of {table_name} for {season}')
+    finally:
+        conn.close()
+
+    logger.info(f'Parquet export: {written} partitions written')
+    return written
+
+
+def read_parquet_table(table_name, columns=None, seasons=None, teams=None,
+                       game_types=None, path=PARQUET_PATH):
+    '''Reads an exported table as a dataframe, only the given columns and
+    the rows of the given seasons, teams (team_id, or teamCode for shots)
+    and game types ('R', 'P').
+
+    Only the files of the wanted seasons are opened, and team and game
+    type filters skip the row groups that cannot match.'''
+    pa, ds, pq = require_pyarrow()
+    spec = PARQUET_TABLES[table_name]
+    table_path = os.path.join(path, table_name)
+    wanted = None if seasons is None else {season_key(s) for s in seasons}
+
+    files = []
+    if os.path.isdir(table_path):
+        for entry in sorted(os.listdir(table_path)):
+            if not entry.startswith('season='):
+                continue
+            if wanted is not None and entry[len('season='):] not in wanted:
+                continue
+            partition_path = os.path.join(table_path, entry)
+            files += [os.path.join(partition_path, name)
+                      for name in sorted(os.listdir(partition_path))
+                      if name.endswith('.parquet')]
+    if not files:
+        return pd.DataFrame(columns=columns or [])
+
+    # A column with no values in some season was written as nulls there
+    schema = pa.unify_schemas([pq.read_schema(f) for f in files])
+    schema = schema.append(pa.field('season', pa.string()))
+    dataset = ds.dataset(
+        files, schema=schema, format='parquet',
+        partitioning=ds.partitioning(
+            pa.schema([('season', pa.string())]), flavor='hive'),
+        partition_base_dir=table_path)
+
+    conditions = []
+    if wanted is not None:
+        conditions.append(ds.field('season').isin(sorted(wanted)))
+    if teams is not None:
+        conditions.append(ds.field(spec['team_column']).isin(list(teams)))
+    if game_types is not None:
+        conditions.append(ds.field('game_type').isin(list(game_types)))
+    condition = None
+    for expression in conditions:
+        condition = expression if condition is None else condition & expression
+
+    table = dataset.to_table(columns=columns, filter=condition)
+    return table.to_pandas(split_blocks=True, self_destruct=True)
@@ -0,0 +1,722 @@
+import logging
+
+logger = logging.getLogger()
+
+# Typed tables, created (or rebuilt from an untyped to_sql table) by
+# migration 1. Keep the column lists in step with the extractors.
+TABLES = {
+    'game_schedules': '''
+        CREATE TABLE game_schedules (
+            game_id INTEGER PRIMARY KEY,
+            link TEXT,
+            gameType TEXT,
+            season TEXT,
+            gameDate TEXT)''',
+    'games': '''
+        CREATE TABLE games (
+            game_id INTEGER PRIMARY KEY,
+            season TEXT,
+            type TEXT,
+            date_time_GMT TEXT,
+            away_team_id INTEGER,
+            home_team_id INTEGER,
+            away_goals INTEGER,
+            home_goals INTEGER,
+            venue TEXT,
+            outcome TEXT)''',
+    'team_game_info': '''
+        CREATE TABLE team_game_info (
+            game_id INTEGER NOT NULL,
+            team_id INTEGER NOT NULL,
+            HoA TEXT,
+            winner TEXT,
+            settled_in TEXT,
+            head_coach TEXT,
+            goals INTEGER,
+            shots INTEGER,
+            hits INTEGER,
+            pim INTEGER,
+            powerPlayOpportunities INTEGER,
+            powerPlayGoals INTEGER,
+            faceOffWinPercentage REAL,
+            giveaways INTEGER,
+            takeaways INTEGER,
+            blocked INTEGER,
+            startRinkSide TEXT,
+            PRIMARY KEY (game_id, team_id))''',
+    'game_players': '''
+        CREATE TABLE game_players (
+            player_id INTEGER NOT NULL,
+            game_id INTEGER NOT NULL,
+            PRIMARY KEY (game_id, player_id))''',
+    'skater_game_stats': '''
+        CREATE TABLE skater_game_stats (
+            player_id INTEGER NOT NULL,
+            timeOnIce TEXT,
+            assists INTEGER,
+            goals INTEGER,
+            shots INTEGER,
+            hits INTEGER,
+            powerPlayGoals INTEGER,
+            powerPlayAssists INTEGER,
+            penaltyMinutes INTEGER,
+            faceOffWins INTEGER,
+            faceoffTaken INTEGER,
+            takeaways INTEGER,
+            giveaways INTEGER,
+            shortHandedGoals INTEGER,
+            shortHandedAssists INTEGER,
+            blocked INTEGER,
+            plusMinus INTEGER,
+            evenTimeOnIce TEXT,
+            shortHandedTimeOnIce TEXT,
+            powerPlayTimeOnIce TEXT,
+            is_home INTEGER,
+            team_id INTEGER,
+            game_id INTEGER NOT NULL,
+            PRIMARY KEY (game_id, player_id))''',
+    'goalie_game_stats': '''
+        CREATE TABLE goalie_game_stats (
+            player_id INTEGER NOT NULL,
+            timeOnIce TEXT,
+            assists INTEGER,
+            goals INTEGER,
+            shots INTEGER,
+            saves INTEGER,
+            pim INTEGER,
+            powerPlaySaves INTEGER,
+            shortHandedSaves INTEGER,
+            evenSaves INTEGER,
+            shortHandedShotsAgainst INTEGER,
+            evenShotsAgainst INTEGER,
+            powerPlayShotsAgainst INTEGER,
+            decision TEXT,
+            savePercentage REAL,
+            powerPlaySavePercentage REAL,
+            evenStrengthSavePercentage REAL,
+            is_home INTEGER,
+            team_id INTEGER,
+            game_id INTEGER NOT NULL,
+            PRIMARY KEY (game_id, player_id))''',
+    'scratches_game_stats': '''
+        CREATE TABLE scratches_game_stats (
+            player_id INTEGER NOT NULL,
+            team_id INTEGER,
+            game_id INTEGER NOT NULL,
+            PRIMARY KEY (game_id, player_id))''',
+    'game_plays_info': '''
+        CREATE TABLE game_plays_info (
+            play_id TEXT PRIMARY KEY,
+            game_id INTEGER NOT NULL,
+            event_id INTEGER NOT NULL,
+            team_id INTEGER,
+            team_id_against INTEGER,
+            event TEXT,
+            secondaryType TEXT,
+            strength TEXT,
+            gameWinningGoal INTEGER,
+            emptyNet INTEGER,
+            penaltySeverity TEXT,
+            penaltyMinutes INTEGER,
+            x REAL,
+            y REAL,
+            period INTEGER,
+            periodType TEXT,
+            periodTime TEXT,
+            periodTimeRemaining TEXT,
+            dateTime TEXT,
+            goals_home INTEGER,
+            goals_away INTEGER,
+            description TEXT)''',
+    'game_play_players': '''
+        CREATE TABLE game_play_players (
+            play_id TEXT NOT NULL,
+            game_id INTEGER NOT NULL,
+            player_id INTEGER,
+            player_type TEXT,
+            PRIMARY KEY (play_id, player_id, player_type))''',
+    'game_shift_info': '''
+        CREATE TABLE game_shift_info (
+            game_id INTEGER NOT NULL,
+            player_id INTEGER NOT NULL,
+            period INTEGER,
+            shift_start TEXT,
+            shift_end TEXT)''',
+}
+
+INDEXES = [
+    'CREATE INDEX IF NOT EXISTS idx_game_schedules_gameDate ON game_schedules (gameDate, game_id)',
+    'CREATE INDEX IF NOT EXISTS idx_games_season ON games (season, type, game_id)',
+    'CREATE INDEX IF NOT EXISTS idx_team_game_info_team ON team_game_info (team_id, game_id)',
+    'CREATE INDEX IF NOT EXISTS idx_game_players_player ON game_players (player_id, game_id)',
+    'CREATE INDEX IF NOT EXISTS idx_skater_game_stats_player ON skater_game_stats (player_id, game_id)',
+    'CREATE INDEX IF NOT EXISTS idx_goalie_game_stats_player ON goalie_game_stats (player_id, game_id)',
+    'CREATE INDEX IF NOT EXISTS idx_game_plays_info_game ON game_plays_info (game_id, event_id)',
+    'CREATE INDEX IF NOT EXISTS idx_game_plays_info_event ON game_plays_info (event, game_id)',
+    'CREATE INDEX IF NOT EXISTS idx_game_play_players_game ON game_play_players (game_id)',
+    'CREATE INDEX IF NOT EXISTS idx_game_play_players_player ON game_play_players (player_id, play_id)',
+    'CREATE INDEX IF NOT EXISTS idx_game_shift_info_game ON game_shift_info (game_id, player_id, period)',
+]
+
+
+# Entity tables, created by migration 2
+ENTITY_TABLES = {
+    'player_info': '''
+        CREATE TABLE player_info (
+            player_id INTEGER PRIMARY KEY,
+            firstName TEXT,
+            lastName TEXT,
+            nationality TEXT,
+            birthCity TEXT,
+            position TEXT,
+            birthDate TEXT,
+            birthStateProvince TEXT,
+            height TEXT,
+            weight INTEGER,
+            shootsCatches TEXT)''',
+    'team_info': '''
+        CREATE TABLE team_info (
+            team_id INTEGER PRIMARY KEY,
+            name TEXT,
+            venue TEXT,
+            abbreviation TEXT,
+            teamName TEXT,
+            locationName TEXT,
+            firstYearOfPlay TEXT,
+            division TEXT,
+            conference TEXT,
+            franchise TEXT,
+            franchise_id INTEGER,
+            shortName TEXT,
+            officialSiteUrl TEXT,
+            active INTEGER)''',
+}
+
+
+def get_columns(conn, table_name):
+    return [row[1] for row in conn.execute(f'PRAGMA table_info("{table_name}")')]
+
+
+def create_table(conn, table_name, ddl):
+    '''Creates table_name from ddl. A table that already exists (e.g. made
+    implicitly by to_sql) is rebuilt, keeping the columns both share and
+    dropping rows that duplicate a primary key or leave a NOT NULL column
+    empty. How many were dropped is logged.'''
+
+    existing = get_columns(conn, table_name)
+    if not existing:
+        conn.execute(ddl)
+        return
+
+    logger.info(f'Rebuilding {table_name} with typed schema')
+    conn.execute(f'ALTER TABLE "{table_name}" RENAME TO "_{table_name}_old"')
+    conn.execute(ddl)
+    common = ', '.join(
+        f'"{column}"' for column in get_columns(conn, table_name)
+        if column in existing)
+    old_rows = conn.execute(f'SELECT COUNT(*) FROM "_{table_name}_old"').fetchone()[0]
+    kept = conn.execute(
+        f'INSERT OR IGNORE INTO "{table_name}" ({common}) '
+        f'SELECT {common} FROM "_{table_name}_old"').rowcount
+    if kept < old_rows:
+        logger.warning(
+            f'Dropped {old_rows - kept} of {old_rows} {table_name} rows '
+            f'duplicating a primary key or missing a required value')
+    conn.execute(f'DROP TABLE "_{table_name}_old"')
+
+
+def typed_tables(conn):
+    for table_name, ddl in TABLES.items():
+        create_table(conn, table_name, ddl)
+    for index in INDEXES:
+        conn.execute(index)
+
+
+def entity_tables(conn):
+    for table_name, ddl in ENTITY_TABLES.items():
+        create_table(conn, table_name, ddl)
+
+
+def http_validators(conn):
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS http_validators (
+            url TEXT PRIMARY KEY,
+            etag TEXT,
+            last_modified TEXT)''')
+
+
+def plays_on_ice(conn):
+    if 'team_id' not in get_columns(conn, 'game_shift_info'):
+        conn.execute('ALTER TABLE game_shift_info ADD COLUMN team_id INTEGER')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS game_play_on_ice (
+            game_id INTEGER NOT NULL,
+            event_id INTEGER NOT NULL,
+            player_id INTEGER NOT NULL,
+            team_id INTEGER,
+            is_goalie INTEGER,
+            PRIMARY KEY (game_id, event_id, player_id))''')
+    conn.execute(
+        'CREATE INDEX IF NOT EXISTS idx_game_play_on_ice_player '
+        'ON game_play_on_ice (player_id, game_id)')
+
+
+# Integer second columns derived from "MM:SS" text columns, per table:
+# (new column, source column, period column for game seconds or None)
+SECONDS_COLUMNS = {
+    'skater_game_stats': [
+        ('timeOnIceSeconds', 'timeOnIce', None),
+        ('evenTimeOnIceSeconds', 'evenTimeOnIce', None),
+        ('shortHandedTimeOnIceSeconds', 'shortHandedTimeOnIce', None),
+        ('powerPlayTimeOnIceSeconds', 'powerPlayTimeOnIce', None),
+    ],
+    'goalie_game_stats': [
+        ('timeOnIceSeconds', 'timeOnIce', None),
+    ],
+    'game_plays_info': [
+        ('periodTimeSeconds', 'periodTime', None),
+        ('periodTimeRemainingSeconds', 'periodTimeRemaining', None),
+        ('gameSeconds', 'periodTime', 'period'),
+    ],
+    'game_shift_info': [
+        ('shift_start_seconds', 'shift_start', None),
+        ('shift_end_seconds', 'shift_end', None),
+        ('shift_start_game_seconds', 'shift_start', 'period'),
+        ('shift_end_game_seconds', 'shift_end', 'period'),
+    ],
+}
+
+
+def seconds_sql(column):
+    return (
+        f'CAST(substr("{column}", 1, instr("{column}", \':\') - 1) AS INTEGER) * 60 + '
+        f'CAST(substr("{column}", instr("{column}", \':\') + 1) AS INTEGER)')
+
+
+def time_seconds(conn):
+    '''Adds the integer second columns and backfills them in bulk'''
+    for table_name, columns in SECONDS_COLUMNS.items():
+        existing = get_columns(conn, table_name)
+        assignments = []
+        for column, source, period in columns:
+            if column not in existing:
+                conn.execute(
+                    f'ALTER TABLE "{table_name}" ADD COLUMN "{column}" INTEGER')
+            value = seconds_sql(source)
+            if period is not None:
+                value = f'("{period}" - 1) * 1200 + {value}'
+            assignments.append(
+                f'"{column}" = CASE WHEN "{source}" LIKE \'%:%\' THEN {value} END')
+        conn.execute(f'UPDATE "{table_name}" SET {", ".join(assignments)}')
+
+    conn.execute(
+        'CREATE INDEX IF NOT EXISTS idx_game_plays_info_seconds '
+        'ON game_plays_info (game_id, gameSeconds)')
+    conn.execute(
+        'CREATE INDEX IF NOT EXISTS idx_game_shift_info_seconds '
+        'ON game_shift_info (game_id, shift_start_game_seconds, shift_end_game_seconds)')
+
+
+def player_season_features(conn):
+    '''Materialized player-season features, plus the dirty tables that
+    record which player-seasons need recomputing. Triggers mark a player's
+    game whenever its boxscore rows are written or removed; games already
+    stored are marked by the migration.'''
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS player_season_features (
+            player_id INTEGER NOT NULL,
+            season TEXT NOT NULL,
+            game_type TEXT NOT NULL,
+            is_goalie INTEGER NOT NULL,
+            games_played INTEGER,
+            toi_seconds INTEGER,
+            even_toi_seconds INTEGER,
+            pp_toi_seconds INTEGER,
+            sh_toi_seconds INTEGER,
+            goals INTEGER,
+            assists INTEGER,
+            points INTEGER,
+            shots INTEGER,
+            hits INTEGER,
+            blocked INTEGER,
+            takeaways INTEGER,
+            giveaways INTEGER,
+            penalty_minutes INTEGER,
+            plus_minus INTEGER,
+            pp_goals INTEGER,
+            pp_assists INTEGER,
+            sh_goals INTEGER,
+            sh_assists INTEGER,
+            faceoff_wins INTEGER,
+            faceoffs_taken INTEGER,
+            saves INTEGER,
+            shots_against INTEGER,
+            goals_against INTEGER,
+            wins INTEGER,
+            save_pct REAL,
+            xgoals REAL,
+            game_score REAL,
+            high_danger_shots REAL,
+            on_ice_xgoals_pct REAL,
+            on_ice_corsi_pct REAL,
+            on_ice_fenwick_pct REAL,
+            goals_saved_above_expected REAL,
+            updated_at REAL NOT NULL,
+            PRIMARY KEY (player_id, season, game_type))''')
+    conn.execute(
+        'CREATE INDEX IF NOT EXISTS idx_player_season_features_season '
+        'ON player_season_features (season, game_type)')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS player_season_dirty (
+            player_id INTEGER NOT NULL,
+            game_id INTEGER NOT NULL,
+            PRIMARY KEY (player_id, game_id)) WITHOUT ROWID''')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS player_season_dirty_seasons (
+            season TEXT NOT NULL,
+            game_type TEXT NOT NULL,
+            PRIMARY KEY (season, game_type)) WITHOUT ROWID''')
+
+    for table_name in ['skater_game_stats', 'goalie_game_stats']:
+        for action, row in [('INSERT', 'NEW'), ('DELETE', 'OLD')]:
+            conn.execute(f'''
+                CREATE TRIGGER IF NOT EXISTS trg_{table_name}_{action.lower()}_dirty
+                AFTER {action} ON {table_name}
+                BEGIN
+                    INSERT OR IGNORE INTO player_season_dirty (player_id, game_id)
+                    VALUES ({row}.player_id, {row}.game_id);
+                END''')
+
+    # Boxscore rows stored before the triggers existed
+    conn.execute('''
+        INSERT OR IGNORE INTO player_season_dirty (player_id, game_id)
+        SELECT player_id, game_id FROM skater_game_stats
+        UNION
+        SELECT player_id, game_id FROM goalie_game_stats''')
+
+
+def player_clusters(conn):
+    '''Fitted k-means models over player-season features, their centroids
+    and the cluster of every player-season'''
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS cluster_models (
+            model_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT NOT NULL,
+            k INTEGER NOT NULL,
+            features TEXT NOT NULL,
+            weights TEXT NOT NULL,
+            mean TEXT NOT NULL,
+            std TEXT NOT NULL,
+            min_games INTEGER NOT NULL,
+            seed INTEGER,
+            inertia REAL,
+            created_at REAL NOT NULL)''')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS cluster_centroids (
+            model_id INTEGER NOT NULL,
+            cluster INTEGER NOT NULL,
+            size INTEGER,
+            centroid TEXT NOT NULL,
+            PRIMARY KEY (model_id, cluster))''')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS player_season_clusters (
+            model_id INTEGER NOT NULL,
+            player_id INTEGER NOT NULL,
+            season TEXT NOT NULL,
+            game_type TEXT NOT NULL,
+            cluster INTEGER NOT NULL,
+            distance REAL,
+            assigned_at REAL NOT NULL,
+            PRIMARY KEY (model_id, player_id, season, game_type))''')
+    conn.execute(
+        'CREATE INDEX IF NOT EXISTS idx_player_season_clusters_cluster '
+        'ON player_season_clusters (model_id, cluster)')
+
+
+def ingest_metrics(conn):
+    '''Timings and row/byte counts of every ingest stage, see metrics.py'''
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS ingest_metrics (
+            run_id TEXT NOT NULL,
+            game_id INTEGER,
+            stage TEXT NOT NULL,
+            label TEXT,
+            seconds REAL,
+            rows INTEGER,
+            bytes INTEGER,
+            recorded_at REAL NOT NULL)''')
+    conn.execute(
+        'CREATE INDEX IF NOT EXISTS idx_ingest_metrics_run '
+        'ON ingest_metrics (run_id, stage, label)')
+
+
+def ingest_jobs(conn):
+    '''Ingest state of every game: pending, in_flight, done, failed (to be
+    retried after next_attempt_at) or dead (given up on, see
+    nhl_api/ingest_jobs)'''
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS ingest_jobs (
+            game_id INTEGER PRIMARY KEY,
+            status TEXT NOT NULL,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            last_error TEXT,
+            next_attempt_at REAL,
+            updated_at REAL)''')
+    conn.execute(
+        'CREATE INDEX IF NOT EXISTS idx_ingest_jobs_status '
+        'ON ingest_jobs (status, next_attempt_at)')
+
+
+# Play-by-play tables are stored dictionary encoded since migration 10:
+# the readable tables became views over these compact tables
+COMPACT_PLAY_TABLES = {
+    'game_plays_info': 'game_plays_compact',
+    'game_play_players': 'game_play_players_compact',
+}
+# Low-cardinality text columns stored as play_codes codes, per readable
+# table: {readable column: compact column}
+PLAY_CODED_COLUMNS = {
+    'game_plays_info': {
+        'event': 'event_code',
+        'secondaryType': 'secondaryType_code',
+        'strength': 'strength_code',
+        'penaltySeverity': 'penaltySeverity_code',
+        'periodType': 'periodType_code',
+    },
+    'game_play_players': {
+        'player_type': 'player_type_code',
+    },
+}
+
+COMPACT_PLAY_DDL = [
+    '''
+    CREATE TABLE play_codes (
+        code INTEGER PRIMARY KEY,
+        column_name TEXT NOT NULL,
+        value TEXT NOT NULL,
+        UNIQUE (column_name, value))''',
+    # dateTime is unix seconds; periodTime and periodTimeRemaining are
+    # rebuilt from their seconds columns
+    '''
+    CREATE TABLE game_plays_compact (
+        game_id INTEGER NOT NULL,
+        event_id INTEGER NOT NULL,
+        team_id INTEGER,
+        team_id_against INTEGER,
+        event_code INTEGER,
+        secondaryType_code INTEGER,
+        strength_code INTEGER,
+        gameWinningGoal INTEGER,
+        emptyNet INTEGER,
+        penaltySeverity_code INTEGER,
+        penaltyMinutes INTEGER,
+        x REAL,
+        y REAL,
+        period INTEGER,
+        periodType_code INTEGER,
+        periodTimeSeconds INTEGER,
+        periodTimeRemainingSeconds INTEGER,
+        gameSeconds INTEGER,
+        dateTime INTEGER,
+        goals_home INTEGER,
+        goals_away INTEGER,
+        PRIMARY KEY (game_id, event_id)) WITHOUT ROWID''',
+    # Kept apart so scans of the plays never read the free text. Holds text,
+    # or a blob when compressed (see compact_plays.compress_description).
+    '''
+    CREATE TABLE game_play_descriptions (
+        game_id INTEGER NOT NULL,
+        event_id INTEGER NOT NULL,
+        description,
+        PRIMARY KEY (game_id, event_id)) WITHOUT ROWID''',
+    '''
+    CREATE TABLE game_play_players_compact (
+        game_id INTEGER NOT NULL,
+        event_id INTEGER NOT NULL,
+        player_id INTEGER NOT NULL,
+        player_type_code INTEGER NOT NULL,
+        PRIMARY KEY (game_id, event_id, player_id, player_type_code)) WITHOUT ROWID''',
+    'CREATE INDEX idx_game_plays_compact_event ON game_plays_compact (event_code, game_id)',
+    'CREATE INDEX idx_game_plays_compact_seconds ON game_plays_compact (game_id, gameSeconds)',
+    'CREATE INDEX idx_game_play_players_compact_player '
+    'ON game_play_players_compact (player_id, game_id)',
+]
+
+
+def mm_ss_sql(column):
+    return (
+        f"CASE WHEN {column} IS NOT NULL "
+        f"THEN printf('%02d:%02d', {column} / 60, {column} % 60) END")
+
+
+def code_value_sql(code_column, alias):
+    return f'(SELECT value FROM play_codes WHERE code = {alias}.{code_column})'
+
+
+# The readable shape of the play tables, as they were before migration 10.
+# Decoded columns are scalar subqueries, so a query only pays for the ones
+# it reads. Descriptions are returned as stored, so any SQLite client can
+# read the views: text, or blobs when compressed, which readers decode
+# with compact_plays.play_description (a SQL function on connections from
+# misc_functions.connect_db and get_engine).
+COMPACT_PLAY_VIEWS = [
+    f'''
+    CREATE VIEW game_plays_info AS
+    SELECT
+        p.game_id || '_' || p.event_id AS play_id,
+        p.game_id,
+        p.event_id,
+        p.team_id,
+        p.team_id_against,
+        {code_value_sql('event_code', 'p')} AS event,
+        {code_value_sql('secondaryType_code', 'p')} AS secondaryType,
+        {code_value_sql('strength_code', 'p')} AS strength,
+        p.gameWinningGoal,
+        p.emptyNet,
+        {code_value_sql('penaltySeverity_code', 'p')} AS penaltySeverity,
+        p.penaltyMinutes,
+        p.x,
+        p.y,
+        p.period,
+        {code_value_sql('periodType_code', 'p')} AS periodType,
+        {mm_ss_sql('p.periodTimeSeconds')} AS periodTime,
+        {mm_ss_sql('p.periodTimeRemainingSeconds')} AS periodTimeRemaining,
+        strftime('%Y-%m-%dT%H:%M:%SZ', p.dateTime, 'unixepoch') AS dateTime,
+        p.goals_home,
+        p.goals_away,
+        (SELECT d.description FROM game_play_descriptions d
+         WHERE d.game_id = p.game_id AND d.event_id = p.event_id) AS description,
+        p.periodTimeSeconds,
+        p.periodTimeRemainingSeconds,
+        p.gameSeconds
+    FROM game_plays_compact p''',
+    f'''
+    CREATE VIEW game_play_players AS
+    SELECT
+        pp.game_id || '_' || pp.event_id AS play_id,
+        pp.game_id,
+        pp.player_id,
+        {code_value_sql('player_type_code', 'pp')} AS player_type,
+        pp.event_id
+    FROM game_play_players_compact pp''',
+]
+
+
+def compact_plays(conn):
+    '''Replaces game_plays_info and game_play_players with dictionary
+    encoded tables keyed by (game_id, event_id), and views of the same
+    name giving back the readable rows. Existing rows are converted; run
+    VACUUM afterwards to return the freed pages to the filesystem.'''
+
+    for ddl in COMPACT_PLAY_DDL:
+        conn.execute(ddl)
+
+    for table_name, coded in PLAY_CODED_COLUMNS.items():
+        for column in coded:
+            conn.execute(
+                f'''INSERT OR IGNORE INTO play_codes (column_name, value)
+                   SELECT DISTINCT '{column}', "{column}" FROM {table_name}
+                   WHERE "{column}" IS NOT NULL''')
+
+    def code_sql(column, alias):
+        return (
+            f"(SELECT code FROM play_codes "
+            f"WHERE column_name = '{column}' AND value = {alias}.\"{column}\")")
+
+    readable_columns = {
+        code: column
+        for column, code in PLAY_CODED_COLUMNS['game_plays_info'].items()}
+    play_columns = get_columns(conn, 'game_plays_compact')
+    select = []
+    for column in play_columns:
+        if column in readable_columns:
+            select.append(code_sql(readable_columns[column], 'p'))
+        elif column == 'dateTime':
+            select.append("CAST(strftime('%s', p.dateTime) AS INTEGER)")
+        else:
+            select.append(f'p."{column}"')
+    conn.execute(
+        f'''INSERT OR REPLACE INTO game_plays_compact ({', '.join(play_columns)})
+           SELECT {', '.join(select)} FROM game_plays_info p''')
+    conn.execute(
+        '''INSERT OR REPLACE INTO game_play_descriptions (game_id, event_id, description)
+           SELECT game_id, event_id, description FROM game_plays_info
+           WHERE description IS NOT NULL''')
+    conn.execute(
+        f'''INSERT OR IGNORE INTO game_play_players_compact
+           (game_id, event_id, player_id, player_type_code)
+           SELECT pp.game_id,
+                  CAST(substr(pp.play_id, instr(pp.play_id, '_') + 1) AS INTEGER),
+                  pp.player_id, {code_sql('player_type', 'pp')}
+           FROM game_play_players pp
+           WHERE pp.player_id IS NOT NULL AND pp.player_type IS NOT NULL''')
+
+    conn.execute('DROP TABLE game_plays_info')
+    conn.execute('DROP TABLE game_play_players')
+    for view in COMPACT_PLAY_VIEWS:
+        conn.execute(view)
+
+
+def plain_play_descriptions(conn):
+    '''Recreates the game_plays_info view of migration 10 without the
+    play_description function, which clients other than connect_db and
+    get_engine do not have'''
+    conn.execute('DROP VIEW IF EXISTS game_plays_info')
+    conn.execute(COMPACT_PLAY_VIEWS[0])
+
+
+def entity_sources(conn):
+    '''The game player_info and team_info rows were last taken from, so an
+    older game (reprocessed or backfilled) never overwrites them. Rows from
+    the people and teams endpoints have none.'''
+    for table_name in ENTITY_TABLES:
+        if 'source_game_id' not in get_columns(conn, table_name):
+            conn.execute(
+                f'ALTER TABLE {table_name} ADD COLUMN source_game_id INTEGER')
+
+
+# (version, migration) pairs, applied in order. Never edit a released
+# migration, add a new one instead.
+MIGRATIONS = [
+    (1, typed_tables),
+    (2, entity_tables),
+    (3, http_validators),
+    (4, plays_on_ice),
+    (5, time_seconds),
+    (6, player_season_features),
+    (7, player_clusters),
+    (8, ingest_metrics),
+    (9, ingest_jobs),
+    (10, compact_plays),
+    (11, plain_play_descriptions),
+    (12, entity_sources),
+]
+
+
+def get_schema_version(conn):
+    return conn.execute('PRAGMA user_version').fetchone()[0]
+
+
+def migrate_database(conn):
+    '''Switches the database to WAL, which the synchronous=NORMAL of
+    SQLITE_PRAGMAS relies on to stay safe, and applies every migration newer
+    than its user_version, each in its own transaction'''
+
+    isolation_level = conn.isolation_level
+    conn.isolation_level = None
+    try:
+        conn.execute('PRAGMA journal_mode=WAL')
+        for version, migration in MIGRATIONS:
+            if version <= get_schema_version(conn):
+                continue
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                migration(conn)
+                conn.execute(f'PRAGMA user_version = {version}')
+                conn.execute('COMMIT')
+            except Exception:
+                conn.execute('ROLLBACK')
+                raise
+            logger.info(f'Applied schema migration {version} ({migration.__name__})')
+    finally:
+        conn.isolation_level = isolation_level
@@ -1,2 +1,86 @@
-DATABASE_NAME = 'nhl_database.db'
+import os
 
+DATABASE_NAME = os.environ.get('NHL_DATABASE', 'nhl_database.db')
+
+# API hosts. Overridable so the fetchers can be pointed at a stand-in
+# server, see benchmarks/
+NHL_STATS_API_URL = os.environ.get('NHL_STATS_API_URL', 'https://statsapi.web.nhl.com')
+NHL_SHIFTS_API_URL = os.environ.get('NHL_SHIFTS_API_URL', 'https://api.nhle.com')
+MONEYPUCK_HOST_URL = os.environ.get('MONEYPUCK_HOST_URL', 'https://moneypuck.com')
+MONEYPUCK_SHOTS_HOST_URL = os.environ.get('MONEYPUCK_SHOTS_HOST_URL', 'https://peter-tanner.com')
+
+# Ingest concurrency
+FETCH_WORKERS = 8
+REQUESTS_PER_SECOND_PER_HOST = float(os.environ.get('NHL_REQUESTS_PER_SECOND', 10))
+PARSE_WORKERS = max(1, (os.cpu_count() or 2) - 1)
+# Most games fetched but not yet written at any time
+PIPELINE_DEPTH = 64
+
+# HTTP response cache. In offline mode only cached responses are used.
+HTTP_CACHE_PATH = os.environ.get('NHL_HTTP_CACHE', 'http_cache.db')
+HTTP_CACHE_MAX_BYTES = 20 * 1024 ** 3
+HTTP_CACHE_OFFLINE = os.environ.get('NHL_OFFLINE', '0') == '1'
+
+# Number of games buffered by the database writer before each transaction
+GAMES_PER_FLUSH = 50
+
+# SQLite tuning applied to every connection
+SQLITE_PRAGMAS = [
+    'PRAGMA synchronous=NORMAL',
+    'PRAGMA cache_size=-262144',  # KiB, i.e. 256MB
+    'PRAGMA mmap_size=1073741824',
+    'PRAGMA temp_store=MEMORY',
+]
+
+# Shared HTTP transport, see http_client.py. Connections are kept alive
+# and pooled per host; timeouts are in seconds.
+HTTP_USER_AGENT = 'Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.11 (KHTML, like Gecko) Chrome/23.0.1271.64 Safari/537.11'
+HTTP_CONNECT_TIMEOUT = 10
+HTTP_TIMEOUT = 60
+HTTP_POOL_HOSTS = 8
+# At least the number of fetch threads, so none waits for a connection
+HTTP_POOL_SIZE = 2 * FETCH_WORKERS
+
+# Large file downloads
+DOWNLOAD_CHUNK_SIZE = 1024 ** 2
+
+# Store play descriptions zlib compressed, see compact_plays.py
+COMPRESS_PLAY_DESCRIPTIONS = os.environ.get('NHL_COMPRESS_DESCRIPTIONS', '0') == '1'
+
+# Compressed archive of every fetched game feed and shiftchart
+ARCHIVE_DATABASE_NAME = os.environ.get('NHL_ARCHIVE_DATABASE', 'nhl_archive.db')
+
+# Player similarity index, memory-mapped from this directory
+SIMILARITY_INDEX_PATH = os.path.join('data', 'similarity')
+# Player-seasons with fewer games are left out of the index
+SIMILARITY_MIN_GAMES = 10
+
+# Player-season clustering
+CLUSTER_COUNT = 12
+CLUSTER_BATCH_SIZE = 2048
+CLUSTER_MAX_ITERATIONS = 200
+# Threads computing distances to the centroids
+CLUSTER_WORKERS = os.cpu_count() or 1
+
+# Ingest metrics: a JSON lines log and Prometheus textfiles are written
+# here, alongside the ingest_metrics table. NHL_PROFILE=cprofile or
+# tracemalloc also captures a profile of each run.
+METRICS_PATH = os.environ.get('NHL_METRICS_PATH', 'metrics')
+METRICS_PROFILE = os.environ.get('NHL_PROFILE', '')
+
+# Retries of transient HTTP errors (timeouts, 429, 5xx) within a run, with
+# exponential backoff and full jitter
+FETCH_RETRIES = 4
+FETCH_BACKOFF_SECONDS = 1
+FETCH_BACKOFF_MAX_SECONDS = 60
+# Games failing this many runs go to the dead-letter list; between runs a
+# failed game waits JOB_RETRY_BACKOFF_SECONDS * 2 ** (attempts - 1)
+JOB_MAX_ATTEMPTS = 5
+JOB_RETRY_BACKOFF_SECONDS = 15 * 60
+JOB_RETRY_BACKOFF_MAX_SECONDS = 24 * 60 * 60
+
+# Season-partitioned Parquet copies of the largest tables, see
+# parquet_export.py
+PARQUET_PATH = os.environ.get('NHL_PARQUET_PATH', os.path.join('data', 'parquet'))
+PARQUET_ROW_GROUP_SIZE = 32768
+PARQUET_COMPRESSION = 'zstd'